@@ -3,8 +3,10 @@
 # Based on Introduction to Computing Systems: From Bits & Gates to C/C++ & Beyond
 # https://www.mheducation.com/highered/product/Introduction-to-Computing-Systems-From-Bits-and-Gates-to-C-C%2B%2B-and-Beyond-Patt.html
 
-# Does not implement RTI or TRAP instructions
-# INT signal is treated as a NOP (call to state 49 and then to 33)
+# Does not implement the TRAP instruction or the reserved opcode, which are NOPs
+# An access violation goes back to state 18 from the ACV states, not through vector x02
+# Interrupts come from an InterruptController, see there, RTI and the privilege mode
+# exception go as in the book
 
 # Bit string functions
 
@@ -23,11 +25,71 @@ class BitString:
         
 # Logging functions
 
+# Methods marked with @logged are recompiled by set_log_level() with every
+# log(depth, ...) call deeper than the log level removed, so the f-string for a
+# message that would not be printed is never built
+
+import ast
+import inspect
+import textwrap
+
 log_level = 3
 
+# Deepest log() depth used
+LOG_DEPTH_MAX = 4
+
+logged_methods = []
+logged_variants = {}
+
+def logged(method):
+    logged_methods.append(method)
+    return method
+
+class LogStripper(ast.NodeTransformer):
+    def __init__(self, level):
+        self.level = level
+
+    def visit_Expr(self, node):
+        call = node.value
+        if (isinstance(call, ast.Call) and isinstance(call.func, ast.Name) and call.func.id == "log"
+                and isinstance(call.args[0], ast.Constant) and call.args[0].value > self.level):
+            return None
+        return node
+
+    def generic_visit(self, node):
+        super().generic_visit(node)
+        # A block left with only log() calls still needs a statement
+        if hasattr(node, "body") and isinstance(node.body, list) and not node.body:
+            node.body = [ast.Pass()]
+        return node
+
+def strip_logging(method, level):
+    source = textwrap.dedent(inspect.getsource(method))
+    tree = ast.parse(source)
+    tree.body[0].decorator_list = []
+    tree = ast.fix_missing_locations(LogStripper(level).visit(tree))
+    ast.increment_lineno(tree, method.__code__.co_firstlineno - 1)
+    namespace = {}
+    exec(compile(tree, inspect.getsourcefile(method), "exec"), method.__globals__, namespace)
+    return namespace[method.__name__]
+
 def set_log_level(level):
     global log_level
     log_level = level
+    variant_level = max(-1, min(level, LOG_DEPTH_MAX))
+    for method in logged_methods:
+        key = (method, variant_level)
+        if key not in logged_variants:
+            if variant_level == LOG_DEPTH_MAX:
+                logged_variants[key] = method
+            else:
+                try:
+                    logged_variants[key] = strip_logging(method, variant_level)
+                except (OSError, TypeError):
+                    # No source available, so keep the checks in log()
+                    logged_variants[key] = method
+        class_name = method.__qualname__.split(".")[0]
+        setattr(method.__globals__[class_name], method.__name__, logged_variants[key])
     
 def log(depth, x):
         if (depth <= log_level):
@@ -41,22 +103,38 @@ def check_bit(value, bit):
     return value & (1 << bit) != 0
 
 # Sign extend or zero extend a value, number of bits in the number, so 5:0 is 6 bits
+# Flipping the sign bit and subtracting it again extends the sign without a test
 
 def sign_extend(value, number_bits):
-    top_mask    = (0xffff << number_bits) & 0xffff
-    bottom_mask = (~top_mask) & 0xffff
-    new_value = value & bottom_mask
-    if check_bit(value, number_bits - 1):
-        new_value = new_value | top_mask
-#    print(f"{value:4x} {top_mask:4x} {bottom_mask:4x} {new_value:4x}")
-    return new_value
+    sign = 1 << (number_bits - 1)
+    return (((value & ((sign << 1) - 1)) ^ sign) - sign) & 0xffff
 
 def zero_extend(value, number_bits):
-    top_mask    = (0xffff << number_bits) & 0xffff
-    bottom_mask = (~top_mask) & 0xffff
-    new_value = value & bottom_mask
+    return value & ((1 << number_bits) - 1) & 0xffff
+
+# Bits high:low of a value, so bit_field(IR, 11, 9) is DR
 
-    return new_value    
+def bit_field(value, high, low):
+    return (value >> low) & ((1 << (high - low + 1)) - 1)
+
+# Vectorised versions for whole arrays of words, for bulk disassembly and predecode
+# These need numpy, which the emulator itself does not
+
+def sign_extend_array(values, number_bits):
+    import numpy
+    sign = 1 << (number_bits - 1)
+    values = numpy.asarray(values).astype(numpy.int32)
+    return ((((values & ((sign << 1) - 1)) ^ sign) - sign) & 0xffff).astype(numpy.uint16)
+
+def zero_extend_array(values, number_bits):
+    import numpy
+    values = numpy.asarray(values).astype(numpy.int32)
+    return (values & ((1 << number_bits) - 1) & 0xffff).astype(numpy.uint16)
+
+def bit_field_array(values, high, low):
+    import numpy
+    values = numpy.asarray(values).astype(numpy.int32)
+    return ((values >> low) & ((1 << (high - low + 1)) - 1)).astype(numpy.uint16)
 
 # Definitions for Contol Unit - which are just signal names
 # Everything in this class can be accessed by other classes
@@ -137,64 +215,199 @@ class COND(IntEnum):
     INTERRUPT_TEST  = 5
     ACV_TEST        = 6
 
+from collections import namedtuple
+
+# Microinstruction format - one entry per field, most significant field first
+# This is the order get_state() packs the control signals into a word
+# (name, number of bits, type)
+
+MICROINSTRUCTION_FIELDS = [
+    ("IRD",             1, bool),
+    ("COND",            3, COND),
+    ("J",               6, int),
+    ("LD_MAR",          1, bool),
+    ("LD_MDR",          1, bool),
+    ("LD_IR",           1, bool),
+    ("LD_BEN",          1, bool),
+    ("LD_REG",          1, bool),
+    ("LD_CC",           1, bool),
+    ("LD_PC",           1, bool),
+    ("LD_PRIV",         1, bool),
+    ("LD_SAVED_SSP",    1, bool),
+    ("LD_SAVED_USP",    1, bool),
+    ("LD_VECTOR",       1, bool),
+    ("LD_PRIORITY",     1, bool),
+    ("LD_ACV",          1, bool),
+    ("GATE_PC",         1, bool),
+    ("GATE_MDR",        1, bool),
+    ("GATE_ALU",        1, bool),
+    ("GATE_MARMUX",     1, bool),
+    ("GATE_VECTOR",     1, bool),
+    ("GATE_PC_MINUS_1", 1, bool),
+    ("GATE_PSR",        1, bool),
+    ("GATE_SP",         1, bool),
+    ("PC_MUX",          2, PCMux),
+    ("DR_MUX",          2, DRMux),
+    ("SR1_MUX",         2, SR1Mux),
+    ("ADDR1_MUX",       1, ADDR1Mux),
+    ("ADDR2_MUX",       2, ADDR2Mux),
+    ("SP_MUX",          2, SPMux),
+    ("MAR_MUX",         1, MARMux),
+    ("TABLE_MUX",       1, TABLEMux),
+    ("VECTOR_MUX",      2, VECTORMux),
+    ("PSR_MUX",         1, PSRMux),
+    ("ALUK",            2, ALUK),
+    ("MIO_EN",          1, bool),
+    ("RW",              1, MemRW),
+    ("SET_PRIV",        1, Priv),
+]
+
+MICROINSTRUCTION_BITS = sum(bits for _, bits, _ in MICROINSTRUCTION_FIELDS)
+
+# Number of states addressable by J (6 bits)
+CONTROL_STORE_SIZE = 64
+
+def decode_microinstruction(word):
+    # Unpack a microinstruction word into a dict of control signal name: value
+    signals = {}
+    for name, bits, kind in reversed(MICROINSTRUCTION_FIELDS):
+        signals[name] = kind(word & ((1 << bits) - 1))
+        word >>= bits
+    return signals
+
+def encode_microinstruction(signals):
+    # Pack a dict of control signal name: value into a word, missing signals are 0
+    word = 0
+    for name, bits, _ in MICROINSTRUCTION_FIELDS:
+        word = (word << bits) | int(signals.get(name, 0))
+    return word
+
+# Position of each field in the word, counting from bit 0
+CONTROL_SHIFTS = {}
+shift = 0
+for name, bits, _ in reversed(MICROINSTRUCTION_FIELDS):
+    CONTROL_SHIFTS[name] = shift
+    shift += bits
+del shift
+
+# Cleared control signals, every signal is 0 / False apart from these
+CLEAR_CONTROL = encode_microinstruction({"ALUK": ALUK.PASSA, "SET_PRIV": Priv.USER})
+
+# The gates and loads only interrupts and RTI use, as bits of the control word, so the
+# datapath can pass over all of them in one test in the other states
+SYSTEM_GATES = encode_microinstruction({"GATE_VECTOR": 1, "GATE_PC_MINUS_1": 1, "GATE_PSR": 1})
+SYSTEM_LOADS = encode_microinstruction({"LD_PRIV": 1, "LD_SAVED_SSP": 1, "LD_SAVED_USP": 1,
+                                        "LD_VECTOR": 1, "LD_PRIORITY": 1})
+
+# The fields of a control word as plain ints and bools, which is what the datapath reads
+# Decoded once per distinct word
+
+ControlSignals = namedtuple("ControlSignals", [name for name, _, _ in MICROINSTRUCTION_FIELDS])
+
+control_signals_cache = {}
+
+def control_signals(word):
+    signals = control_signals_cache.get(word)
+    if signals is None:
+        values = []
+        for name, bits, kind in MICROINSTRUCTION_FIELDS:
+            value = (word >> CONTROL_SHIFTS[name]) & ((1 << bits) - 1)
+            values.append(value != 0 if kind is bool else value)
+        signals = control_signals_cache[word] = ControlSignals(*values)
+    return signals
+
+
+# Decoded instructions
+# Each instruction word is split into its fields once, with the offsets already sign
+# extended, and kept in an InstructionCache by the address it was fetched from
+
+DecodedInstruction = namedtuple("DecodedInstruction",
+    ["word", "opcode", "dr", "sr1", "sr2", "imm", "imm5", "offset6", "offset9",
+     "offset11", "trapvect8", "ir11", "nzp"])
+
+def decode_instruction(word):
+    return DecodedInstruction(
+        word      = word,
+        opcode    = word >> 12,
+        dr        = (word & 0x0e00) >> 9,                   # also SR for stores
+        sr1       = (word & 0x01c0) >> 6,                   # also BaseR
+        sr2       = word & 0x07,
+        imm       = check_bit(word, 5),
+        imm5      = sign_extend(word, 5),
+        offset6   = sign_extend(word, 6),
+        offset9   = sign_extend(word, 9),
+        offset11  = sign_extend(word, 11),
+        trapvect8 = zero_extend(word, 8),
+        ir11      = check_bit(word, 11),
+        nzp       = (word & 0x0e00) >> 9)                   # BEN mask, N = 4, Z = 2, P = 1
+
+# The same fields for a whole array of words at once (needs numpy)
+# Returns a dict of arrays keyed by the DecodedInstruction field names
+
+def decode_instruction_array(words):
+    import numpy
+    words = numpy.asarray(words).astype(numpy.uint16)
+    return {
+        "word":      words,
+        "opcode":    bit_field_array(words, 15, 12),
+        "dr":        bit_field_array(words, 11, 9),
+        "sr1":       bit_field_array(words, 8, 6),
+        "sr2":       bit_field_array(words, 2, 0),
+        "imm":       bit_field_array(words, 5, 5) != 0,
+        "imm5":      sign_extend_array(words, 5),
+        "offset6":   sign_extend_array(words, 6),
+        "offset9":   sign_extend_array(words, 9),
+        "offset11":  sign_extend_array(words, 11),
+        "trapvect8": zero_extend_array(words, 8),
+        "ir11":      bit_field_array(words, 11, 11) != 0,
+        "nzp":       bit_field_array(words, 11, 9)}
+
+class InstructionCache():
+    def __init__(self):
+        self.decoded = {}
+
+    # The word is checked as well as the address, so memory changed without
+    # going through invalidate() is still decoded again
+
+    def lookup(self, address, word):
+        instruction = self.decoded.get(address)
+        if instruction is None or instruction.word != word:
+            instruction = self.decoded[address] = decode_instruction(word)
+        return instruction
+
+    def invalidate(self, address):
+        self.decoded.pop(address, None)
+
+    def clear(self):
+        self.decoded.clear()
+
 
 # Control Unit class
     
+# The control signals are held in one packed control word (the microinstruction format)
+# and decoded into signals, a ControlSignals tuple, which the datapath reads
+# Each signal can still be read and written by name, as cu.LD_MAR and so on
+
 class ControlUnit():
+    __slots__ = ("control", "signals",
+                 "regs", "PC", "IR", "INST", "PSR", "bus", "MDR", "MAR", "R",
+                 "BEN", "ACV", "SR1", "SR2", "DR", "INT", "N", "Z", "P", "state",
+                 "SAVED_SSP", "SAVED_USP", "VECTOR", "INTV", "INT_PRIORITY",
+                 "MAR_MUX_OUT", "ALU_OUT", "PC_MUX_OUT", "ADDR2_MUX_OUT", "ADDR1_MUX_OUT",
+                 "ADDR_ADD_OUT", "SR1_OUT", "SR2_OUT", "SR2_MUX_OUT", "ACV_OUT", "BEN_OUT",
+                 "SP_MUX_OUT", "MEMORY_OUT", "icache", "microcode", "microcode_words",
+                 "next_state_table", "interrupt_controller")
+
     def clear_control_signals(self):
         # From C.3 The Data Path p705
-        
-        # LD signals
-        self.LD_MAR          = False
-        self.LD_MDR          = False
-        self.LD_IR           = False
-        self.LD_BEN          = False
-        self.LD_REG          = False
-        self.LD_CC           = False
-        self.LD_PC           = False
-
-        # LD signals - privilege and exceptions
-        self.LD_PRIV         = False
-        self.LD_PRIORITY     = False
-        self.LD_SAVED_SSP    = False
-        self.LD_SAVED_USP    = False
-        self.LD_ACV          = False
-        self.LD_VECTOR       = False
-
-        # Core gates
-        self.GATE_PC         = False
-        self.GATE_MDR        = False
-        self.GATE_ALU        = False
-        self.GATE_MARMUX     = False
-        
-        # Vector / interrupt / exception gates
-        self.GATE_VECTOR     = False
-        self.GATE_PC_MINUS_1 = False
-        self.GATE_PSR        = False
-        self.GATE_SP         = False
-
-        # MUX
-        self.PC_MUX          = PCMux.PC_PLUS_1
-        self.DR_MUX          = DRMux.IR_11_9
-        self.SR1_MUX         = SR1Mux.IR_11_9
-        self.ADDR1_MUX       = ADDR1Mux.PC
-        self.ADDR2_MUX       = ADDR2Mux.ZERO
-        self.SP_MUX          = SPMux.SP_PLUS_1
-        self.MAR_MUX         = MARMux.IR_7_0
-        self.PSR_MUX         = PSRMux.INDIVIDUAL
-        self.ALUK            = ALUK.PASSA
-
-        self.TABLE_MUX       = TABLEMux.X_00
-        self.VECTOR_MUX      = VECTORMux.INTV
-
-        # Memory signals
-        self.MIO_EN          = False
-        self.RW              = MemRW.RD
-
-        # Processor privilege level signals
-        self.SET_PRIV        = Priv.USER
-
-        # Internal stores
+        # LD, gate, mux, memory and privilege signals, all in the control word
+        self.control = CLEAR_CONTROL
+        self.signals = control_signals(CLEAR_CONTROL)
+
+        # Only the memory output is not worked out again every clock
+        self.MEMORY_OUT = 0
+
+    def clear_internal_stores(self):
         self.MAR_MUX_OUT     = 0
         self.ALU_OUT         = 0
         self.PC_MUX_OUT      = 0
@@ -206,6 +419,7 @@ class ControlUnit():
         self.SR2_MUX_OUT     = 0
         self.ACV_OUT         = 0
         self.BEN_OUT         = 0
+        self.SP_MUX_OUT      = 0
         self.MEMORY_OUT      = 0
         
     def clear_state_signals(self):
@@ -220,9 +434,16 @@ class ControlUnit():
         # Control Unit registers
         self.PC = 0x3000
         self.IR = 0
+        self.INST = decode_instruction(self.IR)
         self.PSR = 0b1000_0000_0000_0000
         self.bus = 0
 
+        # Stack pointers saved when switching between user and supervisor mode, and the
+        # vector of the interrupt or exception being taken
+        self.SAVED_SSP = 0x3000
+        self.SAVED_USP = 0
+        self.VECTOR = 0
+
         # Memory access registers
         self.MDR = 0
         self.MAR = 0
@@ -236,65 +457,104 @@ class ControlUnit():
         self.SR2 = 0
         self.DR = 0
         
-        # Non-state signals
+        # Non-state signals, from the interrupt controller
         self.INT = False
+        self.INTV = 0
+        self.INT_PRIORITY = 0
 
         self.N = False
         self.Z = False
         self.P = False
         
     def __init__(self):
+        self.icache = InstructionCache()
+        self.microcode = None
+        self.microcode_words = None
+        # The sequencer's table, set with the engine by LC3.set_engine()
+        self.next_state_table = None
+        self.interrupt_controller = None
+        self.reset()
+
+    def reset(self):
         self.clear_control_signals()
+        self.clear_internal_stores()
         self.clear_state_signals()
         self.clear_registers()
         self.clear_logic()
        
         self.state = 18 # start at state 18
 
+    # Everything that changes as the machine runs, for snapshot() and restore()
+    # The instruction cache, control store and interrupt controller are not, so are left out
+
+    SNAPSHOT_SLOTS = ("control", "signals",
+                      "regs", "PC", "IR", "INST", "PSR", "bus", "MDR", "MAR", "R",
+                      "BEN", "ACV", "SR1", "SR2", "DR", "INT", "N", "Z", "P", "state",
+                      "SAVED_SSP", "SAVED_USP", "VECTOR", "INTV", "INT_PRIORITY",
+                      "MAR_MUX_OUT", "ALU_OUT", "PC_MUX_OUT", "ADDR2_MUX_OUT", "ADDR1_MUX_OUT",
+                      "ADDR_ADD_OUT", "SR1_OUT", "SR2_OUT", "SR2_MUX_OUT", "ACV_OUT", "BEN_OUT",
+                      "SP_MUX_OUT", "MEMORY_OUT")
+
+    def snapshot(self):
+        values = [getattr(self, name) for name in self.SNAPSHOT_SLOTS]
+        values[2] = tuple(self.regs)
+        return tuple(values)
+
+    def restore(self, snapshot):
+        for name, value in zip(self.SNAPSHOT_SLOTS, snapshot):
+            setattr(self, name, value)
+        self.regs = list(self.regs)
+
     def get_state(self):
         config = BitString()
-        config.append_bool(self.IRD)
-        config.append_int(3, self.COND)
-        config.append_int(6, self.J)
-        config.append_bool(self.LD_MAR)
-        config.append_bool(self.LD_MDR)
-        config.append_bool(self.LD_IR)
-        config.append_bool(self.LD_BEN)
-        config.append_bool(self.LD_REG)
-        config.append_bool(self.LD_CC)
-        config.append_bool(self.LD_PC)
-        config.append_bool(self.LD_PRIV)
-        config.append_bool(self.LD_SAVED_SSP)
-        config.append_bool(self.LD_SAVED_USP)
-        config.append_bool(self.LD_VECTOR)
-        config.append_bool(self.LD_PRIORITY)
-        config.append_bool(self.LD_ACV)
-        config.append_bool(self.GATE_PC)
-        config.append_bool(self.GATE_MDR)
-        config.append_bool(self.GATE_ALU)
-        config.append_bool(self.GATE_MARMUX)
-        config.append_bool(self.GATE_VECTOR)
-        config.append_bool(self.GATE_PC_MINUS_1)
-        config.append_bool(self.GATE_PSR)
-        config.append_bool(self.GATE_SP)
-        config.append_int(2, self.PC_MUX)
-        config.append_int(2, self.DR_MUX)
-        config.append_int(2, self.SR1_MUX)
-        config.append_int(1, self.ADDR1_MUX)
-        config.append_int(2, self.ADDR2_MUX)
-        config.append_int(2, self.SP_MUX)
-        config.append_int(1, self.MAR_MUX)        
-        config.append_int(1, self.TABLE_MUX)
-        config.append_int(2, self.VECTOR_MUX)
-        config.append_int(1, self.PSR_MUX)
-        config.append_int(2, self.ALUK)
-        config.append_bool(self.MIO_EN)
-        config.append_bool(self.RW)
-        config.append_bool(self.SET_PRIV)
+        config.append_int(MICROINSTRUCTION_BITS, self.control)
         return config
-    
 
-        
+    # Microcode control store - an alternative to set_control_signals()
+    # Each state is decoded once when the control store is loaded, so each clock
+    # just loads the control word and signals for the state
+
+    def load_microcode(self, words):
+        if len(words) != CONTROL_STORE_SIZE:
+            raise ValueError(f"Control store needs {CONTROL_STORE_SIZE} words, got {len(words)}")
+        self.microcode_words = list(words)
+        self.microcode = [control_signals(word) for word in words]
+        self.next_state_table = build_next_state_table(words)
+
+    @logged
+    def set_microcode_signals(self):
+        self.control = self.microcode_words[self.state]
+        self.signals = self.microcode[self.state]
+        self.MEMORY_OUT = 0
+        log(2, f"State {self.state}")
+        # Acknowledging INT is not a datapath signal, so is not in the control word
+        if self.state == 49:
+            self.acknowledge_interrupt()
+
+    # The hardwired engine's signals - the words set_control_signals() gives for each state
+    # are built once into HARDWIRED_CONTROL_STORE, so each clock just looks its state up
+    # as set_microcode_signals() does
+    # Logging at level 1 or more goes through set_control_signals() instead, which is where
+    # each state's description is logged from
+
+    @logged
+    def set_hardwired_signals(self):
+        if log_level >= 1:
+            self.set_control_signals()
+            return
+        self.control = HARDWIRED_CONTROL_STORE[self.state]
+        self.signals = HARDWIRED_SIGNALS[self.state]
+        self.MEMORY_OUT = 0
+        if self.state == 49:
+            self.acknowledge_interrupt()
+
+    # State 49 takes the interrupt INT is asking for, so the controller can drop it
+    def acknowledge_interrupt(self):
+        self.INT = False
+        if self.interrupt_controller is not None:
+            self.interrupt_controller.acknowledge(self)
+
+    @logged
     def set_control_signals(self):
         # do this manually for now, can implement in a bitmap later
         self.clear_control_signals()
@@ -374,8 +634,14 @@ class ControlUnit():
             self.GATE_MARMUX = True
             self.J = 23
         elif self.state == 0b1000:
-            log(1, "RTI (NOP)")
-            self.J = 18
+            log(1, "RTI")
+            log(2, "MAR <- SP, |PSR[15]|")
+            self.SR1_MUX = SR1Mux.SP
+            self.ALUK = ALUK.PASSA
+            self.GATE_ALU = True
+            self.LD_MAR = True
+            self.COND = COND.PRIVILEGE_MODE
+            self.J = 36 # or 44 (+8)
         elif self.state == 0b1001:
             log(1, "NOT DR, SR")
             log(2, "DR <- NOT(SR1)")
@@ -555,54 +821,188 @@ class ControlUnit():
             log(2, "|ACV|")
             self.COND = COND.ACV_TEST
             self.J = 28 # or 60 (+32)
+        elif self.state == 34:
+            log(2, "SP <- SP + 1, |PSR[15]|")
+            self.SR1_MUX = SR1Mux.SP
+            self.SP_MUX = SPMux.SP_PLUS_1
+            self.GATE_SP = True
+            self.DR_MUX = DRMux.SP
+            self.LD_REG = True
+            self.COND = COND.PRIVILEGE_MODE
+            self.J = 51 # or 59 (+8)
         elif self.state == 35:
             log(2, "|ACV|")
             self.COND = COND.ACV_TEST
             self.J = 25 # or 57 (+32)
+        elif self.state == 36:
+            log(2, "MDR <- M, wait R")
+            self.MIO_EN = True
+            self.RW = MemRW.RD
+            self.LD_MDR = True
+            self.COND = COND.MEMORY_READY
+            self.J = 36 # or 38 (+2)
+        elif self.state == 37:
+            log(2, "MAR <- SP - 1, SP <- SP - 1")
+            self.SR1_MUX = SR1Mux.SP
+            self.SP_MUX = SPMux.SP_MINUS_1
+            self.GATE_SP = True
+            self.LD_MAR = True
+            self.DR_MUX = DRMux.SP
+            self.LD_REG = True
+            self.J = 41
+        elif self.state == 38:
+            log(2, "PC <- MDR")
+            self.GATE_MDR = True
+            self.PC_MUX = PCMux.BUS
+            self.LD_PC = True
+            self.J = 39
+        elif self.state == 39:
+            log(2, "MAR <- SP + 1, SP <- SP + 1")
+            self.SR1_MUX = SR1Mux.SP
+            self.SP_MUX = SPMux.SP_PLUS_1
+            self.GATE_SP = True
+            self.LD_MAR = True
+            self.DR_MUX = DRMux.SP
+            self.LD_REG = True
+            self.J = 40
+        elif self.state == 40:
+            log(2, "MDR <- M, wait R")
+            self.MIO_EN = True
+            self.RW = MemRW.RD
+            self.LD_MDR = True
+            self.COND = COND.MEMORY_READY
+            self.J = 40 # or 42 (+2)
+        elif self.state == 41:
+            log(2, "Mem[MAR] <- MDR, wait R")
+            self.MIO_EN = True
+            self.RW = MemRW.WR
+            self.COND = COND.MEMORY_READY
+            self.J = 41 # or 43 (+2)
+        elif self.state == 42:
+            log(2, "PSR <- MDR")
+            self.GATE_MDR = True
+            self.PSR_MUX = PSRMux.BUS
+            self.LD_PRIV = True
+            self.LD_PRIORITY = True
+            self.LD_CC = True
+            self.J = 34
+        elif self.state == 43:
+            log(2, "MDR <- PC - 1")
+            self.GATE_PC_MINUS_1 = True
+            self.LD_MDR = True
+            self.J = 47
+        elif self.state == 44:
+            log(1, "---Privilege mode exception")
+            log(2, "MDR <- PSR, PSR[15] <- 0, Vector <- x00")
+            self.GATE_PSR = True
+            self.LD_MDR = True
+            self.PSR_MUX = PSRMux.INDIVIDUAL
+            self.SET_PRIV = Priv.SUPER
+            self.LD_PRIV = True
+            self.VECTOR_MUX = VECTORMux.PRIV_EXCEPTION
+            self.LD_VECTOR = True
+            self.J = 45
+        elif self.state == 45:
+            log(2, "Saved_USP <- SP, SP <- Saved_SSP")
+            self.SR1_MUX = SR1Mux.SP
+            self.LD_SAVED_USP = True
+            self.SP_MUX = SPMux.SAVES_SSP
+            self.GATE_SP = True
+            self.DR_MUX = DRMux.SP
+            self.LD_REG = True
+            self.J = 37
+        elif self.state == 47:
+            log(2, "MAR <- SP - 1, SP <- SP - 1")
+            self.SR1_MUX = SR1Mux.SP
+            self.SP_MUX = SPMux.SP_MINUS_1
+            self.GATE_SP = True
+            self.LD_MAR = True
+            self.DR_MUX = DRMux.SP
+            self.LD_REG = True
+            self.J = 52
         elif self.state == 49:
-            log(2, "INT (NOP)")
-            self.INT = False
-            self.J = 33
+            log(1, "---INT")
+            log(2, "MDR <- PSR, PSR[15] <- 0, PSR[10:8] <- priority, Vector <- INTV, |PSR[15]|")
+            self.acknowledge_interrupt()
+            self.GATE_PSR = True
+            self.LD_MDR = True
+            self.PSR_MUX = PSRMux.INDIVIDUAL
+            self.SET_PRIV = Priv.SUPER
+            self.LD_PRIV = True
+            self.LD_PRIORITY = True
+            self.VECTOR_MUX = VECTORMux.INTV
+            self.LD_VECTOR = True
+            self.COND = COND.PRIVILEGE_MODE
+            self.J = 37 # or 45 (+8)
+        elif self.state == 51:
+            log(2, "NOP")
+            self.J = 18
+        elif self.state == 52:
+            log(2, "Mem[MAR] <- MDR, wait R")
+            self.MIO_EN = True
+            self.RW = MemRW.WR
+            self.COND = COND.MEMORY_READY
+            self.J = 52 # or 54 (+2)
+        elif self.state == 53:
+            log(2, "MDR <- M, wait R")
+            self.MIO_EN = True
+            self.RW = MemRW.RD
+            self.LD_MDR = True
+            self.COND = COND.MEMORY_READY
+            self.J = 53 # or 55 (+2)
+        elif self.state == 54:
+            log(2, "MAR <- x01'Vector")
+            self.TABLE_MUX = TABLEMux.X_01
+            self.GATE_VECTOR = True
+            self.LD_MAR = True
+            self.J = 53
+        elif self.state == 55:
+            log(2, "PC <- MDR")
+            self.GATE_MDR = True
+            self.PC_MUX = PCMux.BUS
+            self.LD_PC = True
+            self.J = 18
+        elif self.state == 59:
+            log(2, "Saved_SSP <- SP, SP <- Saved_USP")
+            self.SR1_MUX = SR1Mux.SP
+            self.LD_SAVED_SSP = True
+            self.SP_MUX = SPMux.SAVED_USP
+            self.GATE_SP = True
+            self.DR_MUX = DRMux.SP
+            self.LD_REG = True
+            self.J = 18
         else:
             log(1, f"MISSING CODE FOR INSTRUCTION {self.state}")
             self.J = 18
 
 
            
+    @logged
     def execute_logic(self):
         log(4, f"Logic: bus is 0x{self.bus:04x} ")
+        s = self.signals
+
+        # Fields of IR, decoded when IR was loaded
+        inst = self.INST
+        if inst.word != self.IR:
+            inst = self.INST = decode_instruction(self.IR)
+
+        # Each mux selects from its inputs in the order of its enum
  
-        # DR
-        if self.DR_MUX == DRMux.IR_11_9:
-            self.DR = (self.IR & 0x0e00) >> 9
-        elif self.DR_MUX == DRMux.R7:
-            self.DR = 0x7
-        elif self.DR_MUX == DRMux.SP:
-            self.DR = 0x6
+        # DR - DRMux IR_11_9, SP, R7
+        self.DR = (inst.dr, 0x6, 0x7)[s.DR_MUX]
         log(4, f"Logic: DR  is 0x{self.DR:02x} ")
         
-        # SR1
-        if self.SR1_MUX == SR1Mux.IR_11_9:
-            self.SR1 = (self.IR & 0x0e00) >> 9
-        elif self.SR1_MUX == SR1Mux.IR_8_6:
-            self.SR1 = (self.IR & 0x01c0) >> 6
-        elif self.SR1_MUX == SR1Mux.SP:
-            self.SR1 = 0x6
+        # SR1 - SR1Mux IR_11_9, IR_8_6, SP
+        self.SR1 = (inst.dr, inst.sr1, 0x6)[s.SR1_MUX]
         log(4, f"Logic: SR1 is 0x{self.SR1:02x} ")
         
         # SR2
-        self.SR2 = (self.IR & 0x07)
+        self.SR2 = inst.sr2
         log(4, f"Logic: SR2 is 0x{self.SR2:02x} ")
         
-        # ADDR2MUX
-        if self.ADDR2_MUX == ADDR2Mux.ZERO:
-            self.ADDR2_MUX_OUT = 0
-        elif self.ADDR2_MUX == ADDR2Mux.OFFSET_6:
-            self.ADDR2_MUX_OUT = sign_extend(self.IR, 6)
-        elif self.ADDR2_MUX == ADDR2Mux.PC_OFFSET_9:
-            self.ADDR2_MUX_OUT = sign_extend(self.IR, 9)
-        elif self.ADDR2_MUX == ADDR2Mux.PC_OFFSET_11:
-            self.ADDR2_MUX_OUT = sign_extend(self.IR, 11)
+        # ADDR2MUX - ADDR2Mux ZERO, OFFSET_6, PC_OFFSET_9, PC_OFFSET_11
+        self.ADDR2_MUX_OUT = (0, inst.offset6, inst.offset9, inst.offset11)[s.ADDR2_MUX]
         log(4, f"Logic: ADDR2_MUX_OUT is 0x{self.ADDR2_MUX_OUT:04x} ")
 
         # REG FILE
@@ -610,70 +1010,67 @@ class ControlUnit():
         self.SR2_OUT = self.regs[self.SR2]
         log(4, f"Logic: SR1_OUT is       0x{self.SR1_OUT:04x}")
         log(4, f"Logic: SR2_OUT is       0x{self.SR2_OUT:04x}")
+
+        # SP_MUX - SPMux SP_PLUS_1, SP_MINUS_1, SAVES_SSP, SAVED_USP
+        # Only worked out for GATE_SP, the one thing that reads it
+        if s.GATE_SP:
+            self.SP_MUX_OUT = ((self.SR1_OUT + 1) & 0xffff, (self.SR1_OUT - 1) & 0xffff,
+                               self.SAVED_SSP, self.SAVED_USP)[s.SP_MUX]
+            log(4, f"Logic: SP_MUX_OUT is    0x{self.SP_MUX_OUT:04x} ")
+            log(4, "SP is gated onto main bus")
+            self.bus = self.SP_MUX_OUT
         
-        # ADDR1MUX
-        if self.ADDR1_MUX == ADDR1Mux.PC:
-            self.ADDR1_MUX_OUT = self.PC
-        elif self.ADDR1_MUX == ADDR1Mux.BASE_R:
-            self.ADDR1_MUX_OUT = self.SR1_OUT
-        log(4, f"Logic: ADDR1MUX is      0x{self.ADDR1_MUX:04x} ")
+        # ADDR1MUX - ADDR1Mux PC, BASE_R
+        self.ADDR1_MUX_OUT = (self.PC, self.SR1_OUT)[s.ADDR1_MUX]
+        log(4, f"Logic: ADDR1MUX is      0x{s.ADDR1_MUX:04x} ")
         
         # ADDR_ADD
         self.ADDR_ADD_OUT = (self.ADDR1_MUX_OUT + self.ADDR2_MUX_OUT) & 0xffff
         log(4, f"Logic: ADDR_ADD_OUT is  0x{self.ADDR_ADD_OUT:04x} ")
         
-        # MAR_MUX
-        if self.MAR_MUX == MARMux.IR_7_0:
-            self.MAR_MUX_OUT = zero_extend(self.IR, 8)
-        elif self.MAR_MUX == MARMux.ADDER:
-            self.MAR_MUX_OUT = self.ADDR_ADD_OUT
+        # MAR_MUX - MARMux IR_7_0, ADDER
+        self.MAR_MUX_OUT = (inst.trapvect8, self.ADDR_ADD_OUT)[s.MAR_MUX]
         log(4, f"Logic: MAR_MUX_OUT is   0x{self.MAR_MUX_OUT:04x} ")
         
         # Check to see if need to gate MAR_MUX
-        if self.GATE_MARMUX:
+        if s.GATE_MARMUX:
             log(4, "MARMUX is gated onto main bus (after update)")
             self.bus = self.MAR_MUX_OUT
 
-        # PC_MUX
-        if self.PC_MUX == PCMux.PC_PLUS_1:
-            self.PC_MUX_OUT = self.PC + 1
-        elif self.PC_MUX == PCMux.BUS:
-            self.PC_MUX_OUT = self.bus
-        elif self.PC_MUX == PCMux.ADDER:
-            self.PC_MUX_OUT = self.ADDR_ADD_OUT
+        # PC_MUX - PCMux PC_PLUS_1, BUS, ADDER
+        self.PC_MUX_OUT = (self.PC + 1, self.bus, self.ADDR_ADD_OUT)[s.PC_MUX]
         log(4, f"Logic: PC_MUX_OUT is    0x{self.PC_MUX_OUT:04x} ")
         
         # There is no need to check for gating PC_MUX
         # PC is controlled by LD_PC
  
         # SR2_MUX
-        if check_bit(self.IR, 5):
-            self.SR2_MUX_OUT = sign_extend(self.IR, 5)
+        if inst.imm:
+            self.SR2_MUX_OUT = inst.imm5
         else:
             self.SR2_MUX_OUT = self.SR2_OUT
         log(4, f"Logic: SR2_MUX_OUT is   0x{self.SR2_MUX_OUT:04x} ")
 
 
-        # ALU
-        if   self.ALUK == ALUK.ADD:
+        # ALU - ALUK 0 ADD, 1 AND, 2 NOT, 3 PASSA
+        aluk = s.ALUK
+        if   aluk == 0:
             self.ALU_OUT = (self.SR2_MUX_OUT + self.SR1_OUT) & 0xffff
-        elif self.ALUK == ALUK.AND:
+        elif aluk == 1:
             self.ALU_OUT = (self.SR2_MUX_OUT & self.SR1_OUT) & 0xffff
-        elif self.ALUK == ALUK.NOT:
+        elif aluk == 2:
             self.ALU_OUT = (~self.SR1_OUT) & 0xffff
-        elif self.ALUK == ALUK.PASSA:
+        else:
             self.ALU_OUT = self.SR1_OUT
         log(4, f"Logic: ALU_OUT is       0x{self.ALU_OUT:04x} ")
         
         # Check to see if need to gate ALU
-        if self.GATE_ALU:
+        if s.GATE_ALU:
             log(4, "ALU is gated onto main bus (after update)")
             self.bus = self.ALU_OUT       
 
         # Calculate BEN
-        self.BEN_OUT = ((self.N and check_bit(self.IR, 11)) or
-                        (self.Z and check_bit(self.IR, 10)) or
-                        (self.P and check_bit(self.IR, 9)))
+        self.BEN_OUT = (inst.nzp & ((self.N << 2) | (self.Z << 1) | self.P)) != 0
         log(4, f"Logic: BEN_OUT is {self.BEN_OUT} ")
 
         # Calculate ACV
@@ -686,133 +1083,1604 @@ class ControlUnit():
 
 
     # Do Gates
-    # Missing GATE_VECTOR, GATE_PC_MINUS_1, GATE_PSR, GATE_SP
+    # GATE_SP is in execute_logic(), as SP_MUX is worked out there
     
+    @logged
     def process_gating(self):
-        if self.GATE_PC:
+        s = self.signals
+        if s.GATE_PC:
             log(3, "PC is gated onto main bus")
             self.bus = self.PC
 
-        if self.GATE_MDR:
+        if s.GATE_MDR:
             log(3, "MDR is gated onto main bus")
             self.bus = self.MDR
 
-        if self.GATE_ALU:
+        if s.GATE_ALU:
             log(3, "ALU is gated onto main bus")
             self.bus = self.ALU_OUT        
 
-        if self.GATE_MARMUX:
+        if s.GATE_MARMUX:
             log(3, "MARMUX is gated onto main bus")
             self.bus = self.MAR_MUX_OUT
 
+        if self.control & SYSTEM_GATES:
+            if s.GATE_VECTOR:
+                log(3, "Table'Vector is gated onto main bus")
+                self.bus = (s.TABLE_MUX << 8) | self.VECTOR
+
+            if s.GATE_PC_MINUS_1:
+                log(3, "PC - 1 is gated onto main bus")
+                self.bus = (self.PC - 1) & 0xffff
+
+            if s.GATE_PSR:
+                log(3, "PSR is gated onto main bus")
+                self.bus = self.PSR | (self.N << 2) | (self.Z << 1) | self.P
+
     # Determine the next state of the state machine
-    # Uses COND, IRD, IR, R, BEN, PSR, INT, ACV
-    
+    # Uses COND, IRD, IR, R, BEN, PSR, INT, ACV, through the next state table for the
+    # control store, see build_next_state_table()
+
+    @logged
     def set_new_state(self):
-        # IRD
-        if self.IRD:
-            # IR[15:12]
-            new_J = (self.IR & 0b1111_0000_0000_0000) >> 12
-        # no IRD
-        else:
-            new_J = self.J
-            if (self.COND == COND.ADDRESSING_MODE) and check_bit(self.IR, 11):
-                new_J += 1
-            if (self.COND == COND.MEMORY_READY) and self.R:
-                new_J += 2
-            if (self.COND == COND.BRANCH) and self.BEN:
-                new_J += 4       
-            if (self.COND == COND.PRIVILEGE_MODE) and check_bit(self.PSR, 15):
-                new_J += 8
-            if (self.COND == COND.INTERRUPT_TEST) and self.INT:
-                new_J += 16
-            if (self.COND == COND.ACV_TEST) and self.ACV:
-                new_J += 32
-        self.state = new_J
+        # As next_state_index(), written out as this is every clock
+        ir = self.IR
+        self.state = new_J = self.next_state_table[
+            (self.state << 10) | ((ir >> 6) & 0x3c0) | ((ir >> 11) & 1) | (self.R << 1) |
+            (self.BEN << 2) | ((self.PSR >> 12) & 8) | (self.INT << 4) | (self.ACV << 5)]
         log(2, f"New J: {new_J}")
 
+    @logged
     def load_registers(self):
+        s = self.signals
         # Do Loads at end (like falling edge of clock)
-        if self.LD_MDR:
+        if s.LD_MDR:
             # This could be to load MDR from a memory read or from the main bus
-            if self.MIO_EN:
+            if s.MIO_EN:
                 self.MDR = self.MEMORY_OUT
                 log(3, f"Loading MDR 0x{self.MDR:04x} from internal memory bus")
             else:
                 self.MDR = self.bus
                 log(3, f"Loading MDR 0x{self.MDR:04x} from main bus")            
             
-        if self.LD_MAR:
+        if s.LD_MAR:
             self.MAR = self.bus
             log(3, f"Loading MAR 0x{self.MAR:04x} from bus")
         
-        if self.LD_PC:
+        if s.LD_PC:
             self.PC = self.PC_MUX_OUT
             log(3, f"Loading PC from PC_MUX_OUT 0x{self.PC:04x}")
                 
-        if self.LD_IR:
+        if s.LD_IR:
             self.IR = self.bus
+            self.INST = self.icache.lookup(self.MAR, self.IR)
             log(3, f"Loading IR 0x{self.IR:04x} from bus")
      
-        if self.LD_CC:
-            self.Z = (self.bus == 0)
-            self.P = (self.bus > 0 and self.bus <= 0x7fff)
-            self.N = (self.bus > 0x7fff)
+        if s.LD_CC:
+            if s.PSR_MUX:
+                # PSR[2:0], from a PSR on the bus
+                self.N = (self.bus & 4) != 0
+                self.Z = (self.bus & 2) != 0
+                self.P = (self.bus & 1) != 0
+            else:
+                self.Z = (self.bus == 0)
+                self.P = (self.bus > 0 and self.bus <= 0x7fff)
+                self.N = (self.bus > 0x7fff)
             log(3, f"Loading Z N P {self.Z} {self.N} {self.P} from bus")
 
-        if self.LD_REG:
+        if s.LD_REG:
             self.regs[self.DR] = self.bus
             log(3, f"Loading DR R{self.DR} with 0x{self.bus:04x}")
 
-        if self.LD_ACV:
+        if s.LD_ACV:
             self.ACV = self.ACV_OUT
             log(3, f"Loading ACV with {self.ACV}")
 
-        if self.LD_BEN:
+        if s.LD_BEN:
             self.BEN = self.BEN_OUT
             log(3, f"Loading BEN with {self.BEN}")
 
+        if self.control & SYSTEM_LOADS:
+            self.load_system_registers(s)
+
+    # Loads for taking an interrupt or exception and for RTI
+    # PSRMux picks PSR[15] and PSR[10:8] from SET_PRIV and INT_PRIORITY, or from the bus
+
+    @logged
+    def load_system_registers(self, s):
+        if s.LD_VECTOR:
+            # VECTORMux INTV, PRIV_EXCEPTION, OPC_EXCEPTION, ACV_EXCEPTION
+            self.VECTOR = (self.INTV, 0x00, 0x01, 0x02)[s.VECTOR_MUX]
+            log(3, f"Loading Vector with 0x{self.VECTOR:02x}")
+
+        if s.LD_PRIV:
+            priv = self.bus & 0x8000 if s.PSR_MUX else s.SET_PRIV << 15
+            self.PSR = (self.PSR & 0x7fff) | priv
+            log(3, f"Loading PSR[15] with {priv >> 15}")
+
+        if s.LD_PRIORITY:
+            priority = self.bus & 0x0700 if s.PSR_MUX else self.INT_PRIORITY << 8
+            self.PSR = (self.PSR & 0xf8ff) | priority
+            log(3, f"Loading PSR[10:8] with {priority >> 8}")
+            # Which requests can interrupt depends on the priority
+            if self.interrupt_controller is not None:
+                self.interrupt_controller.update(self)
+
+        if s.LD_SAVED_SSP:
+            self.SAVED_SSP = self.SR1_OUT
+            log(3, f"Loading Saved_SSP with 0x{self.SAVED_SSP:04x}")
+
+        if s.LD_SAVED_USP:
+            self.SAVED_USP = self.SR1_OUT
+            log(3, f"Loading Saved_USP with 0x{self.SAVED_USP:04x}")
+
+# Named access to each control signal in the control word, for set_control_signals(),
+# tests and debugging
+# Reading gives the signal as its type (PCMux, ALUK and so on), writing packs it into the
+# word and decodes the word again, which is only done building the control store
+
+def control_signal_property(name, bits, kind):
+    shift = CONTROL_SHIFTS[name]
+    field_mask = (1 << bits) - 1
+    mask = field_mask << shift
+
+    def get_signal(self):
+        return kind((self.control >> shift) & field_mask)
+
+    def set_signal(self, value):
+        self.control = (self.control & ~mask) | ((int(value) << shift) & mask)
+        self.signals = control_signals(self.control)
+
+    return property(get_signal, set_signal)
+
+for name, bits, kind in MICROINSTRUCTION_FIELDS:
+    setattr(ControlUnit, name, control_signal_property(name, bits, kind))
+del name, bits, kind
+
+# Memory is the whole 16 bit address space as unsigned 16 bit words in one buffer
+# view is a memoryview of it, for reading and writing ranges without copying
+
+import mmap
+import os
+import sys
+from array import array
+
+# Memory is split into pages for snapshots, a snapshot only copies the pages written
+# since the one before and shares the rest with it
+# Memory.write() and the array record the pages they write, writes through the view or
+# anything else holding the buffer are not seen, so need Memory.mark_written() after them
+
+PAGE_BITS = 8
+PAGE_SIZE = 1 << PAGE_BITS
+PAGE_BYTES = 2 * PAGE_SIZE
+PAGES = 0x10000 >> PAGE_BITS
+ZERO_PAGE = bytes(PAGE_BYTES)
+
+class MemoryArray(array):
+    # Slices can also be assigned from a list, as when memory was a list
+    # Pages written are added to dirty
+    def __setitem__(self, index, value):
+        if isinstance(index, slice):
+            if not isinstance(value, array):
+                value = array("H", value)
+            start, stop, step = index.indices(len(self))
+            if step == 1:
+                self.dirty.update(range(start >> PAGE_BITS, ((stop - 1) >> PAGE_BITS) + 1))
+            else:
+                self.dirty.update({address >> PAGE_BITS for address in range(start, stop, step)})
+        else:
+            self.dirty.add((index % len(self)) >> PAGE_BITS)
+        super().__setitem__(index, value)
+
+# Memory latency models
+# Memory.set_latency() takes a number of cycles for every access (0 or 1 is zero wait,
+# R on the first cycle) or any object with a latency(address, rw) method, like these
+
+class RegionLatency():
+    # regions is a list of (first address, last address, cycles), anywhere else takes default
+    def __init__(self, default, regions):
+        self.default = default
+        self.regions = list(regions)
+
+    def latency(self, address, rw):
+        for first, last, cycles in self.regions:
+            if first <= address <= last:
+                return cycles
+        return self.default
+
+# Memory mapped devices from 0xfe00 are slower than the rest of memory
+
+def device_latency(memory_cycles=3, device_cycles=10):
+    return RegionLatency(memory_cycles, [(0xfe00, 0xffff, device_cycles)])
+
+MemorySnapshot = namedtuple("MemorySnapshot", ["pages", "clock_count", "access_latency",
+                                               "accesses", "wait_cycles"])
+
 class Memory():
     def __init__(self):
-        self.memory_max = 0x4000
-        self.memory = [0] * self.memory_max
+        self.memory_max = 0x10000
+        self.memory = MemoryArray("H", bytes(2 * self.memory_max))
+        self.memory.dirty = set()
+        self.view = memoryview(self.memory)
 
         self.clock_latency = 3
+        self.latency_model = None
+
+        self.icache = InstructionCache()
+        self.reset()
+
+    # Clear memory, any access in progress and the counters, but keep the latency settings
+
+    def reset(self):
+        self.memory[:] = array("H", bytes(2 * self.memory_max))
+        self.icache.clear()
+
+        # The pages of the last snapshot or restore, memory is these with the dirty pages
+        # written over
+        self.pages = (ZERO_PAGE,) * PAGES
+        self.memory.dirty.clear()
+
         self.clock_count = 0
+        self.access_latency = self.clock_latency
 
+        # Completed accesses and the cycles spent waiting for R, in all and in each state
+        self.accesses = 0
+        self.wait_cycles = 0
+        self.state_wait_cycles = [0] * CONTROL_STORE_SIZE
+
+    def set_latency(self, latency):
+        if isinstance(latency, int):
+            self.clock_latency = latency
+            self.latency_model = None
+        else:
+            self.latency_model = latency
+
+    # Every write from the machine comes through here, so decoded instructions are
+    # dropped when their word is overwritten (self modifying code)
+
+    def write(self, address, value):
+        self.view[address] = value
+        self.memory.dirty.add(address >> PAGE_BITS)
+        self.icache.invalidate(address)
+
+    # After writing memory through view, or any other way round the array, so the next
+    # snapshot or restore sees it
+    # With no range every page is compared with the last snapshot's, a full scan
+
+    def mark_written(self, start=0, length=None):
+        if length is None:
+            length = self.memory_max - start
+        if length > 0:
+            self.memory.dirty.update(range(start >> PAGE_BITS,
+                                           ((start + length - 1) >> PAGE_BITS) + 1))
+
+    # Snapshots - the pages of memory and the state of any access in progress
+    # Pages are bytes, so can be shared by any number of snapshots
+    # Only the dirty pages are copied, and one written back as it was is still shared
+
+    def snapshot(self):
+        dirty = self.memory.dirty
+        if dirty:
+            pages = list(self.pages)
+            for page in dirty:
+                start = page << PAGE_BITS
+                data = self.view[start:start + PAGE_SIZE].tobytes()
+                if data != pages[page]:
+                    pages[page] = data
+            self.pages = tuple(pages)
+            dirty.clear()
+        return MemorySnapshot(self.pages, self.clock_count, self.access_latency,
+                              self.accesses, self.wait_cycles)
+
+    # Only pages written since the last snapshot, or that differ between the last
+    # snapshot and this one, are copied back
+    # The instruction cache checks each word it decoded, so can be kept
+
+    def restore(self, snapshot):
+        dirty = self.memory.dirty
+        for page, (current, wanted) in enumerate(zip(self.pages, snapshot.pages)):
+            if current is not wanted or page in dirty:
+                start = page << PAGE_BITS
+                self.view[start:start + PAGE_SIZE] = memoryview(wanted).cast("H")
+        self.pages = snapshot.pages
+        dirty.clear()
+        (_, self.clock_count, self.access_latency,
+         self.accesses, self.wait_cycles) = snapshot
+
+    # Object images, as written by lc3as and https://wchargin.com/lc3web/
+    # Big endian 16 bit words, the first word is the origin of the rest
+    # The file is memory mapped and copied and byte swapped as a whole, never word by word
+
+    def load_image(self, filename):
+        with open(filename, "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            if size < 4 or size % 2 != 0:
+                raise ValueError(f"{filename} is not an image of 16 bit words with an origin")
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as image:
+                words = array("H")
+                words.frombytes(image)
+        if sys.byteorder == "little":
+            words.byteswap()
+        origin = words[0]
+        length = len(words) - 1
+        if origin + length > self.memory_max:
+            raise ValueError(f"{filename} runs past the end of memory")
+        self.memory[origin:origin + length] = words[1:]
+        return origin, length
+
+    # Each file is a segment with its own origin, returns (origin, length) for each
+
+    def load_images(self, filenames):
+        return [self.load_image(filename) for filename in filenames]
+
+    # With no range this saves all of memory as a core image, loaded again at 0x0000
+
+    def save_image(self, filename, origin=0x0000, length=None):
+        if length is None:
+            length = self.memory_max - origin
+        words = array("H", [origin])
+        words.extend(self.memory[origin:origin + length])
+        if sys.byteorder == "little":
+            words.byteswap()
+        with open(filename, "wb") as f:
+            words.tofile(f)
+
+    @logged
     def clock_cycle(self, cu):
         # There is no need to gate MDR as this can't change in this clock cycle
         # MDR is controlled by a LD_MDR
 
         cu.R = False
-        if cu.MIO_EN:
+        s = cu.signals
+        if s.MIO_EN:
             self.MEMORY_OUT = 0
             log(3, "Memory enabled")
-            # Use clock_count and clock_latency to emulate memory latency of clock_latency cycles
+            # Use clock_count and access_latency to emulate memory latency of access_latency cycles
+            # The latency is set at the start of each access, from clock_latency or the latency model
+            if self.clock_count == 0:
+                if self.latency_model is None:
+                    self.access_latency = self.clock_latency
+                else:
+                    self.access_latency = self.latency_model.latency(cu.MAR, cu.RW)
             self.clock_count += 1
-            if (self.clock_count >= self.clock_latency):
+            if (self.clock_count >= self.access_latency):
                 self.clock_count = 0
+                self.accesses += 1
                 cu.R = True
                 # The only place a memory write can come from is the MDR
                 # but a read goes to a mux before MDR
-                if cu.RW == MemRW.WR:
-                    self.memory[cu.MAR] = cu.MDR
+                if s.RW:                       # MemRW.WR
+                    self.write(cu.MAR, cu.MDR)
                     log(3, f"Memory write 0x{cu.MDR:04x} to 0x{cu.MAR:04x}")
                 else:
-                    cu.MEMORY_OUT = self.memory[cu.MAR]
+                    cu.MEMORY_OUT = self.view[cu.MAR]
                     log(3, f"Memory read 0x{cu.MEMORY_OUT:04x} from 0x{cu.MAR:04x}")
+            else:
+                self.wait_cycles += 1
+                self.state_wait_cycles[cu.state] += 1
+
+
+# Control store - the microcode for every state, built from set_control_signals()
+
+def build_control_store():
+    global log_level
+    saved_log_level = log_level
+    log_level = -1
+    try:
+        cu = ControlUnit()
+        words = []
+        for state in range(CONTROL_STORE_SIZE):
+            cu.state = state
+            cu.clear_state_signals()
+            cu.set_control_signals()
+            words.append(cu.get_state().bits)
+    finally:
+        log_level = saved_log_level
+    return words
+
+# File format is one word per line, in hex, for states 0 to 63 in order
+# Anything after a # is a comment
+
+def save_control_store(filename, words):
+    with open(filename, "w") as f:
+        for state, word in enumerate(words):
+            f.write(f"0x{word:014x}    # state {state}\n")
+
+def load_control_store(filename):
+    words = []
+    with open(filename) as f:
+        for line in f:
+            line = line.split("#")[0].strip()
+            if line:
+                words.append(int(line, 0))
+    return words
+
+
+# Next state table - the sequencer as one lookup, the next state for every state and
+# every value of the inputs it can test
+# The index is the state and the inputs packed into 16 bits
+#   15:10   state
+#    9:6    IR[15:12], the opcode IRD dispatches on
+#    5      ACV         COND 6, adds 32 to J
+#    4      INT         COND 5, adds 16
+#    3      PSR[15]     COND 4, adds 8
+#    2      BEN         COND 2, adds 4
+#    1      R           COND 1, adds 2
+#    0      IR[11]      COND 3, adds 1
+# so each condition adds the bit it tests to J, and the table is just bytes
+
+NEXT_STATE_INPUT_BITS = 10
+COND_INPUT_BIT = {COND.ADDRESSING_MODE: 0, COND.MEMORY_READY: 1, COND.BRANCH: 2,
+                  COND.PRIVILEGE_MODE: 3, COND.INTERRUPT_TEST: 4, COND.ACV_TEST: 5}
+
+def next_state_index(state, ir, r, ben, psr, interrupt, acv):
+    return ((state << 10) | ((ir >> 6) & 0x3c0) | ((ir >> 11) & 1) | (r << 1) | (ben << 2) |
+            ((psr >> 12) & 8) | (interrupt << 4) | (acv << 5))
+
+def build_next_state_table(control_store):
+    table = bytearray()
+    inputs = range(1 << NEXT_STATE_INPUT_BITS)
+    for word in control_store:
+        s = control_signals(word)
+        if s.IRD:
+            table += bytes(i >> 6 for i in inputs)
+        elif s.COND in COND_INPUT_BIT:
+            bit = COND_INPUT_BIT[s.COND]
+            table += bytes(s.J + (i & (1 << bit)) for i in inputs)
+        else:
+            table += bytes([s.J]) * len(inputs)
+    return bytes(table)
+
+# The hardwired engine's control store, signals and next state table, built once the
+# module has everything build_control_store() needs, and before anything runs a cycle
+
+HARDWIRED_CONTROL_STORE = build_control_store()
+HARDWIRED_SIGNALS = [control_signals(word) for word in HARDWIRED_CONTROL_STORE]
+HARDWIRED_NEXT_STATE_TABLE = build_next_state_table(HARDWIRED_CONTROL_STORE)
+
+# The states the sequencer can get to from start, taking every input as possible,
+# so a state not in the set is never run whatever the program does
+# Gives {state: set of next states}
+
+def state_transitions(table):
+    inputs = 1 << NEXT_STATE_INPUT_BITS
+    return {state: set(table[state * inputs:(state + 1) * inputs])
+            for state in range(len(table) // inputs)}
+
+def reachable_states(table, start=18):
+    transitions = state_transitions(table)
+    reached = {start}
+    todo = [start]
+    while todo:
+        for state in transitions[todo.pop()]:
+            if state not in reached:
+                reached.add(state)
+                todo.append(state)
+    return reached
+
+def save_next_state_table(filename, table):
+    with open(filename, "wb") as f:
+        f.write(table)
+
+def load_next_state_table(filename):
+    with open(filename, "rb") as f:
+        table = f.read()
+    if len(table) != CONTROL_STORE_SIZE << NEXT_STATE_INPUT_BITS:
+        raise ValueError(f"Next state table needs {CONTROL_STORE_SIZE << NEXT_STATE_INPUT_BITS} bytes, got {len(table)}")
+    return table
+
+
+# Specialised state functions - one generated Python function per state, doing just
+# what that state's control signals use of process_gating(), execute_logic(),
+# Memory.clock_cycle(), set_new_state() and load_registers(), with the signals as
+# constants, so a cycle is one call with no muxes to select through
+# bus, the latches, registers, memory and its counters are left as the generic path leaves
+# them, as are control, signals and MEMORY_OUT for hooks that read them
+# DR is only set by the states that load a register, where it is used, not every cycle as
+# the generic path sets it
+# The internal stores (ALU_OUT, MAR_MUX_OUT and so on) are not kept, no later cycle reads them
+
+def specialise_state(state, word):
+    return "\n".join(["def step(cu, mem):"] + state_lines(state, word)) + "\n"
+
+# The body of a state's function, for specialise_state() and fuse_states()
+
+def state_lines(state, word):
+    s = control_signals(word)
+    lines = [f"    cu.control = {word}",
+             f"    cu.signals = SIGNALS_{state}",
+             "    cu.MEMORY_OUT = 0",
+             "    cu.R = False"]
+    if state == 49:
+        lines.append("    cu.acknowledge_interrupt()")
+
+    # Memory
+    if s.MIO_EN:
+        lines += ["    if mem.clock_count == 0:",
+                  "        if mem.latency_model is None:",
+                  "            mem.access_latency = mem.clock_latency",
+                  "        else:",
+                  f"            mem.access_latency = mem.latency_model.latency(cu.MAR, {s.RW})",
+                  "    mem.clock_count += 1",
+                  "    if mem.clock_count >= mem.access_latency:",
+                  "        mem.clock_count = 0",
+                  "        mem.accesses += 1",
+                  "        cu.R = True"]
+        if s.RW:
+            lines.append("        mem.write(cu.MAR, cu.MDR)")
+        else:
+            lines.append("        cu.MEMORY_OUT = mem.view[cu.MAR]")
+        lines += ["    else:",
+                  "        mem.wait_cycles += 1",
+                  f"        mem.state_wait_cycles[{state}] += 1"]
+
+    # What the datapath has to work out this state
+    ld_pc = s.LD_PC
+    if (ld_pc and s.PC_MUX == 1 and s.GATE_ALU and not
+            (s.GATE_MARMUX or s.GATE_VECTOR or s.GATE_PC_MINUS_1 or s.GATE_PSR or s.GATE_SP)):
+        # PC_MUX would see the ALU output from the clock before, which is not kept
+        raise ValueError(f"State {state} loads PC from the bus while gating the ALU")
+    needs_adder = (s.GATE_MARMUX and s.MAR_MUX) or (ld_pc and s.PC_MUX == 2)
+    needs_sr1 = (s.GATE_ALU or (needs_adder and s.ADDR1_MUX) or s.GATE_SP or
+                 s.LD_SAVED_SSP or s.LD_SAVED_USP)
+    needs_sr2 = s.GATE_ALU and s.ALUK in (0, 1)
+    needs_inst = needs_sr1 or needs_adder or s.GATE_MARMUX or s.LD_REG or s.LD_BEN
+    if needs_inst:
+        lines += ["    inst = cu.INST",
+                  "    if inst.word != cu.IR:",
+                  "        inst = cu.INST = decode_instruction(cu.IR)"]
+    if needs_sr1:
+        lines.append(f"    sr1_out = cu.regs[{('inst.dr', 'inst.sr1', '6')[s.SR1_MUX]}]")
+
+    # Gates, the last one gated wins, the adder and ALU outputs as they are this clock
+    bus = None
+    if s.GATE_PC:
+        bus = "cu.PC"
+    if s.GATE_MDR:
+        bus = "cu.MDR"
+    if s.GATE_VECTOR:
+        bus = f"{s.TABLE_MUX << 8} | cu.VECTOR"
+    if s.GATE_PC_MINUS_1:
+        bus = "(cu.PC - 1) & 0xffff"
+    if s.GATE_PSR:
+        bus = "cu.PSR | (cu.N << 2) | (cu.Z << 1) | cu.P"
+    if s.GATE_SP:
+        bus = ("(sr1_out + 1) & 0xffff", "(sr1_out - 1) & 0xffff", "cu.SAVED_SSP", "cu.SAVED_USP")[s.SP_MUX]
+    if needs_adder:
+        addr1 = "sr1_out" if s.ADDR1_MUX else "cu.PC"
+        addr2 = (None, "inst.offset6", "inst.offset9", "inst.offset11")[s.ADDR2_MUX]
+        lines.append(f"    adder = ({addr1} + {addr2}) & 0xffff" if addr2 else f"    adder = {addr1} & 0xffff")
+    if s.GATE_MARMUX:
+        bus = "adder" if s.MAR_MUX else "inst.trapvect8"
+    if bus is not None:
+        lines.append(f"    bus = cu.bus = {bus}")
+        bus = "bus"
+    if ld_pc:
+        lines.append(f"    pc = {('cu.PC + 1', 'cu.bus', 'adder')[s.PC_MUX]}")
+    if s.GATE_ALU:
+        if needs_sr2:
+            lines.append("    sr2 = inst.imm5 if inst.imm else cu.regs[inst.sr2]")
+        alu = ("(sr2 + sr1_out) & 0xffff", "sr2 & sr1_out", "sr1_out ^ 0xffff", "sr1_out")[s.ALUK]
+        lines.append(f"    bus = cu.bus = {alu}")
+        bus = "bus"
+    if bus is None:
+        bus = "cu.bus"
+
+    # Next state, from the latches before this clock loads them, and R from memory above
+    if s.IRD:
+        lines.append("    cu.state = cu.IR >> 12")
+    else:
+        test = {COND.MEMORY_READY: "cu.R", COND.BRANCH: "cu.BEN",
+                COND.ADDRESSING_MODE: "cu.IR & 0x0800", COND.PRIVILEGE_MODE: "cu.PSR & 0x8000",
+                COND.INTERRUPT_TEST: "cu.INT", COND.ACV_TEST: "cu.ACV"}.get(s.COND)
+        if test is None:
+            lines.append(f"    cu.state = {s.J}")
+        else:
+            taken = s.J | (1 << COND_INPUT_BIT[s.COND])
+            lines.append(f"    cu.state = {taken} if {test} else {s.J}")
+
+    # Loads, in the order load_registers() does them
+    if s.LD_MDR:
+        lines.append("    cu.MDR = cu.MEMORY_OUT" if s.MIO_EN else f"    cu.MDR = {bus}")
+    if s.LD_MAR:
+        lines.append(f"    cu.MAR = {bus}")
+    if ld_pc:
+        lines.append("    cu.PC = pc")
+    if s.LD_IR:
+        lines += [f"    cu.IR = {bus}",
+                  f"    cu.INST = cu.icache.lookup(cu.MAR, {bus})"]
+    if s.LD_CC and s.PSR_MUX:
+        lines += [f"    cu.N = ({bus} & 4) != 0",
+                  f"    cu.Z = ({bus} & 2) != 0",
+                  f"    cu.P = ({bus} & 1) != 0"]
+    elif s.LD_CC:
+        lines += [f"    cu.Z = {bus} == 0",
+                  f"    cu.P = 0 < {bus} <= 0x7fff",
+                  f"    cu.N = {bus} > 0x7fff"]
+    if s.LD_REG:
+        dr = ("inst.dr", "6", "7")[s.DR_MUX]
+        lines += [f"    cu.DR = {dr}",
+                  f"    cu.regs[{dr}] = {bus}"]
+    if s.LD_ACV:
+        lines.append(f"    cu.ACV = (cu.PSR & 0x8000) != 0 and ({bus} >= 0xfe00 or {bus} < 0x3000)")
+    if s.LD_BEN:
+        lines.append("    cu.BEN = (inst.nzp & ((cu.N << 2) | (cu.Z << 1) | cu.P)) != 0")
+    if s.LD_VECTOR:
+        lines.append(f"    cu.VECTOR = {('cu.INTV', '0x00', '0x01', '0x02')[s.VECTOR_MUX]}")
+    if s.LD_PRIV:
+        priv = f"({bus} & 0x8000)" if s.PSR_MUX else f"{s.SET_PRIV << 15}"
+        lines.append(f"    cu.PSR = (cu.PSR & 0x7fff) | {priv}")
+    if s.LD_PRIORITY:
+        priority = f"({bus} & 0x0700)" if s.PSR_MUX else "(cu.INT_PRIORITY << 8)"
+        lines += [f"    cu.PSR = (cu.PSR & 0xf8ff) | {priority}",
+                  "    if cu.interrupt_controller is not None:",
+                  "        cu.interrupt_controller.update(cu)"]
+    if s.LD_SAVED_SSP:
+        lines.append("    cu.SAVED_SSP = sr1_out")
+    if s.LD_SAVED_USP:
+        lines.append("    cu.SAVED_USP = sr1_out")
+    return lines
+
+# A state that waits for memory by looping on itself, and loads nothing but MDR from
+# memory, so its waiting cycles all do the same thing
+
+def wait_state(state, word):
+    s = control_signals(word)
+    loads = [name for name, _, _ in MICROINSTRUCTION_FIELDS if name.startswith("LD_") and getattr(s, name)]
+    return (s.MIO_EN and not s.IRD and s.COND == COND.MEMORY_READY and
+            s.J == state and loads in ([], ["LD_MDR"]))
+
+# What the generated functions for a control store refer to
+def state_namespace(control_store):
+    namespace = {f"SIGNALS_{state}": control_signals(word) for state, word in enumerate(control_store)}
+    namespace["decode_instruction"] = decode_instruction
+    return namespace
+
+def build_state_functions(control_store):
+    functions = []
+    for state, word in enumerate(control_store):
+        namespace = state_namespace(control_store)
+        exec(compile(specialise_state(state, word), f"<state {state}>", "exec"), namespace)
+        functions.append(namespace["step"])
+    return functions
+
+# Fused runs - the states from a state that the sequencer goes through whatever the inputs,
+# as one generated function, for the fused engine with a fixed latency
+# A run goes on past
+#   a state with one next state
+#   a memory wait, whose access takes max(latency, 1) cycles with a fixed latency, so its
+#   waiting cycles are added to the counters in one go and its last cycle is run
+#   a test of a latch (INT, ACV, BEN, IR[11], PSR[15]) to J, the way it goes unless there
+#   is an interrupt, an ACV or the like, and the run returns there if it goes the other way
+# and stops at an IRD, before state 18 or a state already in it, or after any other access
+# fused_run() gives the states of the run from a state, fuse_states() the function, which
+# runs them and returns the cycles they took
+
+def fused_run(control_store, start):
+    states = [start]
+    state = start
+    while True:
+        word = control_store[state]
+        s = control_signals(word)
+        if s.IRD or (s.MIO_EN and not wait_state(state, word)):
+            break
+        next_state = s.J | 2 if s.MIO_EN else s.J
+        if next_state == 18 or next_state in states:
+            break
+        states.append(next_state)
+        state = next_state
+    return states
+
+def fuse_states(control_store, states, latency):
+    lines = ["def run(cu, mem, state_cycles):"]
+    cycles = 0
+    for i, state in enumerate(states):
+        word = control_store[state]
+        s = control_signals(word)
+        lines.append(f"    # state {state}")
+        state_cycles = 1
+        if wait_state(state, word) and latency > 1:
+            # The access has waited all but its last cycle
+            state_cycles = latency
+            lines += [f"    mem.clock_count = {latency - 1}",
+                      f"    mem.access_latency = {latency}",
+                      f"    mem.wait_cycles += {latency - 1}",
+                      f"    mem.state_wait_cycles[{state}] += {latency - 1}"]
+        lines += state_lines(state, word)
+        lines.append(f"    state_cycles[{state}] += {state_cycles}")
+        cycles += state_cycles
+        if i + 1 < len(states) and not s.MIO_EN and s.COND != COND.UNCONDITIONAL:
+            lines += [f"    if cu.state != {states[i + 1]}:",
+                      f"        return {cycles}"]
+    lines.append(f"    return {cycles}")
+    return "\n".join(lines) + "\n", cycles
+
+# The fused run from each state, as (function, cycles for all of it), or None for a state
+# with nothing after it to fuse
+
+def build_fused_runs(control_store, latency):
+    namespace = state_namespace(control_store)
+    runs = []
+    for state in range(len(control_store)):
+        states = fused_run(control_store, state)
+        if len(states) == 1:
+            runs.append(None)
+            continue
+        source, cycles = fuse_states(control_store, states, latency)
+        exec(compile(source, f"<fused run from state {state}>", "exec"), namespace)
+        runs.append((namespace["run"], cycles))
+    return runs
+
+
+# Instruction costs - a static walk of the control store from state 18 back to state 18,
+# following every way the sequencer can go, for the cycles each instruction takes
+# without running it
+# A path is the states of one instruction and the inputs that chose them
+#   INT     - INT in state 18
+#   opcode  - IR[15:12], from the IRD dispatch
+#   BEN     - branch taken
+#   IR11    - JSR rather than JSRR
+#   PSR15   - user mode
+#   ACV     - which ACV test found a violation, counting from 1 for the one after the
+#             fetch, or 0 for none
+# A state that waits for memory by looping on itself is one access, which takes
+# max(latency, 1) cycles, every other state is one cycle
+# Once a state has loaded PSR[15], a privilege test after it goes by the value loaded,
+# or for one loaded from the bus (RTI) by the input NEW_PSR15, which is in the path but
+# not in the cost table, so the paths it splits must cost the same
+
+from itertools import product, repeat
+
+COST_INPUTS = ("INT", "opcode", "BEN", "IR11", "PSR15", "ACV")
+
+# inputs is {name: value} for the inputs the path tests
+InstructionPath = namedtuple("InstructionPath", ["inputs", "states", "cycles", "accesses"])
+
+InstructionCost = namedtuple("InstructionCost", ["cycles", "accesses"])
+
+COND_INPUT = {COND.BRANCH: "BEN", COND.ADDRESSING_MODE: "IR11", COND.PRIVILEGE_MODE: "PSR15",
+              COND.INTERRUPT_TEST: "INT"}
+
+def instruction_paths(control_store):
+    signals = [control_signals(word) for word in control_store]
+    paths = []
+
+    # privilege is the name of the input PSR[15] is now, or the value it was loaded with
+    def walk(state, inputs, states, cycles, accesses, acv_tests, privilege):
+        if len(states) > CONTROL_STORE_SIZE:
+            raise ValueError(f"State {states[0]} never gets back to state 18")
+        s = signals[state]
+        states = states + [state]
+        if wait_state(state, control_store[state]):
+            accesses += 1
+            successors = [(s.J + 2, inputs, acv_tests)]
+        elif s.IRD:
+            cycles += 1
+            successors = [(opcode, dict(inputs, opcode=opcode), acv_tests) for opcode in range(16)]
+        elif s.COND == COND.MEMORY_READY:
+            raise ValueError(f"State {state} waits for memory but does not loop on itself")
+        elif s.COND == COND.ACV_TEST:
+            cycles += 1
+            successors = [(s.J, inputs, acv_tests + 1),
+                          (s.J + 32, dict(inputs, ACV=acv_tests + 1), acv_tests + 1)]
+        elif s.COND == COND.PRIVILEGE_MODE and isinstance(privilege, bool):
+            cycles += 1
+            successors = [(s.J + 8 * privilege, inputs, acv_tests)]
+        elif s.COND in COND_INPUT:
+            cycles += 1
+            name = privilege if s.COND == COND.PRIVILEGE_MODE else COND_INPUT[s.COND]
+            bit = 1 << COND_INPUT_BIT[s.COND]
+            successors = [(s.J + bit * value, dict(inputs, **{name: value}), acv_tests)
+                          for value in (False, True) if inputs.get(name, value) == value]
+        else:
+            cycles += 1
+            successors = [(s.J, inputs, acv_tests)]
+        if s.LD_PRIV:
+            privilege = "NEW_PSR15" if s.PSR_MUX else s.SET_PRIV == Priv.USER
+        for next_state, next_inputs, next_acv_tests in successors:
+            if next_state == 18:
+                paths.append(InstructionPath(dict({"ACV": 0}, **next_inputs), states, cycles, accesses))
+            else:
+                walk(next_state, next_inputs, states, cycles, accesses, next_acv_tests, privilege)
+
+    walk(18, {}, [], 0, 0, 0, "PSR15")
+    return paths
+
+# Every path as {(INT, opcode, BEN, IR11, PSR15, ACV): InstructionCost}, with an entry for
+# each value of the inputs a path does not test
+
+def build_cost_table(control_store):
+    table = {}
+    for path in instruction_paths(control_store):
+        values = []
+        for name in COST_INPUTS:
+            if name in path.inputs:
+                values.append([path.inputs[name]])
+            elif name == "opcode":
+                values.append(range(16))
+            else:
+                values.append([False, True])
+        cost = InstructionCost(path.cycles, path.accesses)
+        for key in product(*values):
+            if table.get(key, cost) != cost:
+                raise ValueError(f"Paths for {key} take different numbers of cycles")
+            table[key] = cost
+    return table
+
+def instruction_cycles(cost, latency):
+    return cost.cycles + cost.accesses * max(latency, 1)
+
+# The cost table as cycles at one latency, in a list indexed by the inputs packed into
+# 10 bits, for the instruction level path
+#   9 INT, 8:5 opcode, 4 BEN, 3 IR11, 2 PSR15, 1:0 ACV
+
+def cycle_index(interrupt, opcode, ben, ir11, user, acv):
+    return (interrupt << 9) | (opcode << 5) | (ben << 4) | (ir11 << 3) | (user << 2) | acv
+
+def build_cycle_table(cost_table, latency):
+    table = [None] * 1024
+    for key, cost in cost_table.items():
+        if key[-1] > 3:
+            raise ValueError("Only 3 ACV tests in an instruction can be packed")
+        table[cycle_index(*key)] = instruction_cycles(cost, latency)
+    return table
+
+# The states of each path, as (state, waits for memory), for the counters of the
+# instruction and block level paths, in a list indexed as the cycle table with bit 10 for
+# PSR[15] after the instruction, which picks the state RTI goes to at the end
+
+PATH_INDEXES = 2048
+
+def build_path_states(control_store):
+    table = [None] * PATH_INDEXES
+    for path in instruction_paths(control_store):
+        states = tuple((state, wait_state(state, control_store[state])) for state in path.states)
+        values = []
+        for name in COST_INPUTS + ("NEW_PSR15",):
+            if name in path.inputs:
+                values.append([path.inputs[name]])
+            elif name == "opcode":
+                values.append(range(16))
+            else:
+                values.append([False, True])
+        for key in product(*values):
+            if key[5] > 3:
+                raise ValueError("Only 3 ACV tests in an instruction can be packed")
+            table[cycle_index(*key[:6]) | (key[6] << 10)] = states
+    return table
+
+HARDWIRED_COST_TABLE = build_cost_table(HARDWIRED_CONTROL_STORE)
+HARDWIRED_PATH_STATES = build_path_states(HARDWIRED_CONTROL_STORE)
+
+
+ArchitecturalState = namedtuple("ArchitecturalState", ["regs", "PC", "N", "Z", "P", "memory"])
+
+# What a batch run did, and why it stopped
+# reason is "cycles", "instructions", "breakpoint", "halt" or "until"
+
+RunSummary = namedtuple("RunSummary", ["cycles", "instructions", "faults", "reason"])
+
+# Performance counters, from LC3.counters()
+#   instructions        - instructions finished, each time back in state 18 as run_batch()
+#                         counts them, with those decoded by opcode in opcode_instructions
+#   state_cycles        - cycles spent in each state
+#   memory_wait_cycles  - cycles waiting for R, by state in state_wait_cycles
+#   acv                 - access violations, the ACV_STATES entered
+#   interrupts          - interrupts taken, state 49 entered
+#   opcode_cycles       - cycles from an instruction's state 18 to the next, for each opcode
+#   opcode_cpi          - opcode_cycles per instruction, None for an opcode not seen
+
+PerfCounters = namedtuple("PerfCounters", ["cycles", "instructions", "state_cycles",
+                                           "memory_wait_cycles", "state_wait_cycles",
+                                           "acv", "interrupts", "opcode_instructions",
+                                           "opcode_cycles", "opcode_cpi"])
+
+# The states ACV_TEST goes to on an access violation
+ACV_STATES = (48, 56, 57, 60, 61)
+
+# A whole machine at one cycle, from LC3.snapshot()
+
+Snapshot = namedtuple("Snapshot", ["cu", "mem", "cycles", "interrupts"])
+
+# History - an undo journal for running backwards
+# Each cycle adds an entry holding the old value of only what that cycle changes, which
+# its control word says: the latches its LD signals load, the register LD_REG writes, the
+# memory word at MAR if it writes memory (the only word a cycle can write) and the memory
+# access counters if it uses memory, as well as the state, control word, R, bus and memory
+# output every cycle sets
+# The datapath's internal stores (ALU_OUT, SR1 and so on) are worked out again by every
+# cycle that uses them, so are not kept
+# The interrupt controller is kept by a cycle that loads PSR[10:8], as that updates it, and
+# its events, run between cycles, by the entry of the cycle after them
+# The journal is a ring buffer of the last length cycles, with a snapshot every
+# snapshot_interval cycles, so going back further than the journal restores a snapshot
+# and runs forward again
+
+from collections import deque
+from operator import attrgetter
+
+HISTORY_ALWAYS = ("state", "control", "signals", "R", "bus", "MEMORY_OUT")
+HISTORY_LOADS = (("LD_MAR", ("MAR",)), ("LD_MDR", ("MDR",)), ("LD_IR", ("IR", "INST")),
+                 ("LD_BEN", ("BEN",)), ("LD_CC", ("N", "Z", "P")), ("LD_PC", ("PC",)),
+                 ("LD_PRIV", ("PSR",)), ("LD_SAVED_SSP", ("SAVED_SSP",)),
+                 ("LD_SAVED_USP", ("SAVED_USP",)), ("LD_VECTOR", ("VECTOR",)),
+                 ("LD_PRIORITY", ("PSR", "INT", "INTV", "INT_PRIORITY")), ("LD_ACV", ("ACV",)))
+MEMORY_HISTORY_NAMES = ("clock_count", "access_latency", "accesses", "wait_cycles")
+
+# What a cycle with this control word changes, as
+# (getter, names, LD_REG, fixed DR or None for IR[11:9], MIO_EN, writes memory, LD_PRIORITY)
+
+def history_plan(word):
+    s = control_signals(word)
+    names = list(HISTORY_ALWAYS)
+    for signal, loaded in HISTORY_LOADS:
+        if getattr(s, signal):
+            names += [name for name in loaded if name not in names]
+    fixed_dr = {DRMux.IR_11_9: None, DRMux.SP: 6, DRMux.R7: 7}[s.DR_MUX]
+    return (attrgetter(*names), tuple(names), s.LD_REG, fixed_dr, s.MIO_EN,
+            s.MIO_EN and s.RW == MemRW.WR, s.LD_PRIORITY)
+
+class History():
+    def __init__(self, lc, length=10000, snapshot_interval=1000, snapshots=100):
+        self.lc = lc
+        self.journal = deque(maxlen=length)
+        self.snapshot_interval = snapshot_interval
+        self.snapshots = deque(maxlen=snapshots)
+        self.get_memory = attrgetter(*MEMORY_HISTORY_NAMES)
+        self.plans = {}
+        self.clear()
+
+    def wrap(self, execute):
+        self.execute_inner = execute
+        return self.execute
 
+    def execute(self):
+        lc = self.lc
+        cu = lc.cu
+        mem = lc.mem
+        self.take_snapshot()
+
+        word = lc.control_store[cu.state]
+        plan = self.plans.get(word)
+        if plan is None:
+            plan = self.plans[word] = history_plan(word)
+        get_cu, names, load_reg, fixed_dr, memory, write, priority = plan
+        cu_before = get_cu(cu)
+        reg_change = None
+        if load_reg:
+            dr = (cu.IR >> 9) & 7 if fixed_dr is None else fixed_dr
+            reg_change = (dr, cu.regs[dr])
+        memory_before = self.get_memory(mem) if memory else None
+        memory_change = None
+        if write:
+            memory_change = (cu.MAR, mem.view[cu.MAR])
+        interrupts_before = None
+        if priority and lc.interrupts is not None:
+            interrupts_before = lc.interrupts.snapshot()
+        events_before = self.events_before
+        self.events_before = None
+
+        self.execute_inner()
+
+        if memory_change is not None and mem.view[memory_change[0]] == memory_change[1]:
+            memory_change = None
+        self.journal.append((names, cu_before, reg_change, memory_change, memory_before,
+                             interrupts_before, events_before))
+
+    # Every snapshot_interval cycles, before any events for the cycle are run, so running
+    # forward from it runs them again just once
+    def take_snapshot(self):
+        lc = self.lc
+        if lc.cycles % self.snapshot_interval == 0 and (
+                not self.snapshots or self.snapshots[-1].cycles != lc.cycles):
+            self.snapshots.append(lc.snapshot())
+
+    # Before events are run, the controller and the INT signals they can change
+    def record_events(self):
+        self.take_snapshot()
+        if self.events_before is None:
+            cu = self.lc.cu
+            self.events_before = (self.lc.interrupts.snapshot(), cu.INT, cu.INTV, cu.INT_PRIORITY)
+
+    def restore_events(self, events_before):
+        cu = self.lc.cu
+        interrupts, cu.INT, cu.INTV, cu.INT_PRIORITY = events_before
+        self.lc.interrupts.restore(interrupts)
+
+    # Undo the last cycle in the journal, then the events run before it
+    def undo(self):
+        (names, cu_before, reg_change, memory_change, memory_before,
+         interrupts_before, events_before) = self.journal.pop()
+        lc = self.lc
+        cu = lc.cu
+        for name, old in zip(names, cu_before):
+            setattr(cu, name, old)
+        if reg_change is not None:
+            cu.regs[reg_change[0]] = reg_change[1]
+        if memory_change is not None:
+            lc.mem.write(*memory_change)
+        if memory_before is not None:
+            for name, old in zip(MEMORY_HISTORY_NAMES, memory_before):
+                setattr(lc.mem, name, old)
+        if interrupts_before is not None:
+            lc.interrupts.restore(interrupts_before)
+        if events_before is not None:
+            self.restore_events(events_before)
+        lc.cycles -= 1
+
+    # The earliest cycle the history can go back to
+    def earliest(self):
+        earliest = self.lc.cycles - len(self.journal)
+        if self.snapshots:
+            earliest = min(earliest, self.snapshots[0].cycles)
+        return earliest
+
+    # Back to an earlier cycle, no earlier than earliest()
+    # Anything after that cycle is forgotten
+
+    # Running forward again runs events between cycles as run_batch() does
+
+    def go_back_to(self, cycles):
+        lc = self.lc
+        interrupts = lc.interrupts
+        if self.events_before is not None:
+            self.restore_events(self.events_before)
+            self.events_before = None
+        while self.snapshots and self.snapshots[-1].cycles > cycles:
+            self.snapshots.pop()
+        if cycles < lc.cycles - len(self.journal):
+            snapshot = self.snapshots[-1]
+            if interrupts is not None:
+                interrupts.restore(snapshot.interrupts)
+            lc.cu.restore(snapshot.cu)
+            lc.mem.restore(snapshot.mem)
+            lc.cycles = snapshot.cycles
+            self.journal.clear()
+        while lc.cycles > cycles:
+            self.undo()
+        while lc.cycles < cycles:
+            if interrupts is not None and lc.cycles >= interrupts.next_event:
+                lc.service_events()
+            self.execute()
+
+    # Start again from the machine as it is now
+    def clear(self):
+        self.journal.clear()
+        self.events_before = None
+        self.snapshots.clear()
+        self.snapshots.append(self.lc.snapshot())
+
+# Basic block translation
+# A run of instructions up to and including a BR, JMP, JSR, JSRR or TRAP, or up to an RTI,
+# is turned into one Python function, with the registers in locals and NZP worked out only
+# where it is used
+# RTI is left to execute_instruction(), as it changes the mode blocks are translated for
+# It does just what execute_instruction() would for each instruction in turn, and leaves
+# the same registers, memory, PC, NZP and MAR / MDR / IR / BEN / ACV latches
+# A block ending in a branch back to its own start loops inside the function
+# The function checks its instruction words first, so a block whose code has been changed,
+# by a store or in any other way, is never run and is translated again
+
+BLOCK_MAX_INSTRUCTIONS = 32
+
+# Opcodes that end a basic block - BR, JSR, RTI, JMP, TRAP
+BLOCK_END_OPCODES = frozenset([0b0000, 0b0100, 0b1000, 0b1100, 0b1111])
+
+# start and end are addresses, opcodes and words have one entry for each instruction
+# run(cu, regs, memory, write, limit) returns how many instructions it ran, going round a
+# loop while there is room for another time round in limit, or 0 if its code has changed
+
+Block = namedtuple("Block", ["start", "end", "opcodes", "words", "run", "source"])
+
+def protected_address(address):
+    return address >= 0xfe00 or address < 0x3000
+
+# Python for (mask & NZP) != 0, with NZP from cc, the value NZP was last loaded from,
+# or from the nzp bits at the start of the block (or of this time round a loop)
+
+def nzp_test(mask, cc):
+    if mask == 0:
+        return "False"
+    if cc is None:
+        return "nzp != 0" if mask == 7 else f"(nzp & {mask}) != 0"
+    return {1: "0 < cc < 0x8000", 2: "cc == 0", 3: "cc < 0x8000", 4: "cc > 0x7fff",
+            5: "cc != 0", 6: "not 0 < cc < 0x8000", 7: "True"}[mask]
+
+# user is PSR[15] for the blocks run, as fetches and loads / stores are checked for
+# ACV at translation where they can be
+# Returns None where there is no block, at a protected address in user mode, at 0xffff
+# or at an RTI
+
+def translate_block(memory, start, user):
+    if start == 0xffff or (user and protected_address(start)) or memory[start] >> 12 == 0b1000:
+        return None
+    source, end, opcodes, words, written, loops = block_source(memory, start, user)
+    if loops:
+        source, end, opcodes, words, written, loops = block_source(memory, start, user, written)
+    namespace = {}
+    exec(compile(source, f"<block 0x{start:04x}>", "exec"), namespace)
+    return Block(start, end, opcodes, words, namespace["run"], source)
+
+# loop_written is None for a block run once, or the registers the block writes for a
+# block that loops, which has every one of them in a local from the start
+
+def block_source(memory, start, user, loop_written=None):
+    loop = loop_written is not None
+    body = []
+    guards = []
+    opcodes = []
+    words = []
+    used = set()
+    written = set()
+    cc = None
+    uses_nzp = False
+    loops = False
+
+    # Lines that leave the block after instruction number count, at indent
+    def leave(indent, count, pc, ir, mar, mdr, ben, acv):
+        pad = "    " * indent
+        lines = [f"cu.PC = {pc}", f"cu.IR = {ir}", f"cu.MAR = {mar}", f"cu.MDR = {mdr}",
+                 f"cu.BEN = {ben}", f"cu.ACV = {acv}"]
+        lines += [f"regs[{r}] = r{r}" for r in sorted(loop_written if loop else written)]
+        if cc is not None:
+            lines += ["cu.N = cc > 0x7fff", "cu.Z = cc == 0", "cu.P = 0 < cc < 0x8000"]
+        elif loop:
+            lines += ["cu.N = (nzp & 4) != 0", "cu.Z = (nzp & 2) != 0", "cu.P = (nzp & 1) != 0"]
+        lines.append(f"return count + {count}" if loop else f"return {count}")
+        body.extend(pad + line for line in lines)
+
+    def test(mask):
+        nonlocal uses_nzp
+        if cc is None and mask != 0:
+            uses_nzp = True
+        return nzp_test(mask, cc)
+
+    # Checks a load or store address held in address, leaving with ACV if it is protected
+    def check_address(count, pc, word, mdr, mask):
+        if user:
+            body.append("    if address >= 0xfe00 or address < 0x3000:")
+            leave(2, count, pc, word, "address", mdr, test(mask), True)
+
+    address = start
+    while True:
+        word = memory[address]
+        inst = decode_instruction(word)
+        opcode = inst.opcode
+        pc = address + 1
+        dr, sr1, mask = inst.dr, inst.sr1, inst.nzp
+        count = len(opcodes) + 1
+        guards.append(f"memory[{address}] != {word}")
+        opcodes.append(opcode)
+        words.append(word)
+        last = (opcode in BLOCK_END_OPCODES or count == BLOCK_MAX_INSTRUCTIONS or
+                pc == 0xffff or (user and protected_address(pc)) or memory[pc] >> 12 == 0b1000)
+        body.append(f"    # 0x{address:04x} 0x{word:04x}")
+
+        if opcode in (0b0001, 0b0101, 0b1001):              # ADD, AND, NOT
+            used.add(sr1)
+            if inst.imm:
+                b = str(inst.imm5)
+            else:
+                b = f"r{inst.sr2}"
+                used.add(inst.sr2)
+            if opcode == 0b0001:
+                body.append(f"    r{dr} = (r{sr1} + {b}) & 0xffff")
+            elif opcode == 0b0101:
+                body.append(f"    r{dr} = r{sr1} & {b}")
+            else:
+                body.append(f"    r{dr} = r{sr1} ^ 0xffff")
+            written.add(dr)
+            if last:
+                body.append(f"    ben = {test(mask)}")
+            body.append(f"    cc = r{dr}")
+            cc = "cc"
+            if last:
+                leave(1, count, pc, word, address, word, "ben", False)
+        elif opcode == 0b1110:                              # LEA
+            body.append(f"    r{dr} = {(pc + inst.offset9) & 0xffff}")
+            written.add(dr)
+            if last:
+                leave(1, count, pc, word, address, word, test(mask), False)
+        elif opcode == 0b0000:                              # BR
+            target = (pc + inst.offset9) & 0xffff
+            body.append(f"    ben = {test(mask)}")
+            loops = target == start and mask != 0
+            if loop:
+                # Round again if there is room for all of it, with NZP as it is now, which
+                # a test or a leave before the first instruction setting it reads from nzp
+                body.append(f"    if ben and count + {2 * count} <= limit:")
+                body.append(f"        count += {count}")
+                if cc is not None:
+                    body.append("        nzp = 4 if cc > 0x7fff else 2 if cc == 0 else 1")
+                body.append("        continue")
+            leave(1, count, f"{target} if ben else {pc}", word, address, word, "ben", False)
+        elif opcode == 0b1100:                              # JMP
+            used.add(sr1)
+            leave(1, count, f"r{sr1}", word, address, word, test(mask), False)
+        elif opcode == 0b0100:                              # JSR, JSRR
+            if inst.ir11:
+                body.append(f"    target = {(pc + inst.offset11) & 0xffff}")
+            else:
+                used.add(sr1)
+                body.append(f"    target = r{sr1}")
+            body.append(f"    r7 = {pc}")
+            written.add(7)
+            leave(1, count, "target", word, address, word, test(mask), False)
+        elif opcode in (0b0010, 0b0110, 0b1010, 0b0011, 0b0111, 0b1011):   # loads and stores
+            if opcode in (0b0110, 0b0111):                  # LDR, STR - BaseR + offset6
+                used.add(sr1)
+                body.append(f"    address = (r{sr1} + {inst.offset6}) & 0xffff")
+                if opcode == 0b0111:
+                    used.add(dr)
+                check_address(count, pc, word, word if opcode == 0b0110 else f"r{dr}", mask)
+            else:
+                body.append(f"    address = {(pc + inst.offset9) & 0xffff}")
+                if user and protected_address((pc + inst.offset9) & 0xffff):
+                    # Only ST has loaded MDR with the register by then
+                    if opcode == 0b0011:
+                        used.add(dr)
+                    leave(1, count, pc, word, "address", f"r{dr}" if opcode == 0b0011 else word,
+                          test(mask), True)
+                    break
+            if opcode in (0b1010, 0b1011):                  # LDI, STI - through a pointer
+                if opcode == 0b1011:
+                    used.add(dr)
+                body.append("    address = memory[address]")
+                check_address(count, pc, word, "address" if opcode == 0b1010 else f"r{dr}", mask)
+            if opcode in (0b0010, 0b0110, 0b1010):
+                body.append(f"    r{dr} = memory[address]")
+                written.add(dr)
+                if last:
+                    body.append(f"    ben = {test(mask)}")
+                body.append(f"    cc = r{dr}")
+                cc = "cc"
+                if last:
+                    leave(1, count, pc, word, "address", f"r{dr}", "ben", False)
+            else:
+                used.add(dr)
+                body.append(f"    write(address, r{dr})")
+                if last:
+                    leave(1, count, pc, word, "address", f"r{dr}", test(mask), False)
+                else:
+                    # A store into this block leaves it, the rest is out of date
+                    body.append("    if BLOCK_START <= address <= BLOCK_END:")
+                    leave(2, count, pc, word, "address", f"r{dr}", test(mask), False)
+        else:                                               # TRAP, reserved - NOPs
+            if last:
+                leave(1, count, pc, word, address, word, test(mask), False)
+
+        if last:
+            break
+        address = pc
+
+    end = address
+    head = [f"    if {' or '.join(guards)}:", "        return 0"]
+    if uses_nzp or loop:
+        head.append("    nzp = (cu.N << 2) | (cu.Z << 1) | cu.P")
+    head += [f"    r{r} = regs[{r}]" for r in sorted(used | (loop_written if loop else set()))]
+    if loop:
+        head += ["    count = 0", "    while True:"]
+        body = ["    " + line for line in body]
+    lines = ["def run(cu, regs, memory, write, limit):"] + head + body
+    source = "\n".join(lines).replace("BLOCK_START", str(start)).replace("BLOCK_END", str(end)) + "\n"
+    return source, end, opcodes, words, written, loops
+
+# Interrupts
+# An InterruptController holds the interrupt requests of devices and drives INT, INTV and
+# INT_PRIORITY from the highest priority one above PSR[10:8], as the LC-3 interrupt logic
+# does, each time a request comes or goes and each time PSR[10:8] is loaded
+# The state machine takes INT in state 18, and state 49 acknowledges it, which drops the
+# request it took
+# Devices are not looked at every clock - what they will do is an event on a time ordered
+# queue (a heapq) of (cycle, sequence, device), and runs go through uninterrupted up to the
+# next event, see LC3.service_events()
+# A device has start(controller, cycle), called when it is added, and
+# event(controller, cycle), called for each event it schedules, with the cycle it was for,
+# and snapshot() and restore(state) for any state of its own
+
+import heapq
+
+# Cycle for no event, later than any run gets to
+NO_EVENT = 1 << 62
+
+# The keyboard and display of the LC-3 are x80 and x81, both at priority 4
+TIMER_VECTOR = 0x82
+TIMER_PRIORITY = 4
+
+# The controller's state, for LC3.snapshot() and History, with devices by their index in
+# devices, so it can be restored into a controller with the same devices added in the
+# same order, on another machine as well
+
+InterruptSnapshot = namedtuple("InterruptSnapshot", ["events", "sequence", "requests",
+                                                     "raised", "devices"])
+
+class InterruptController():
+    def __init__(self):
+        self.devices = []
+        self.reset()
+
+    def reset(self):
+        self.events = []
+        self.sequence = 0
+        self.next_event = NO_EVENT
+        # Devices asking for an interrupt, in the order they asked
+        self.requests = []
+        self.raised = None
+
+    # Back to no requests, with every device started again from cycle
+    def restart(self, cycle=0):
+        self.reset()
+        for device in self.devices:
+            device.start(self, cycle)
+
+    def add_device(self, device, cycle=0):
+        self.devices.append(device)
+        device.start(self, cycle)
+
+    def schedule(self, cycle, device):
+        heapq.heappush(self.events, (cycle, self.sequence, device))
+        self.sequence += 1
+        self.next_event = self.events[0][0]
+
+    # Every event due by cycle, in time order
+    def run_events(self, cycle):
+        events = self.events
+        while events and events[0][0] <= cycle:
+            event_cycle, _, device = heapq.heappop(events)
+            device.event(self, event_cycle)
+        self.next_event = events[0][0] if events else NO_EVENT
+
+    # A device already asking is not asked for twice
+    def request(self, device):
+        if device not in self.requests:
+            self.requests.append(device)
+
+    # The highest priority request, the first to ask of those with the same priority
+    def highest(self):
+        highest = None
+        for device in self.requests:
+            if highest is None or device.priority > highest.priority:
+                highest = device
+        return highest
+
+    def update(self, cu):
+        device = self.highest()
+        if device is not None and device.priority > (cu.PSR >> 8) & 7:
+            cu.INT = True
+            cu.INTV = device.vector
+            cu.INT_PRIORITY = device.priority
+            self.raised = device
+        else:
+            cu.INT = False
+            self.raised = None
+
+    def acknowledge(self, cu):
+        if self.raised is not None:
+            self.requests.remove(self.raised)
+            self.raised = None
+
+    def snapshot(self):
+        devices = self.devices
+        return InterruptSnapshot(
+            tuple((cycle, sequence, devices.index(device)) for cycle, sequence, device in self.events),
+            self.sequence,
+            tuple(devices.index(device) for device in self.requests),
+            None if self.raised is None else devices.index(self.raised),
+            tuple(device.snapshot() for device in devices))
+
+    # The events are copied in the same order, so are still a heap
+    def restore(self, snapshot):
+        devices = self.devices
+        if len(snapshot.devices) != len(devices):
+            raise ValueError(f"Snapshot has {len(snapshot.devices)} interrupt devices, "
+                             f"the controller has {len(devices)}")
+        self.events = [(cycle, sequence, devices[i]) for cycle, sequence, i in snapshot.events]
+        self.sequence = snapshot.sequence
+        self.next_event = self.events[0][0] if self.events else NO_EVENT
+        self.requests = [devices[i] for i in snapshot.requests]
+        self.raised = None if snapshot.raised is None else devices[snapshot.raised]
+        for device, state in zip(devices, snapshot.devices):
+            device.restore(state)
+
+# Asks for one interrupt at cycle, or never if cycle is None
+
+class InterruptDevice():
+    def __init__(self, priority, vector, cycle=None):
+        if not 0 <= priority <= 7:
+            raise ValueError(f"Priority {priority} is not 0 to 7")
+        if not 0 <= vector <= 0xff:
+            raise ValueError(f"Vector 0x{vector:x} is not 8 bits")
+        self.priority = priority
+        self.vector = vector
+        self.cycle = cycle
+
+    def start(self, controller, cycle):
+        if self.cycle is not None:
+            controller.schedule(self.cycle, self)
+
+    def event(self, controller, cycle):
+        controller.request(self)
+
+    # Nothing changes once it is started, its event is on the controller's queue
+    def snapshot(self):
+        return None
+
+    def restore(self, state):
+        pass
+
+# Asks for an interrupt every interval cycles, from when it is started
+# A tick while the one before is still waiting to be taken is lost, as it would be for a
+# device with one ready bit
+
+class Timer(InterruptDevice):
+    def __init__(self, interval, priority=TIMER_PRIORITY, vector=TIMER_VECTOR):
+        if interval < 1:
+            raise ValueError(f"Timer interval {interval} is less than 1 cycle")
+        super().__init__(priority, vector)
+        self.interval = interval
+        self.ticks = 0
+
+    def start(self, controller, cycle):
+        self.ticks = 0
+        controller.schedule(cycle + self.interval, self)
+
+    def event(self, controller, cycle):
+        self.ticks += 1
+        controller.request(self)
+        controller.schedule(cycle + self.interval, self)
+
+    def snapshot(self):
+        return self.ticks
+
+    def restore(self, state):
+        self.ticks = state
 
 class LC3():
     def __init__(self):
         self.cu = ControlUnit()
         self.mem = Memory()
-        
-    def execute(self):
-        self.cu.clear_control_signals()
-        self.cu.clear_state_signals()
-  
-        self.cu.set_control_signals()
+        self.cu.icache = self.mem.icache
+        self.cycles = 0
+        self.clear_counters()
+        self.breakpoints = set()
+        self.hooks = []
+        self.history = None
+        self.profiler = None
+        self.blocks = {}
+        self.block_costs = {}
+        self.interrupts = None
+        self.set_engine("hardwired")
+
+    # Back to power on, but keep the engine, latency settings and breakpoints
+    # so one machine can run many programs
+
+    def reset(self):
+        self.cu.reset()
+        self.mem.reset()
+        self.cycles = 0
+        self.clear_counters()
+        self.blocks.clear()
+        self.block_costs.clear()
+        if self.interrupts is not None:
+            self.interrupts.restart()
+        if self.history is not None:
+            self.history.clear()
+
+    # Engines
+    #   hardwired   - control signals from the if / elif chain in set_control_signals(),
+    #                 built once for each state, see set_hardwired_signals()
+    #   microcode   - control signals from a control store, built once or loaded from a file
+    #   specialised - a generated function for each state of a control store, see
+    #                 specialise_state()
+    #   fused       - specialised, with batch runs going through each fixed run of states,
+    #                 such as the fetch from 18 to 32, in one generated function for the
+    #                 latency, see execute_fused()
+
+    def set_engine(self, engine, control_store=None):
+        if engine == "hardwired":
+            control_store = HARDWIRED_CONTROL_STORE
+            self.cu.next_state_table = HARDWIRED_NEXT_STATE_TABLE
+            self.set_cost_table(HARDWIRED_COST_TABLE, HARDWIRED_PATH_STATES)
+            self.execute_cycle = self.execute_hardwired
+        elif engine == "microcode":
+            if control_store is None:
+                control_store = build_control_store()
+            self.cu.load_microcode(control_store)
+            self.set_cost_table(build_cost_table(control_store), build_path_states(control_store))
+            self.execute_cycle = self.execute_microcode
+        elif engine in ("specialised", "fused"):
+            if control_store is None:
+                control_store = build_control_store()
+            self.cu.load_microcode(control_store)
+            self.set_cost_table(build_cost_table(control_store), build_path_states(control_store))
+            self.state_functions = build_state_functions(control_store)
+            self.wait_states = [wait_state(state, word) for state, word in enumerate(control_store)]
+            # Fused runs for each latency, the one set now built here and any other as it is
+            # first needed, see fused_runs_for()
+            self.fused_runs = {}
+            self.execute_cycle = self.execute_specialised
+        else:
+            raise ValueError(f"Unknown engine {engine}")
+        self.engine = engine
+        self.control_store = control_store
+        if engine == "fused" and self.mem.latency_model is None:
+            self.fused_runs_for(self.mem.clock_latency)
+        self.install_hooks()
+
+    # The cycles each instruction takes through the engine's control store, and the states
+    # it goes through, for the instruction and block level paths, see build_cost_table()
+    # and build_path_states()
+
+    def set_cost_table(self, cost_table, path_states):
+        self.count_paths()
+        self.cost_table = cost_table
+        self.path_states = path_states
+        self.cycle_table = None
+        self.cycle_table_latency = None
+        self.block_costs.clear()
+
+    # The cost table as a cycle table for the latency now
+    def update_cycle_table(self):
+        self.count_paths()
+        self.cycle_table = build_cycle_table(self.cost_table, self.mem.clock_latency)
+        self.cycle_table_latency = self.mem.clock_latency
+        self.max_instruction_cycles = max(cycles for cycles in self.cycle_table if cycles is not None)
+
+    # Interrupts come from an InterruptController, or None for none
+    # Its events are run by run_batch(), execute_instruction() and execute_block() as they
+    # come due, a cycle at a time through execute() they are not
+
+    def set_interrupts(self, controller):
+        self.interrupts = controller
+        self.cu.interrupt_controller = controller
+        if controller is None:
+            self.cu.INT = False
+        else:
+            controller.update(self.cu)
+        # Snapshots from before are with the controller there was then
+        if self.history is not None:
+            self.history.clear()
+
+    # Run the events due by cycle, the cycles run so far if None, and raise INT for the
+    # requests they make
+    def service_events(self, cycle=None):
+        if self.history is not None:
+            self.history.record_events()
+        self.interrupts.run_events(self.cycles if cycle is None else cycle)
+        self.interrupts.update(self.cu)
+
+    # execute() is the engine's cycle, or wrappers around it when something is
+    # watching every cycle, so nothing is added to a cycle that is not asked for
+    # A hook has a wrap(execute) method that returns its own execute, which calls the one
+    # it was given once for each cycle, hooks added later are outermost
+    # A profiler runs the cycle itself, phase by phase, so takes the place of the engine's
+
+    def install_hooks(self):
+        execute = self.execute_cycle if self.profiler is None else self.profiler.execute
+        for hook in self.hooks:
+            execute = hook.wrap(execute)
+        self.execute = execute
+
+    def add_hook(self, hook):
+        self.hooks.append(hook)
+        self.install_hooks()
+
+    def remove_hook(self, hook):
+        self.hooks.remove(hook)
+        self.install_hooks()
+
+    # None takes the profiler off again
+    def set_profiler(self, profiler):
+        self.profiler = profiler
+        self.install_hooks()
+
+    def execute_hardwired(self):
+        self.cycles += 1
+        state = self.cu.state
+        self.state_cycles[state] += 1
+        if state == 18:
+            self.count_fetch()
+        self.cu.set_hardwired_signals()
         self.mem.clock_cycle(self.cu)
         self.cu.process_gating()
         self.cu.execute_logic()
@@ -820,14 +2688,680 @@ class LC3():
     
         self.cu.load_registers()
 
+    def execute_microcode(self):
+        self.cycles += 1
+        state = self.cu.state
+        self.state_cycles[state] += 1
+        if state == 18:
+            self.count_fetch()
+        self.cu.set_microcode_signals()
+        self.mem.clock_cycle(self.cu)
+        self.cu.process_gating()
+        self.cu.execute_logic()
+        self.cu.set_new_state()
+
+        self.cu.load_registers()
+
+    def execute_specialised(self):
+        self.cycles += 1
+        state = self.cu.state
+        self.state_cycles[state] += 1
+        if state == 18:
+            self.count_fetch()
+        self.state_functions[state](self.cu, self.mem)
+
+    # Fusion
+    # Runs from the state now until the machine enters state 18 again, or until limit
+    # cycles, in one call
+    # With a fixed latency each state's fused run (see fused_run()) is one call, as long as
+    # all of it fits in the limit
+    # Otherwise a state runs its own function, and a memory wait, where a state loops on
+    # itself until R, changes nothing but the access counters after its first cycle, so the
+    # rest of the wait up to the cycle the access finishes is added to the counters in one go
+    # Every cycle's work is done, so INT is still tested in state 18 and ACV where the
+    # state machine tests it, and the cycle counts and counters are those of a run
+    # one cycle at a time
+    # Returns the number of cycles run
+
+    def fused_runs_for(self, latency):
+        runs = self.fused_runs.get(latency)
+        if runs is None:
+            runs = self.fused_runs[latency] = build_fused_runs(self.control_store, latency)
+        return runs
+
+    def execute_fused(self, limit=None):
+        cu = self.cu
+        mem = self.mem
+        functions = self.state_functions
+        wait_states = self.wait_states
+        state_cycles = self.state_cycles
+        runs = None if mem.latency_model is not None else self.fused_runs_for(mem.clock_latency)
+        start = cycles = self.cycles
+        end = None if limit is None else start + limit
+        while True:
+            state = cu.state
+            if state == 18:
+                self.cycles = cycles + 1
+                self.count_fetch()
+            run = None if runs is None else runs[state]
+            if (run is not None and mem.clock_count == 0 and
+                    (end is None or cycles + run[1] <= end)):
+                cycles += run[0](cu, mem, state_cycles)
+            else:
+                cycles += 1
+                state_cycles[state] += 1
+                functions[state](cu, mem)
+                if wait_states[state] and cu.state == state:
+                    wait = mem.access_latency - mem.clock_count - 1
+                    if end is not None:
+                        wait = min(wait, end - cycles)
+                    if wait > 0:
+                        mem.clock_count += wait
+                        mem.wait_cycles += wait
+                        mem.state_wait_cycles[state] += wait
+                        state_cycles[state] += wait
+                        cycles += wait
+            if cu.state == 18 or cycles == end:
+                break
+        self.cycles = cycles
+        return cycles - start
+
+    # Performance counters
+    # Each cycle adds one to the count for its state, and each instruction is counted from
+    # the cycle it starts in state 18 to the next time the machine is in state 18, for the
+    # opcode in IR if it was decoded, everything else is worked out from those in counters()
+    # The instruction and block level paths count the path each instruction took, and the
+    # states, memory waits and accesses of the paths are added in by count_paths(), so the
+    # counters are those of a run one cycle at a time
+
+    def clear_counters(self):
+        self.state_cycles = [0] * CONTROL_STORE_SIZE
+        self.instructions = 0
+        self.opcode_instructions = [0] * 16
+        self.opcode_cycles = [0] * 16
+        # The instruction in progress, the cycle it started at and the decodes before it
+        self.instruction_start = None
+        self.instruction_decodes = 0
+        # Instructions run at the cycle table's latency, for each index of path_states
+        self.path_counts = [0] * PATH_INDEXES
+
+    # The paths counted at the cycle table's latency, into the state and memory counters
+    def count_paths(self):
+        counts = self.path_counts
+        if not any(counts):
+            return
+        latency = repeat(max(self.cycle_table_latency, 1))
+        for index, count in enumerate(counts):
+            if count:
+                self.count_path_states(self.path_states[index], latency, count)
+        self.path_counts = [0] * PATH_INDEXES
+
+    # The cycles for times instructions along the path states, with each access taking the
+    # next of latencies
+    def count_path_states(self, states, latencies, times=1):
+        state_cycles = self.state_cycles
+        mem = self.mem
+        for state, wait in states:
+            if wait:
+                cycles = next(latencies)
+                state_cycles[state] += times * cycles
+                mem.wait_cycles += times * (cycles - 1)
+                mem.state_wait_cycles[state] += times * (cycles - 1)
+                mem.accesses += times
+            else:
+                state_cycles[state] += times
+
+    # A cycle in state 18 starts the next instruction
+    def count_fetch(self):
+        self.count_instruction(self.cycles - 1)
+        self.instruction_start = self.cycles - 1
+        self.instruction_decodes = self.state_cycles[32]
+
+    # The instruction in progress finished at cycle end
+    # Taking an interrupt or an ACV on the fetch counts as an instruction, as in
+    # run_batch(), but has no opcode
+    def count_instruction(self, end):
+        if self.instruction_start is None:
+            return
+        self.instructions += 1
+        if self.state_cycles[32] != self.instruction_decodes:
+            opcode = self.cu.IR >> 12
+            self.opcode_instructions[opcode] += 1
+            self.opcode_cycles[opcode] += end - self.instruction_start
+        self.instruction_start = None
+
+    def counters(self):
+        self.count_paths()
+        # An instruction back in state 18 has finished, though the next has not started
+        if self.cu.state == 18:
+            self.count_instruction(self.cycles)
+        state_cycles = self.state_cycles
+        opcode_cpi = tuple(cycles / instructions if instructions else None
+                           for cycles, instructions in zip(self.opcode_cycles, self.opcode_instructions))
+        return PerfCounters(self.cycles, self.instructions, tuple(state_cycles),
+                            self.mem.wait_cycles, tuple(self.mem.state_wait_cycles),
+                            sum(state_cycles[state] for state in ACV_STATES), state_cycles[49],
+                            tuple(self.opcode_instructions), tuple(self.opcode_cycles),
+                            opcode_cpi)
+
+    # Instruction level execution
+    # Runs a whole instruction from state 18 back to state 18 in one step, with the
+    # same registers, memory, PC, NZP and MAR / MDR / IR / BEN / ACV latches as the state machine
+    # An instruction part way through the state machine is finished by the engine first,
+    # so runs can switch between the two at any point
+
+    def execute_instruction(self):
+        cu = self.cu
+        interrupts = self.interrupts
+        self.finish_instruction()
+        self.count_instruction(self.cycles)
+        if interrupts is not None and self.cycles >= interrupts.next_event:
+            self.service_events()
+
+        # Every cycle has to go through the hooks or profiler, so no shortcut while there are any
+        if self.execute != self.execute_cycle:
+            self.execute()
+            self.finish_instruction()
+            return
+
+        # The cycles the state machine would have taken, from the cost table for the way
+        # the instruction went
+        interrupt = cu.INT
+        start = cu.PC
+        psr = cu.PSR
+        start_cycles = self.cycles
+        if interrupt and interrupts is not None and self.cycles + 1 >= interrupts.next_event:
+            # Events due after state 18 can change the request state 49 takes
+            self.service_events(self.cycles + 1)
+        acv = self.instruction_datapath(cu, psr > 0x7fff, interrupt)
+        ir = cu.IR
+        mem = self.mem
+        # As cycle_index()
+        index = ((interrupt << 9) | ((ir >> 7) & 0x1e0) | (cu.BEN << 4) | ((ir >> 8) & 8) |
+                 ((psr >> 13) & 4) | acv)
+        if mem.latency_model is None:
+            if mem.clock_latency != self.cycle_table_latency:
+                self.update_cycle_table()
+            self.cycles += self.cycle_table[index]
+            self.path_counts[index | ((cu.PSR >> 5) & 0x400)] += 1
+        else:
+            cost = self.cost_table[(interrupt, ir >> 12, cu.BEN, (ir >> 11) & 1, psr > 0x7fff, acv)]
+            latencies = self.access_latencies(start, cost.accesses, interrupt)
+            self.cycles += cost.cycles + sum(latencies)
+            self.count_path_states(self.path_states[index | ((cu.PSR >> 5) & 0x400)], iter(latencies))
+        self.instructions += 1
+        if not interrupt and acv != 1:
+            self.opcode_instructions[ir >> 12] += 1
+            self.opcode_cycles[ir >> 12] += self.cycles - start_cycles
+        # Running a cycle at a time would have run the events due before the last cycle
+        if interrupts is not None and self.cycles > interrupts.next_event:
+            self.service_events(self.cycles - 1)
+
+    # Runs the engine to the end of an instruction part way through the state machine,
+    # with events run between cycles as run_batch() does
+
+    def finish_instruction(self):
+        cu = self.cu
+        interrupts = self.interrupts
+        while cu.state != 18:
+            if interrupts is not None and self.cycles >= interrupts.next_event:
+                self.service_events()
+            self.execute()
+
+    # What an instruction does, or taking the interrupt for interrupt, returns the ACV
+    # test that found a violation, as in COST_INPUTS, or 0 for none
+
+    def instruction_datapath(self, cu, user, interrupt):
+        memory = self.mem.view
+        regs = cu.regs
+        # 18: MAR <- PC, PC <- PC + 1, set ACV, |INT|
+        address = cu.MAR = cu.PC
+        cu.PC = pc = cu.PC + 1
+        cu.ACV = user and (address >= 0xfe00 or address < 0x3000)
+        if interrupt:
+            # 49 on, instead of the instruction
+            cu.acknowledge_interrupt()
+            self.exception_datapath(cu, cu.INTV, cu.INT_PRIORITY)
+            return 0
+        if cu.ACV:
+            return 1                                        # 33 -> 60
+
+        # 28, 30: MDR <- M, IR <- MDR
+        cu.MDR = cu.IR = memory[address]
+        inst = cu.INST = self.mem.icache.lookup(address, cu.IR)
+        opcode = inst.opcode
+        dr = inst.dr
+        sr1 = inst.sr1
+
+        # 32: BEN <- (IR[11] & N) + (IR[10] & Z) + (IR[9] & P), |IR[15:12]|
+        cu.BEN = (inst.nzp & ((cu.N << 2) | (cu.Z << 1) | cu.P)) != 0
+
+        value = None
+        if opcode == 0b0000:                                # BR
+            if cu.BEN:
+                cu.PC = (pc + inst.offset9) & 0xffff
+        elif opcode in (0b0001, 0b0101, 0b1001):            # ADD, AND, NOT
+            a = regs[sr1]
+            b = inst.imm5 if inst.imm else regs[inst.sr2]
+            if opcode == 0b0001:
+                value = (a + b) & 0xffff
+            elif opcode == 0b0101:
+                value = a & b
+            else:
+                value = (~a) & 0xffff
+        elif opcode in (0b0010, 0b0110, 0b1010):            # LD, LDR, LDI
+            if opcode == 0b0110:
+                address = (regs[sr1] + inst.offset6) & 0xffff
+            else:
+                address = (pc + inst.offset9) & 0xffff
+            cu.MAR = address
+            cu.ACV = user and (address >= 0xfe00 or address < 0x3000)
+            if cu.ACV:
+                return 2                                    # 35 / 17 -> 57 / 56
+            if opcode == 0b1010:
+                address = cu.MAR = cu.MDR = memory[address]
+                cu.ACV = user and (address >= 0xfe00 or address < 0x3000)
+                if cu.ACV:
+                    return 3                                # 35 -> 57
+            value = cu.MDR = memory[address]
+        elif opcode in (0b0011, 0b0111, 0b1011):            # ST, STR, STI
+            if opcode == 0b0111:
+                address = (regs[sr1] + inst.offset6) & 0xffff
+            else:
+                address = (pc + inst.offset9) & 0xffff
+            cu.MAR = address
+            cu.ACV = user and (address >= 0xfe00 or address < 0x3000)
+            if opcode == 0b1011:
+                if cu.ACV:
+                    return 2                                # 19 -> 61
+                address = cu.MAR = cu.MDR = memory[address]
+                cu.ACV = user and (address >= 0xfe00 or address < 0x3000)
+            cu.MDR = regs[dr]
+            if cu.ACV:
+                return 3 if opcode == 0b1011 else 2         # 23 -> 48
+            self.mem.write(address, cu.MDR)
+        elif opcode == 0b0100:                              # JSR, JSRR
+            if inst.ir11:
+                cu.PC = (pc + inst.offset11) & 0xffff
+            else:
+                cu.PC = regs[sr1]
+            regs[7] = pc
+        elif opcode == 0b1100:                              # JMP
+            cu.PC = regs[sr1]
+        elif opcode == 0b1110:                              # LEA
+            regs[dr] = (pc + inst.offset9) & 0xffff
+        elif opcode == 0b1000:                              # RTI
+            # 8: MAR <- SP, |PSR[15]|
+            sp = cu.MAR = regs[6]
+            if user:
+                # 44 on: privilege mode exception
+                self.exception_datapath(cu, 0x00)
+                return 0
+            # 36, 38: MDR <- M, PC <- MDR
+            cu.PC = memory[sp]
+            # 39, 40: MAR, SP <- SP + 1, MDR <- M
+            sp = cu.MAR = (sp + 1) & 0xffff
+            psr = cu.MDR = memory[sp]
+            # 42: PSR <- MDR
+            cu.PSR = (cu.PSR & 0x78ff) | (psr & 0x8700)
+            cu.N = (psr & 4) != 0
+            cu.Z = (psr & 2) != 0
+            cu.P = (psr & 1) != 0
+            if cu.interrupt_controller is not None:
+                cu.interrupt_controller.update(cu)
+            # 34: SP <- SP + 1, |PSR[15]|
+            regs[6] = (sp + 1) & 0xffff
+            if psr & 0x8000:
+                # 59: Saved_SSP <- SP, SP <- Saved_USP
+                cu.SAVED_SSP = regs[6]
+                regs[6] = cu.SAVED_USP
+        # TRAP and the reserved opcode are NOPs
+
+        if value is not None:
+            regs[dr] = value
+            cu.Z = (value == 0)
+            cu.P = (value > 0 and value <= 0x7fff)
+            cu.N = (value > 0x7fff)
+        return 0
+
+    # 49 / 44 on: push PSR and PC - 1 on the supervisor stack, switching to it from user
+    # mode, then go to the handler in the vector table
+    # priority is the interrupt's, an exception leaves PSR[10:8] as it is
+
+    def exception_datapath(self, cu, vector, priority=None):
+        regs = cu.regs
+        psr = cu.PSR
+        # 49 / 44: MDR <- PSR, PSR[15] <- 0, PSR[10:8] <- priority, Vector <- vector
+        cu.MDR = psr | (cu.N << 2) | (cu.Z << 1) | cu.P
+        cu.VECTOR = vector
+        cu.PSR = psr & 0x7fff
+        if priority is not None:
+            cu.PSR = (cu.PSR & 0xf8ff) | (priority << 8)
+            if cu.interrupt_controller is not None:
+                cu.interrupt_controller.update(cu)
+        if psr & 0x8000:
+            # 45: Saved_USP <- SP, SP <- Saved_SSP
+            cu.SAVED_USP = regs[6]
+            regs[6] = cu.SAVED_SSP
+        # 37, 41: MAR, SP <- SP - 1, M[MAR] <- MDR
+        sp = cu.MAR = regs[6] = (regs[6] - 1) & 0xffff
+        self.mem.write(sp, cu.MDR)
+        # 43, 47, 52: MDR <- PC - 1, MAR, SP <- SP - 1, M[MAR] <- MDR
+        cu.MDR = (cu.PC - 1) & 0xffff
+        sp = cu.MAR = regs[6] = (sp - 1) & 0xffff
+        self.mem.write(sp, cu.MDR)
+        # 54, 53, 55: MAR <- x01'Vector, MDR <- M, PC <- MDR
+        cu.MAR = 0x0100 | vector
+        cu.MDR = cu.PC = self.mem.view[cu.MAR]
+
+    # Cycles for each of the first accesses memory accesses of the instruction just run from
+    # start, with the latency model, each access taking the latency of its address
+    # The accesses are the fetch, the pointer of LDI / STI, then the load or store at MAR,
+    # or for RTI the two pops, and for an interrupt or exception the two pushes onto the
+    # stack, now at SP, then the read of the vector table at MAR
+
+    def access_latencies(self, start, accesses, interrupt):
+        cu = self.cu
+        model = self.mem.latency_model
+        opcode = cu.IR >> 12
+        sp = cu.regs[6]
+        pushes = [((sp + 1) & 0xffff, MemRW.WR), (sp, MemRW.WR), (cu.MAR, MemRW.RD)]
+        if interrupt:
+            return [max(model.latency(address, rw), 1) for address, rw in pushes[:accesses]]
+        addresses = [(start, MemRW.RD)]
+        if opcode == 0b1000:
+            if accesses > 3:
+                addresses += pushes
+            else:
+                addresses += [((cu.MAR - 1) & 0xffff, MemRW.RD), (cu.MAR, MemRW.RD)]
+        elif opcode in (0b1010, 0b1011):
+            addresses.append(((start + 1 + sign_extend(cu.IR, 9)) & 0xffff, MemRW.RD))
+        if opcode in (0b0010, 0b0110, 0b1010):
+            addresses.append((cu.MAR, MemRW.RD))
+        elif opcode in (0b0011, 0b0111, 0b1011):
+            addresses.append((cu.MAR, MemRW.WR))
+        return [max(model.latency(address, rw), 1) for address, rw in addresses[:accesses]]
+
+    # Block level execution
+    # Runs a whole basic block of instructions from the PC in one step, translating it the
+    # first time, returns how many instructions it ran
+    # limit is the most instructions to run, a block that loops goes round while there is
+    # room, and a block longer than limit runs one instruction instead
+    # Interrupts are taken by execute_instruction(), and a block only runs the instructions
+    # sure to finish by the next event, so INT is raised at the same instruction as it is
+    # running a cycle at a time
+
+    def execute_block(self, limit=None):
+        cu = self.cu
+        interrupts = self.interrupts
+        self.finish_instruction()
+        self.count_instruction(self.cycles)
+        # A latency model needs the address of each access, which a block does not keep
+        if self.execute != self.execute_cycle or self.mem.latency_model is not None or cu.INT:
+            self.execute_instruction()
+            return 1
+        if interrupts is not None:
+            if self.cycles >= interrupts.next_event:
+                self.execute_instruction()
+                return 1
+            if self.mem.clock_latency != self.cycle_table_latency:
+                self.update_cycle_table()
+            room = (interrupts.next_event - self.cycles) // self.max_instruction_cycles
+            if room == 0:
+                self.execute_instruction()
+                return 1
+            limit = room if limit is None else min(limit, room)
+
+        key = cu.PC | ((cu.PSR & 0x8000) << 1)
+        block = self.blocks.get(key)
+        if block is not None and limit is not None and len(block.opcodes) > limit:
+            self.execute_instruction()
+            return 1
+        view = self.mem.view
+        count = 0
+        if block is not None:
+            count = block.run(cu, cu.regs, view, self.mem.write, limit or len(block.opcodes))
+        if count == 0:
+            block = translate_block(view, cu.PC, check_bit(cu.PSR, 15))
+            if block is None:
+                self.execute_instruction()
+                return 1
+            self.blocks[key] = block
+            if limit is not None and len(block.opcodes) > limit:
+                self.execute_instruction()
+                return 1
+            count = block.run(cu, cu.regs, view, self.mem.write, limit or len(block.opcodes))
+
+        self.count_block(key, block, count)
+        return count
+
+    # The cycles the state machine would have taken for count instructions of a block,
+    # from the cost table as in execute_instruction(), added to the cycles and the counts
+    # for each opcode and path
+    # Every instruction but the last went without an ACV and took the branch closing a
+    # loop, so costs the same each time round
+
+    def count_block(self, key, block, count):
+        cu = self.cu
+        if self.mem.clock_latency != self.cycle_table_latency:
+            self.update_cycle_table()
+        table = self.cycle_table
+        user = key >> 16
+        costs = self.block_costs.get(key)
+        if costs is None or costs[0] is not block or costs[1] != self.cycle_table_latency:
+            # Path index and cycles for each instruction of the block, and cycles for the
+            # first n, for each n
+            indexes = [cycle_index(False, word >> 12, True, (word >> 11) & 1, user, 0)
+                       for word in block.words]
+            steps = [table[index] for index in indexes]
+            prefix = [0]
+            for step in steps:
+                prefix.append(prefix[-1] + step)
+            indexes = [index | (user << 10) for index in indexes]
+            costs = self.block_costs[key] = (block, self.cycle_table_latency, prefix, steps, indexes)
+        prefix, steps, indexes = costs[2:]
+        words = block.words
+        opcodes = block.opcodes
+        opcode_instructions = self.opcode_instructions
+        opcode_cycles = self.opcode_cycles
+        path_counts = self.path_counts
+        # A loop can go round many times, and leave part way round
+        times, rest = divmod(count, len(words))
+        cycles = times * prefix[-1] + prefix[rest]
+        if times:
+            for opcode, step, index in zip(opcodes, steps, indexes):
+                opcode_instructions[opcode] += times
+                opcode_cycles[opcode] += times * step
+                path_counts[index] += times
+        for opcode, step, index in zip(opcodes[:rest], steps, indexes):
+            opcode_instructions[opcode] += 1
+            opcode_cycles[opcode] += step
+            path_counts[index] += 1
+
+        # The last instruction as it went, an ACV is in the second test unless an LDI / STI
+        # pointer was fine
+        last = (count - 1) % len(words)
+        word = words[last]
+        acv = 0
+        if cu.ACV:
+            acv = 2
+            if word >> 12 in (0b1010, 0b1011):
+                pointer = (block.start + last + 1 + sign_extend(word, 9)) & 0xffff
+                if not protected_address(pointer):
+                    acv = 3
+        index = cycle_index(False, word >> 12, cu.BEN, (word >> 11) & 1, user, acv)
+        change = table[index] - steps[last]
+        opcode_cycles[opcodes[last]] += change
+        path_counts[indexes[last]] -= 1
+        path_counts[index | (user << 10)] += 1
+        self.cycles += cycles + change
+        self.instructions += count
+
+    def run_blocks(self, instructions):
+        count = 0
+        while count < instructions:
+            count += self.execute_block(instructions - count)
+        return count
+
+    # Batch running
+    # An instruction is counted each time the machine enters state 18, and is a fault
+    # if ACV is set then (an access violation stopped it)
+    # Breakpoints and the halt test are checked on entering state 18, so a run started
+    # on a breakpoint does not stop there straight away
+    # Interrupt events are run between cycles once they are due, the fused engine runs
+    # uninterrupted up to the next one
+
+    def run_batch(self, cycles=None, instructions=None, until=None, stop_on_halt=True):
+        cu = self.cu
+        execute = self.execute
+        breakpoints = self.breakpoints
+        start_cycles = self.cycles
+        end_cycles = NO_EVENT if cycles is None else start_cycles + cycles
+        next_event = NO_EVENT if self.interrupts is None else self.interrupts.next_event
+        count = 0
+        faults = 0
+        reason = "cycles"
+
+        # Fusion needs no one to see the cycles in between, so is off with hooks, a
+        # profiler or an until test, breakpoints are only looked at in state 18
+        fused = self.engine == "fused" and until is None and execute == self.execute_cycle
+
+        while self.cycles < end_cycles:
+            if self.cycles >= next_event:
+                self.service_events()
+                next_event = self.interrupts.next_event
+            if fused:
+                self.execute_fused(min(end_cycles, next_event) - self.cycles)
+            else:
+                execute()
+            if until is not None and until(self):
+                reason = "until"
+                break
+            if cu.state == 18:
+                count += 1
+                if cu.ACV:
+                    faults += 1
+                if count == instructions:
+                    reason = "instructions"
+                    break
+                if cu.PC in breakpoints:
+                    reason = "breakpoint"
+                    break
+                if stop_on_halt and self.halted():
+                    reason = "halt"
+                    break
+        return RunSummary(self.cycles - start_cycles, count, faults, reason)
+
+    def run(self, cycles, stop_on_halt=True):
+        return self.run_batch(cycles=cycles, stop_on_halt=stop_on_halt)
+
+    def run_instructions(self, instructions, stop_on_halt=True):
+        return self.run_batch(instructions=instructions, stop_on_halt=stop_on_halt)
+
+    def run_until(self, predicate, cycles=None, stop_on_halt=True):
+        return self.run_batch(cycles=cycles, until=predicate, stop_on_halt=stop_on_halt)
+
+    # The spin: br spin idiom - a branch to itself that is taken never changes anything again,
+    # unless an interrupt is coming
+
+    def halted(self):
+        cu = self.cu
+        pc = cu.PC
+        if cu.INT or pc >= self.mem.memory_max:
+            return False
+        if self.interrupts is not None and self.interrupts.next_event != NO_EVENT:
+            return False
+        if check_bit(cu.PSR, 15) and (pc >= 0xfe00 or pc < 0x3000):
+            return False
+        word = self.mem.view[pc]
+        if (word & 0xf1ff) != 0x01ff:
+            return False
+        return ((word >> 9) & ((cu.N << 2) | (cu.Z << 1) | cu.P)) != 0
+
+    # Load an object image and start running it at its origin
+
+    def load_image(self, filename):
+        origin, length = self.mem.load_image(filename)
+        self.cu.PC = origin
+        self.cu.state = 18
+        return origin, length
+
+    # Snapshots can be restored any number of times, and into any LC3, so a run can be
+    # forked from a checkpoint or wound back
+    # Engine, latency settings and breakpoints are not part of a snapshot
+
+    def snapshot(self):
+        # Memory's counters are in the snapshot, so the paths are counted into them first
+        self.count_paths()
+        interrupts = None if self.interrupts is None else self.interrupts.snapshot()
+        return Snapshot(self.cu.snapshot(), self.mem.snapshot(), self.cycles, interrupts)
+
+    # A snapshot with interrupt state goes into a machine with a controller with the same
+    # devices, and one without into a machine without
+    def restore(self, snapshot):
+        if (snapshot.interrupts is None) != (self.interrupts is None):
+            raise ValueError("Snapshot and machine do not both have an interrupt controller")
+        if self.interrupts is not None:
+            self.interrupts.restore(snapshot.interrupts)
+        self.count_paths()
+        self.cu.restore(snapshot.cu)
+        self.mem.restore(snapshot.mem)
+        self.cycles = snapshot.cycles
+        # The counters carry on, but not for an instruction started before the restore
+        self.instruction_start = None
+        if self.history is not None:
+            self.history.clear()
+
+    # Reverse execution
+    # record_history() keeps an undo journal from here on, see History
+
+    def record_history(self, length=10000, snapshot_interval=1000, snapshots=100):
+        self.stop_history()
+        self.history = History(self, length, snapshot_interval, snapshots)
+        self.add_hook(self.history)
+
+    def stop_history(self):
+        if self.history is not None:
+            self.remove_hook(self.history)
+            self.history = None
+
+    # Go back n cycles, returns how many it went back, which is less when the
+    # history does not go back that far
+
+    def step_back(self, cycles=1):
+        if self.history is None:
+            raise ValueError("No history, call record_history() first")
+        start = self.cycles
+        self.history.go_back_to(max(start - cycles, self.history.earliest()))
+        return start - self.cycles
+
+    # Go back until a register (0 to 7) or memory address changes, stopping just before
+    # the cycle that changed it, returns False if the history ran out first
+
+    def step_back_until_changed(self, register=None, address=None):
+        cu = self.cu
+        memory = self.mem.view
+        def watched():
+            return (None if register is None else cu.regs[register],
+                    None if address is None else memory[address])
+        value = watched()
+        while self.step_back(1):
+            if watched() != value:
+                return True
+        return False
+
+    def architectural_state(self):
+        cu = self.cu
+        return ArchitecturalState(tuple(cu.regs), cu.PC, cu.N, cu.Z, cu.P, array("H", self.mem.memory))
+
     def extract_state_table(self):
         state_matrix = {}
         for i in range(36):
             self.cu.state = i
             self.cu.clear_control_signals()
+            self.cu.clear_state_signals()
             self.cu.set_control_signals()
             config = self.cu.get_state()
             state_matrix[i] = config.bits   
-            log(0, f"{config.bits:056b}")        
-
-
+            log(0, f"{config.bits:056b}")
+        return state_matrix
@@ -0,0 +1,200 @@
+# LC3 benchmark - times the engines on a few small workloads and saves the results as JSON
+
+# python LC3Bench.py [--engines ...] [--latency ...] [--instructions N]
+#                    [--output results.json] [--compare old.json]
+#
+# Each workload is a hand assembled program that loops for ever, and is run for the same
+# number of instructions with every engine and memory latency, so the results can be
+# compared between runs and between commits
+# Engines are hardwired, microcode, specialised and fused (the state machine) and fast
+# (execute_instruction)
+
+import argparse
+import json
+import platform
+import subprocess
+import time
+from collections import namedtuple
+
+import LC3 as lc3
+from LC3 import LC3, InterruptController, Timer, TIMER_VECTOR, set_log_level
+
+# timers - (interval, priority, vector, handler) for each Timer, interrupting every interval
+# cycles, with its vector going to the handler address
+Workload = namedtuple("Workload", ["name", "origin", "words", "timers"])
+
+WORKLOADS = [
+    # Tight count down loop, as lbl3 in the test program
+    Workload("loop", 0x3000, [
+        0b0101_011_011_1_00000,         # again   and r3, r3, #0
+        0b0001_011_011_1_01111,         #         add r3, r3, #15
+        0b0001_011_011_1_11111,         # lbl3    add r3, r3, #-1
+        0b0000_001_111111110,           #         brp lbl3
+        0b0000_111_111111011,           #         br  again
+    ], []),
+
+    # Copy 8 words from src to dst, again and again
+    Workload("copy", 0x3000, [
+        0b1110_000_000001111,           # again   lea r0, src
+        0b1110_001_000011110,           #         lea r1, dst
+        0b0101_010_010_1_00000,         #         and r2, r2, #0
+        0b0001_010_010_1_01000,         #         add r2, r2, #8
+        0b0110_011_000_000000,          # next    ldr r3, r0, #0
+        0b0111_011_001_000000,          #         str r3, r1, #0
+        0b0001_000_000_1_00001,         #         add r0, r0, #1
+        0b0001_001_001_1_00001,         #         add r1, r1, #1
+        0b0001_010_010_1_11111,         #         add r2, r2, #-1
+        0b0000_001_111111010,           #         brp next
+        0b0000_111_111110101,           #         br  again
+        0, 0, 0, 0, 0,
+        0x1111, 0x2222, 0x3333, 0x4444,  # src
+        0x5555, 0x6666, 0x7777, 0x8888,
+    ], []),
+
+    # Read and write through pointers, LDI and STI each take two memory accesses
+    Workload("indirect", 0x3000, [
+        0b1010_000_000001111,           # again   ldi r0, pa
+        0b0001_000_000_1_00001,         #         add r0, r0, #1
+        0b1011_000_000001110,           #         sti r0, pb
+        0b1010_001_000001101,           #         ldi r1, pb
+        0b1011_001_000001011,           #         sti r1, pa
+        0b0000_111_111111010,           #         br  again
+        0, 0, 0, 0, 0, 0, 0, 0, 0, 0,
+        0x3020,                         # pa      .fill a
+        0x3021,                         # pb      .fill b
+    ], []),
+
+    # Subroutine calls
+    Workload("calls", 0x3000, [
+        0b0100_1_00000000011,           # again   jsr sub
+        0b0100_1_00000000010,           #         jsr sub
+        0b0000_111_111111101,           #         br  again
+        0,
+        0b0001_000_000_1_00001,         # sub     add r0, r0, #1
+        0b1100_000_111_000000,          #         ret
+    ], []),
+
+    # Interrupt storm - the count down loop under three timers at priorities 4 to 6, each
+    # handler counting its ticks, so a higher priority tick interrupts a lower one's handler
+    # Taking, handling and returning from interrupts is over half the instructions at
+    # latency 1, and nearly all of them at latency 3
+    Workload("storm", 0x3000, [
+        0b0101_011_011_1_00000,         # again   and r3, r3, #0
+        0b0001_011_011_1_01111,         #         add r3, r3, #15
+        0b0001_011_011_1_11111,         # lbl3    add r3, r3, #-1
+        0b0000_001_111111110,           #         brp lbl3
+        0b0000_111_111111011,           #         br  again
+        0, 0, 0,
+        0b0001_100_100_1_00001,         # tick4   add r4, r4, #1
+        0b1000_000000000000,            #         rti
+        0b0001_101_101_1_00001,         # tick5   add r5, r5, #1
+        0b1000_000000000000,            #         rti
+        0b0001_010_010_1_00001,         # tick6   add r2, r2, #1
+        0b1000_000000000000,            #         rti
+    ], [(100, 4, TIMER_VECTOR, 0x3008), (140, 5, TIMER_VECTOR + 1, 0x300a),
+        (190, 6, TIMER_VECTOR + 2, 0x300c)]),
+]
+
+ENGINES = ["hardwired", "microcode", "specialised", "fused", "fast"]
+LATENCIES = [1, 3]
+
+def load_workload(lc, workload):
+    lc.mem.memory[workload.origin:workload.origin + len(workload.words)] = workload.words
+    lc.cu.PC = workload.origin
+    if workload.timers:
+        lc.set_interrupts(InterruptController())
+        for interval, priority, vector, handler in workload.timers:
+            lc.mem.memory[0x0100 + vector] = handler
+            lc.interrupts.add_device(Timer(interval, priority, vector), lc.cycles)
+
+def run_workload(workload, engine, latency, instructions):
+    lc = LC3()
+    # Latency first, so the fused engine builds its runs for it here and not in the timed run
+    lc.mem.set_latency(latency)
+    if engine != "fast":
+        lc.set_engine(engine)
+    load_workload(lc, workload)
+
+    start = time.perf_counter()
+    if engine == "fast":
+        for _ in range(instructions):
+            lc.execute_instruction()
+    else:
+        lc.run_instructions(instructions, stop_on_halt=False)
+    seconds = time.perf_counter() - start
+
+    # Fast mode counts the cycles from the cost table
+    cycles = lc.cycles
+    return {
+        "workload": workload.name,
+        "engine": engine,
+        "latency": latency,
+        "instructions": instructions,
+        "cycles": cycles,
+        "seconds": seconds,
+        "cycles_per_second": cycles / seconds if cycles else None,
+        "instructions_per_second": instructions / seconds,
+    }
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run_benchmarks(engines=ENGINES, latencies=LATENCIES, instructions=2000, workloads=WORKLOADS):
+    saved_log_level = lc3.log_level
+    set_log_level(0)
+    try:
+        results = [run_workload(workload, engine, latency, instructions)
+                   for workload in workloads for engine in engines for latency in latencies]
+    finally:
+        set_log_level(saved_log_level)
+    return {
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "results": results,
+    }
+
+def result_key(result):
+    return (result["workload"], result["engine"], result["latency"])
+
+def print_results(benchmarks, baseline=None):
+    previous = {}
+    if baseline is not None:
+        previous = {result_key(result): result for result in baseline["results"]}
+    print(f"{'workload':12}{'engine':11}{'latency':>8}{'cycles/s':>12}{'instr/s':>12}")
+    for result in benchmarks["results"]:
+        cycles_per_second = result["cycles_per_second"]
+        cycles_per_second = "-" if cycles_per_second is None else f"{cycles_per_second:.0f}"
+        line = (f"{result['workload']:12}{result['engine']:11}{result['latency']:8}"
+                f"{cycles_per_second:>12}{result['instructions_per_second']:12.0f}")
+        old = previous.get(result_key(result))
+        if old is not None:
+            change = result["instructions_per_second"] / old["instructions_per_second"] - 1
+            line += f"{change:+9.1%}"
+        print(line)
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the LC3 engines")
+    parser.add_argument("--engines", nargs="+", default=ENGINES, choices=ENGINES)
+    parser.add_argument("--latency", nargs="+", type=int, default=LATENCIES)
+    parser.add_argument("--instructions", type=int, default=2000)
+    parser.add_argument("--output", help="save the results to this JSON file")
+    parser.add_argument("--compare", help="show the change from the results in this JSON file")
+    args = parser.parse_args()
+
+    benchmarks = run_benchmarks(args.engines, args.latency, args.instructions)
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    print_results(benchmarks, baseline)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(benchmarks, f, indent=2)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+# LC3 batch runner - runs many short programs across a pool of processes
+
+# Each job is (image, regs, cycles)
+#   image  - an object image filename, or a list of (origin, words) segments
+#            the program starts at the origin of the first segment
+#   regs   - the 8 starting registers, or None for all 0
+#   cycles - the most cycles to run for, the job also stops at a spin: br spin halt
+#
+# Each worker process keeps one LC3 and resets it between jobs, with logging off
+# Results come back from the workers as plain tuples and are made into JobResults here
+
+import os
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+
+import LC3 as lc3
+from LC3 import LC3, set_log_level
+
+Job = namedtuple("Job", ["image", "regs", "cycles"])
+
+JobResult = namedtuple("JobResult", ["regs", "PC", "N", "Z", "P",
+                                     "cycles", "instructions", "faults", "reason"])
+
+REASONS = ["cycles", "instructions", "breakpoint", "halt", "until"]
+
+# The machine for this process, made by start_worker()
+
+worker_lc = None
+
+def start_worker(engine="microcode", latency=None):
+    global worker_lc
+    set_log_level(0)
+    worker_lc = LC3()
+    worker_lc.set_engine(engine)
+    if latency is not None:
+        worker_lc.mem.set_latency(latency)
+
+def run_job(job):
+    lc = worker_lc
+    image, regs, cycles = job
+    lc.reset()
+    if isinstance(image, str):
+        lc.load_image(image)
+    else:
+        for origin, words in image:
+            lc.mem.memory[origin:origin + len(words)] = words
+        lc.cu.PC = image[0][0]
+    if regs is not None:
+        lc.cu.regs = list(regs)
+
+    summary = lc.run(cycles)
+    cu = lc.cu
+    nzp = (cu.N << 2) | (cu.Z << 1) | cu.P
+    return (tuple(cu.regs), cu.PC, nzp, summary.cycles, summary.instructions,
+            summary.faults, REASONS.index(summary.reason))
+
+def job_result(packed):
+    regs, pc, nzp, cycles, instructions, faults, reason = packed
+    return JobResult(list(regs), pc, (nzp & 4) != 0, (nzp & 2) != 0, (nzp & 1) != 0,
+                     cycles, instructions, faults, REASONS[reason])
+
+# workers = 0 runs the jobs in this process, which is easier to debug
+
+def run_jobs(jobs, workers=None, engine="microcode", latency=None, chunksize=None):
+    jobs = [Job(*job) for job in jobs]
+    if workers == 0:
+        saved_log_level = lc3.log_level
+        start_worker(engine, latency)
+        try:
+            return [job_result(run_job(job)) for job in jobs]
+        finally:
+            set_log_level(saved_log_level)
+
+    if workers is None:
+        workers = os.cpu_count() or 1
+    if chunksize is None:
+        chunksize = max(1, len(jobs) // (workers * 4))
+    with ProcessPoolExecutor(max_workers=workers, initializer=start_worker,
+                             initargs=(engine, latency)) as executor:
+        return [job_result(packed) for packed in executor.map(run_job, jobs, chunksize=chunksize)]
@@ -0,0 +1,249 @@
+# LC3 profiling - where the emulator spends its time, and where the program it runs does
+
+# PhaseProfiler times each phase of every cycle with perf_counter_ns and adds the times up
+# for each state, the phases being those of LC3.execute_hardwired() / execute_microcode()
+#   signals     set_hardwired_signals() or set_microcode_signals()
+#   memory      Memory.clock_cycle()
+#   gating      process_gating()
+#   logic       execute_logic()
+#   next_state  set_new_state()
+#   load        load_registers()
+# The specialised and fused engines run each cycle as one generated function for its
+# state, which does every phase, so their cycles are timed as the one phase "state"
+#
+# It runs each cycle itself in place of the engine, so a machine with no profiler set
+# runs the engine's execute with nothing in between
+#
+#   profiler = PhaseProfiler(lc)
+#   lc.set_profiler(profiler)
+#   lc.run(10000)
+#   lc.set_profiler(None)
+#   profiler.save_folded("lc3.folded")      # for flamegraph.pl or speedscope
+
+from collections import namedtuple
+from time import perf_counter_ns
+
+from LC3 import BLOCK_END_OPCODES, CONTROL_STORE_SIZE
+
+PHASES = ["signals", "memory", "gating", "logic", "next_state", "load"]
+STATE_PHASE = "state"
+ALL_PHASES = PHASES + [STATE_PHASE]
+STATE_INDEX = len(PHASES)
+GENERATED_ENGINES = ("specialised", "fused")
+
+class PhaseProfiler():
+    def __init__(self, lc):
+        self.lc = lc
+        self.clear()
+
+    def clear(self):
+        # Nanoseconds in each phase, for each state
+        self.state_times = [[0] * len(ALL_PHASES) for _ in range(CONTROL_STORE_SIZE)]
+        self.state_cycles = [0] * CONTROL_STORE_SIZE
+
+    # One cycle, as the engine runs it, with the time taken by each phase
+    def execute(self):
+        lc = self.lc
+        cu = lc.cu
+        lc.cycles += 1
+        state = cu.state
+        lc.state_cycles[state] += 1
+        if state == 18:
+            lc.count_fetch()
+
+        if lc.engine in GENERATED_ENGINES:
+            t0 = perf_counter_ns()
+            lc.state_functions[state](cu, lc.mem)
+            self.state_times[state][STATE_INDEX] += perf_counter_ns() - t0
+            self.state_cycles[state] += 1
+            return
+
+        t0 = perf_counter_ns()
+        if lc.engine == "microcode":
+            cu.set_microcode_signals()
+        else:
+            cu.set_hardwired_signals()
+        t1 = perf_counter_ns()
+        lc.mem.clock_cycle(cu)
+        t2 = perf_counter_ns()
+        cu.process_gating()
+        t3 = perf_counter_ns()
+        cu.execute_logic()
+        t4 = perf_counter_ns()
+        cu.set_new_state()
+        t5 = perf_counter_ns()
+        cu.load_registers()
+        t6 = perf_counter_ns()
+
+        times = self.state_times[state]
+        times[0] += t1 - t0
+        times[1] += t2 - t1
+        times[2] += t3 - t2
+        times[3] += t4 - t3
+        times[4] += t5 - t4
+        times[5] += t6 - t5
+        self.state_cycles[state] += 1
+
+    # Total nanoseconds for each phase that took any time, over every state
+    def phase_times(self):
+        totals = {phase: sum(times[i] for times in self.state_times)
+                  for i, phase in enumerate(ALL_PHASES)}
+        return {phase: total for phase, total in totals.items() if total}
+
+    # Folded stacks, one line for each state and phase that took any time:
+    #   execute;state 18;memory 12345
+    # with the time in nanoseconds
+
+    def folded_stacks(self):
+        lines = []
+        for state, times in enumerate(self.state_times):
+            for phase, time in zip(ALL_PHASES, times):
+                if time:
+                    lines.append(f"execute;state {state};{phase} {time}")
+        return lines
+
+    def save_folded(self, filename):
+        with open(filename, "w") as f:
+            for line in self.folded_stacks():
+                f.write(line + "\n")
+
+
+# GuestProfiler counts every instruction fetched (state 18) by its address, and gives every
+# cycle to the instruction it is part of, in two dense 64K counter lists
+# Calls are followed through JSR / JSRR (states 20 and 21) and RET, which is JMP R7 (state 12),
+# for a call graph and the cycles spent in each subroutine
+#
+# It is a hook, so runs around the engine's execute
+#
+#   profiler = GuestProfiler(lc)
+#   lc.add_hook(profiler)
+#   lc.run(10000)
+#   lc.remove_hook(profiler)
+#   profiler.hot_addresses(10)
+
+HotAddress = namedtuple("HotAddress", ["address", "fetches", "cycles"])
+BasicBlock = namedtuple("BasicBlock", ["start", "end", "executions", "cycles"])
+
+# self_cycles are the cycles in the subroutine itself, total_cycles include the ones it calls
+Subroutine = namedtuple("Subroutine", ["address", "calls", "self_cycles", "total_cycles"])
+
+CALL_STATES = (20, 21)
+JMP_STATE = 12
+TRANSFER_STATES = frozenset(CALL_STATES + (JMP_STATE,))
+
+class GuestProfiler():
+    def __init__(self, lc):
+        self.lc = lc
+        self.cu = lc.cu
+        self.fetches = [0] * 0x10000
+        self.cycles = [0] * 0x10000
+
+        # Addresses reached other than from the address before, where basic blocks start
+        self.leaders = set()
+        self.address = -2
+
+        # Subroutines by address, the program being run is the one at the PC now
+        self.function = lc.cu.PC
+        self.function_start = lc.cycles
+        self.stack = []
+        self.calls = {}
+        self.call_edges = {}
+        self.self_cycles = {}
+        self.total_cycles = {}
+
+    def wrap(self, execute):
+        self.execute_inner = execute
+        return self.execute
+
+    def execute(self):
+        cu = self.cu
+        state = cu.state
+        if state == 18:
+            pc = cu.PC
+            if pc != self.address + 1:
+                self.leaders.add(pc)
+            self.address = pc
+            self.fetches[pc] += 1
+
+        self.execute_inner()
+
+        self.cycles[self.address] += 1
+        if state in TRANSFER_STATES:
+            self.transfer(state)
+
+    def transfer(self, state):
+        cu = self.cu
+        cycles = self.lc.cycles
+        if state in CALL_STATES:
+            callee = cu.PC
+            self.end_function(cycles)
+            self.stack.append((self.function, cycles))
+            self.calls[callee] = self.calls.get(callee, 0) + 1
+            edge = (self.function, callee)
+            self.call_edges[edge] = self.call_edges.get(edge, 0) + 1
+            self.function = callee
+        elif (cu.IR >> 6) & 0x7 == 7 and self.stack:
+            # RET - the cycles from the call to here go to the subroutine returning
+            self.end_function(cycles)
+            caller, called = self.stack.pop()
+            self.total_cycles[self.function] = self.total_cycles.get(self.function, 0) + cycles - called
+            self.function = caller
+
+    # Give the cycles since the last call or return to the subroutine running
+    def end_function(self, cycles):
+        self.self_cycles[self.function] = self.self_cycles.get(self.function, 0) + cycles - self.function_start
+        self.function_start = cycles
+
+    def hot_addresses(self, count=10):
+        cycles = self.cycles
+        addresses = sorted((address for address in range(0x10000) if cycles[address]),
+                           key=lambda address: -cycles[address])
+        return [HotAddress(address, self.fetches[address], cycles[address])
+                for address in addresses[:count]]
+
+    # Blocks of instructions run one after the other, each entered only at its start
+    # The instructions are read from memory as it is now
+
+    def basic_blocks(self):
+        fetches = self.fetches
+        memory = self.lc.mem.view
+        blocks = []
+        start = None
+        for address in range(0x10000):
+            if start is not None and (not fetches[address] or address in self.leaders or
+                                      fetches[address] != fetches[start]):
+                blocks.append(self.block(start, address - 1))
+                start = None
+            if fetches[address]:
+                if start is None:
+                    start = address
+                if memory[address] >> 12 in BLOCK_END_OPCODES:
+                    blocks.append(self.block(start, address))
+                    start = None
+        if start is not None:
+            blocks.append(self.block(start, 0xffff))
+        return sorted(blocks, key=lambda block: -block.cycles)
+
+    def block(self, start, end):
+        return BasicBlock(start, end, self.fetches[start], sum(self.cycles[start:end + 1]))
+
+    # The program being run and every subroutine called, hottest first
+    # A subroutine still running has its cycles up to now
+
+    def subroutines(self):
+        cycles = self.lc.cycles
+        self_cycles = dict(self.self_cycles)
+        total_cycles = dict(self.total_cycles)
+        self_cycles[self.function] = self_cycles.get(self.function, 0) + cycles - self.function_start
+        for function, (caller, called) in zip([f for f, _ in self.stack[1:]] + [self.function], self.stack):
+            total_cycles[function] = total_cycles.get(function, 0) + cycles - called
+        root = self.stack[0][0] if self.stack else self.function
+        total_cycles[root] = sum(self_cycles.values())
+        functions = set(self_cycles) | set(self.calls)
+        return sorted((Subroutine(function, self.calls.get(function, 0), self_cycles.get(function, 0),
+                                  total_cycles.get(function, 0)) for function in functions),
+                      key=lambda subroutine: -subroutine.self_cycles)
+
+    # Calls between subroutines, as {(caller, callee): calls}
+    def call_graph(self):
+        return dict(self.call_edges)
@@ -14,16 +14,20 @@ def check(cond):
 set_log_level(0)
 
 print( "Test:   Extract state table")
-lc.extract_state_table()
+state_table = lc.extract_state_table()
 print("-" * 50)
 
 print("Test: Interrupt")
 lc.cu.INT = True 
 lc.mem.memory[0x3000] = 0b0000_0000_0000_0001
-# only 2 instructions to get to INT handler (state 49)
+# only 2 instructions to get to INT handler (state 49), which goes on to the
+# supervisor stack from user mode (state 45)
 run_times(2)       
 print(f"Result: got to state {lc.cu.state:d}")
-check(lc.cu.state == 33)
+check(lc.cu.state == 45)
+check(lc.cu.INT == False and lc.cu.PSR == 0)
+# Back to user mode for the tests after
+lc.cu.PSR = 0b1000_0000_0000_0000
 print("-" * 50)
 
 print( "Test:   LDI R2, R1, 0x003")
@@ -206,11 +210,7 @@ print( "Test:   test program")
 # This part can read the output from https://wchargin.com/lc3web/
 
 """
-f = open("lc3.bin", "rb")
-mem = list(f.read())
-# LC3 is big endian words
-m2 = [(a << 8) | b for a, b in zip(mem[0::2], mem[1::2])]
-address = m2.pop(0)
+address, length = lc.mem.load_image("lc3.bin")
 
 """
 # Or just have the list of words
@@ -244,3 +244,1008 @@ print(f'PC {lc.cu.PC:4x}')
 check(match_regs == 8)
 print("-" * 50)
 
+
+def machine_state(machine):
+    cu = machine.cu
+    return (cu.state, cu.PC, cu.IR, cu.MAR, cu.MDR, cu.bus, cu.BEN, cu.ACV,
+            cu.N, cu.Z, cu.P, cu.INT, tuple(cu.regs))
+
+def load_test_program(machine):
+    machine.mem.memory[address:address + len(m2)] = m2
+    machine.cu.regs = [0x0000, 0x0000, 0x0000, 0x0000, 0x0000, 0x0000, 0x0000, 0x0000]
+    machine.cu.PC = address
+    machine.cu.state = 18
+
+print( "Test:   microcode engine matches hardwired engine every cycle")
+hardwired = LC3()
+microcode = LC3()
+microcode.set_engine("microcode")
+load_test_program(hardwired)
+load_test_program(microcode)
+match_cycles = 0
+for _ in range(440):
+    hardwired.execute()
+    microcode.execute()
+    if (machine_state(hardwired) == machine_state(microcode) and
+            hardwired.mem.memory == microcode.mem.memory):
+        match_cycles += 1
+print(f"Result: {match_cycles} of 440 cycles match")
+check(match_cycles == 440)
+print("-" * 50)
+
+print( "Test:   microcode engine with INT")
+hardwired.cu.INT = True
+microcode.cu.INT = True
+for _ in range(3):
+    hardwired.execute()
+    microcode.execute()
+print(f"Result: got to state {microcode.cu.state:d}")
+check(machine_state(hardwired) == machine_state(microcode))
+print("-" * 50)
+
+print( "Test:   save and load control store")
+import os
+import tempfile
+from LC3 import build_control_store, save_control_store, load_control_store
+words = build_control_store()
+with tempfile.TemporaryDirectory() as directory:
+    filename = os.path.join(directory, "lc3.ucode")
+    save_control_store(filename, words)
+    loaded = load_control_store(filename)
+print(f"Result: {len(loaded)} words loaded")
+check(loaded == words)
+check(all(state_table[state] == words[state] for state in state_table))
+print("-" * 50)
+
+print( "Test:   log calls compiled out below the log level")
+import io
+from contextlib import redirect_stdout
+from LC3 import ControlUnit
+check("log" not in ControlUnit.execute_logic.__code__.co_names)
+logging_lc = LC3()
+load_test_program(logging_lc)
+output = io.StringIO()
+with redirect_stdout(output):
+    set_log_level(3)
+    for _ in range(7):
+        logging_lc.execute()
+    set_log_level(0)
+print(f"Result: {len(output.getvalue().splitlines())} lines logged at level 3")
+check("Loading IR 0xe031 from bus" in output.getvalue())
+check("IR <- MDR" in output.getvalue())
+check("MAR <- PC, PC <- PC + 1, set ACV, |INT|" in output.getvalue())
+check("log" not in ControlUnit.execute_logic.__code__.co_names)
+check(logging_lc.cu.state == 14)
+print("-" * 50)
+
+# Everything the instruction level execution keeps up to date (not the bus)
+
+def latch_state(machine):
+    cu = machine.cu
+    return (cu.state, cu.PC, cu.IR, cu.MAR, cu.MDR, cu.BEN, cu.ACV,
+            cu.N, cu.Z, cu.P, cu.INT, tuple(cu.regs))
+
+def run_instructions_cycle_accurate(machine, instructions):
+    for _ in range(instructions):
+        machine.execute()
+        while machine.cu.state != 18:
+            machine.execute()
+
+print( "Test:   instruction level execution matches state machine")
+cycle_lc = LC3()
+fast_lc = LC3()
+load_test_program(cycle_lc)
+load_test_program(fast_lc)
+match_instructions = 0
+for _ in range(60):
+    run_instructions_cycle_accurate(cycle_lc, 1)
+    fast_lc.execute_instruction()
+    if (cycle_lc.architectural_state() == fast_lc.architectural_state() and
+            latch_state(cycle_lc) == latch_state(fast_lc)):
+        match_instructions += 1
+print(f"Result: {match_instructions} of 60 instructions match")
+check(match_instructions == 60)
+check(fast_lc.architectural_state().regs == tuple(expected_regs))
+print("-" * 50)
+
+print( "Test:   switch between instruction level and state machine")
+cycle_lc = LC3()
+mixed_lc = LC3()
+load_test_program(cycle_lc)
+load_test_program(mixed_lc)
+instructions = 0
+for _ in range(10):
+    mixed_lc.execute_instruction()
+    instructions += 1
+# Stop part way through an instruction, execute_instruction() finishes it first
+for _ in range(103):
+    mixed_lc.execute()
+    if mixed_lc.cu.state == 18:
+        instructions += 1
+if mixed_lc.cu.state != 18:
+    instructions += 1
+for _ in range(20):
+    mixed_lc.execute_instruction()
+    instructions += 1
+run_instructions_cycle_accurate(cycle_lc, instructions)
+print(f"Result: PC 0x{mixed_lc.cu.PC:04x}")
+check(cycle_lc.architectural_state() == mixed_lc.architectural_state())
+# Each instruction's cycles go to its own opcode, and its path's to each state and memory
+# wait, whichever way it ran
+def instruction_counts(machine):
+    return machine.counters()
+check(instruction_counts(cycle_lc) == instruction_counts(mixed_lc))
+print("-" * 50)
+
+print( "Test:   instruction level ACV and INT")
+for word, interrupt in [(0b0010_010_1_1111_1100, False), (0b1011_101_1_1111_0000, False),
+                        (0b0001_001_011_1_00111, True)]:
+    cycle_lc = LC3()
+    fast_lc = LC3()
+    for machine in (cycle_lc, fast_lc):
+        machine.cu.regs = [0x0003, 0x0030, 0x0300, 0x3000, 0x0005, 0x0050, 0x0500, 0x5000]
+        machine.mem.memory[0x3000] = word
+        machine.cu.INT = interrupt
+    run_instructions_cycle_accurate(cycle_lc, 1)
+    fast_lc.execute_instruction()
+    print(f"Result: ACV {fast_lc.cu.ACV} PC 0x{fast_lc.cu.PC:04x}")
+    check(cycle_lc.architectural_state() == fast_lc.architectural_state() and
+          latch_state(cycle_lc) == latch_state(fast_lc))
+    check(instruction_counts(cycle_lc) == instruction_counts(fast_lc))
+print("-" * 50)
+
+print( "Test:   decoded instruction cache with self modifying code")
+smc = [0x14a1,      # add r2, r2, #1   - replaced by the st below
+       0x2202,      # ld  r1, new
+       0x33fd,      # st  r1, 0x3000
+       0x0ffc,      # br  0x3000
+       0x14a5]      # new: add r2, r2, #5
+cycle_lc = LC3()
+fast_lc = LC3()
+for machine in (cycle_lc, fast_lc):
+    machine.mem.memory[0x3000:0x3000 + len(smc)] = smc
+run_instructions_cycle_accurate(cycle_lc, 3)
+for _ in range(3):
+    fast_lc.execute_instruction()
+check(0x3000 not in fast_lc.mem.icache.decoded)
+check(0x3000 not in cycle_lc.mem.icache.decoded)
+run_instructions_cycle_accurate(cycle_lc, 2)
+for _ in range(2):
+    fast_lc.execute_instruction()
+print(f"Result: 0x{cycle_lc.cu.regs[2]:04x} 0x{fast_lc.cu.regs[2]:04x} in R2")
+check(cycle_lc.cu.regs[2] == 0x0006 and fast_lc.cu.regs[2] == 0x0006)
+check(fast_lc.mem.icache.decoded[0x3000].imm5 == 5)
+print("-" * 50)
+
+# sign_extend and zero_extend as they were first written, to check the faster versions
+
+def reference_sign_extend(value, number_bits):
+    top_mask    = (0xffff << number_bits) & 0xffff
+    bottom_mask = (~top_mask) & 0xffff
+    new_value = value & bottom_mask
+    if value & (1 << (number_bits - 1)) != 0:
+        new_value = new_value | top_mask
+    return new_value
+
+def reference_zero_extend(value, number_bits):
+    top_mask    = (0xffff << number_bits) & 0xffff
+    bottom_mask = (~top_mask) & 0xffff
+    return value & bottom_mask
+
+print( "Test:   sign_extend and zero_extend for every word")
+from LC3 import sign_extend, zero_extend, bit_field
+widths = [5, 6, 8, 9, 11]
+match_widths = 0
+for width in widths:
+    if (all(sign_extend(value, width) == reference_sign_extend(value, width) for value in range(0x10000)) and
+            all(zero_extend(value, width) == reference_zero_extend(value, width) for value in range(0x10000))):
+        match_widths += 1
+print(f"Result: {match_widths} of {len(widths)} widths match")
+check(match_widths == len(widths))
+check(bit_field(0b1010_010_001_000011, 11, 9) == 0b010)
+print("-" * 50)
+
+print( "Test:   vectorised sign_extend and zero_extend for every word")
+try:
+    import numpy
+except ImportError:
+    numpy = None
+if numpy is None:
+    print("Result: numpy not installed, skipped")
+else:
+    from LC3 import (sign_extend_array, zero_extend_array, decode_instruction_array,
+                     decode_instruction)
+    values = numpy.arange(0x10000)
+    match_widths = 0
+    for width in widths:
+        if (sign_extend_array(values, width).tolist() == [reference_sign_extend(value, width) for value in range(0x10000)] and
+                zero_extend_array(values, width).tolist() == [reference_zero_extend(value, width) for value in range(0x10000)]):
+            match_widths += 1
+    print(f"Result: {match_widths} of {len(widths)} widths match")
+    check(match_widths == len(widths))
+    fields = decode_instruction_array(m2)
+    check(all(tuple(fields[name][i].item() for name in fields) == tuple(decode_instruction(word))
+              for i, word in enumerate(m2)))
+print("-" * 50)
+
+print( "Test:   LD from 0xc000 in full 64K memory")
+big_lc = LC3()
+big_lc.cu.regs = [0x0003, 0xc000, 0x03ff, 0x0707, 0x0005, 0x0050, 0x0500, 0x5000]
+big_lc.mem.memory[0x3000] = 0b0110_010_001_00_0011       # ldr r2, r1, #3
+big_lc.mem.view[0xc003] = 0x1234
+run_instructions_cycle_accurate(big_lc, 1)
+print(f"Result: 0x{big_lc.cu.regs[2]:04x} in R2")
+check(big_lc.cu.regs[2] == 0x1234)
+check(len(big_lc.mem.memory) == 0x10000 and big_lc.mem.memory[0xc003] == 0x1234)
+check(big_lc.mem.view[0x3000:0x3001].tolist() == [0b0110_010_001_00_0011])
+print("-" * 50)
+
+print( "Test:   instruction level matches state machine for random programs")
+import random
+random.seed(3)
+match_programs = 0
+for _ in range(200):
+    program = [random.randrange(0x10000) for _ in range(8)]
+    registers = [random.choice([0x3000 + random.randrange(0x20), random.randrange(0x10000)]) for _ in range(8)]
+    cycle_lc = LC3()
+    fast_lc = LC3()
+    for machine in (cycle_lc, fast_lc):
+        machine.mem.memory[0x3000:0x3008] = program
+        machine.cu.regs = list(registers)
+    run_instructions_cycle_accurate(cycle_lc, 8)
+    for _ in range(8):
+        fast_lc.execute_instruction()
+    if (cycle_lc.architectural_state() == fast_lc.architectural_state() and
+            latch_state(cycle_lc) == latch_state(fast_lc) and
+            instruction_counts(cycle_lc) == instruction_counts(fast_lc)):
+        match_programs += 1
+print(f"Result: {match_programs} of 200 programs match")
+check(match_programs == 200)
+print("-" * 50)
+
+print( "Test:   save and load object images")
+with tempfile.TemporaryDirectory() as directory:
+    program_file = os.path.join(directory, "program.obj")
+    data_file = os.path.join(directory, "data.obj")
+    core_file = os.path.join(directory, "core.bin")
+    load_test_program(lc)
+    lc.mem.save_image(program_file, address, 0x30)
+    lc.mem.save_image(data_file, address + 0x30, 4)
+    with open(program_file, "rb") as f:
+        check(f.read(4) == bytes([0x30, 0x00, 0xe0, 0x31]))
+    image_lc = LC3()
+    segments = image_lc.mem.load_images([program_file, data_file])
+    image_lc.load_image(program_file)
+    for _ in range(440):
+        image_lc.execute()
+    print(f"Result: segments {[(hex(origin), length) for origin, length in segments]}")
+    check(segments == [(0x3000, 0x30), (0x3030, 4)])
+    check(image_lc.cu.regs == expected_regs)
+    image_lc.mem.save_image(core_file)
+    core_lc = LC3()
+    core_lc.mem.load_image(core_file)
+    check(core_lc.mem.memory == image_lc.mem.memory)
+print("-" * 50)
+
+print( "Test:   memory latency only changes cycle counts")
+from LC3 import device_latency
+latency_results = {}
+for latency in [0, 1, 3, 5]:
+    latency_lc = LC3()
+    latency_lc.mem.set_latency(latency)
+    load_test_program(latency_lc)
+    run_instructions_cycle_accurate(latency_lc, 60)
+    latency_results[latency] = (latency_lc.architectural_state(), latency_lc.cycles,
+                                latency_lc.mem.accesses, latency_lc.mem.wait_cycles)
+    print(f"Result: latency {latency} took {latency_lc.cycles} cycles, {latency_lc.mem.wait_cycles} waiting")
+accesses = latency_results[1][2]
+check(all(result[0] == latency_results[3][0] and result[2] == accesses for result in latency_results.values()))
+check(latency_results[0][1] == latency_results[1][1] and latency_results[1][3] == 0)
+check(latency_results[3][1] - latency_results[1][1] == 2 * accesses == latency_results[3][3])
+print("-" * 50)
+
+print( "Test:   device region latency")
+device_lc = LC3()
+device_lc.mem.set_latency(device_latency(3, 10))
+device_lc.cu.PSR = 0x0000                           # supervisor, so no ACV
+device_lc.cu.regs = [0x0003, 0xfe00, 0x03ff, 0x0707, 0x0005, 0x0050, 0x0500, 0x5000]
+device_lc.mem.memory[0x3000] = 0b0110_010_001_00_0000     # ldr r2, r1, #0
+device_lc.mem.memory[0xfe00] = 0x8000
+run_instructions_cycle_accurate(device_lc, 1)
+print(f"Result: {device_lc.cycles} cycles, {device_lc.mem.wait_cycles} waiting")
+check(device_lc.cu.regs[2] == 0x8000)
+check(device_lc.mem.wait_cycles == 2 + 9)
+print("-" * 50)
+
+print( "Test:   batch runs")
+batch_lc = LC3()
+load_test_program(batch_lc)
+summary = batch_lc.run(1000)
+print(f"Result: {summary}")
+check(summary.reason == "halt" and batch_lc.cu.PC == 0x301a and batch_lc.cu.regs == expected_regs)
+check(summary.cycles == batch_lc.cycles and summary.faults == 0)
+load_test_program(batch_lc)
+summary = batch_lc.run_instructions(10)
+check(summary.reason == "instructions" and summary.instructions == 10 and batch_lc.cu.state == 18)
+summary = batch_lc.run(5, stop_on_halt=False)
+check(summary.reason == "cycles" and summary.cycles == 5)
+batch_lc.breakpoints.add(0x301d)
+summary = batch_lc.run(1000)
+print(f"Result: {summary}")
+check(summary.reason == "breakpoint" and batch_lc.cu.PC == 0x301d)
+summary = batch_lc.run_until(lambda machine: machine.cu.regs[0] == 0x4323, 1000)
+print(f"Result: {summary}")
+check(summary.reason == "until" and batch_lc.cu.regs[0] == 0x4323)
+load_test_program(batch_lc)
+batch_lc.mem.memory[0x3000] = 0b0010_010_1_1111_1100      # ld r2 with ACV
+summary = batch_lc.run_instructions(1)
+check(summary.faults == 1)
+print("-" * 50)
+
+print( "Test:   packed control word")
+from LC3 import ALUK, MemRW, encode_microinstruction
+packed_lc = LC3()
+cu = packed_lc.cu
+cu.clear_control_signals()
+cu.LD_MAR = True
+cu.ALUK = ALUK.ADD
+cu.RW = MemRW.WR
+cu.J = 35
+print(f"Result: control word 0x{cu.control:014x}")
+check(cu.control == encode_microinstruction({"LD_MAR": True, "ALUK": ALUK.ADD, "RW": MemRW.WR,
+                                             "J": 35, "SET_PRIV": 1}))
+check(cu.LD_MAR is True and cu.LD_MDR is False and cu.ALUK == ALUK.ADD and cu.J == 35)
+check(cu.signals.RW == MemRW.WR and not hasattr(cu, "__dict__"))
+check(type(cu.ALUK) is ALUK and type(cu.RW) is MemRW and type(cu.LD_MAR) is bool)
+cu.clear_control_signals()
+check(cu.ALUK == ALUK.PASSA and not cu.LD_MAR and cu.J == 0)
+from LC3 import COND, HARDWIRED_CONTROL_STORE
+cu.state = 25
+cu.set_hardwired_signals()
+check(cu.control == HARDWIRED_CONTROL_STORE[25] and cu.LD_MDR and cu.COND == COND.MEMORY_READY)
+print("-" * 50)
+
+print( "Test:   batch runner across a process pool")
+from LC3Pool import run_jobs
+pool_jobs = []
+for i in range(12):
+    registers = [i, 0, 0, 0, 0, 0, 0, 0]
+    pool_jobs.append(([(address, m2)], registers, 1000))
+pool_jobs.append(([(0x3000, [0b0010_010_1_1111_1100, 0x0fff])], None, 100))   # ld with ACV, then spin
+serial_results = run_jobs(pool_jobs, workers=0)
+if __name__ == "__main__":
+    pool_results = run_jobs(pool_jobs, workers=2)
+else:
+    pool_results = serial_results
+print(f"Result: {pool_results[0]}")
+check(pool_results == serial_results)
+check(all(result.regs == expected_regs and result.reason == "halt" for result in pool_results[:12]))
+check(pool_results[12].faults == 1 and pool_results[12].reason == "cycles")
+print("-" * 50)
+
+print( "Test:   lockstep vector engine matches independent machines every cycle")
+if numpy is None:
+    print("Result: numpy not installed, skipped")
+else:
+    from LC3Vector import LC3Vector
+    random.seed(5)
+    lane_machines = []
+    vector_lc = LC3Vector(8, latency=device_latency(2, 5))
+    for i in range(8):
+        if i < 4:
+            program = m2
+            registers = [i] * 8
+        else:
+            program = [random.randrange(0x10000) for _ in range(8)]
+            registers = [0x3000 + random.randrange(0x20) for _ in range(8)]
+        machine = LC3()
+        machine.set_engine("microcode")
+        machine.mem.set_latency(device_latency(2, 5))
+        machine.mem.memory[address:address + len(program)] = program
+        machine.cu.regs = list(registers)
+        vector_lc.load(address, program, [i])
+        vector_lc.regs[i] = registers
+        lane_machines.append(machine)
+    lane_machines[1].cu.INT = True
+    vector_lc.INT[1] = True
+    match_cycles = 0
+    for _ in range(440):
+        vector_lc.step()
+        for machine in lane_machines:
+            machine.execute()
+        if all(machine.cu.state == vector_lc.state[i] and
+               machine.architectural_state() == vector_lc.architectural_state(i)
+               for i, machine in enumerate(lane_machines)):
+            match_cycles += 1
+    print(f"Result: {match_cycles} of 440 cycles match")
+    check(match_cycles == 440)
+    check(vector_lc.regs[0].tolist() == expected_regs)
+print("-" * 50)
+
+print( "Test:   snapshot and restore")
+snapshot_lc = LC3()
+load_test_program(snapshot_lc)
+snapshot_lc.mem.set_latency(2)
+snapshot_lc.run(41, stop_on_halt=False)
+checkpoint = snapshot_lc.snapshot()
+first_state = machine_state(snapshot_lc)
+snapshot_lc.run(300)
+end_state = (machine_state(snapshot_lc), snapshot_lc.architectural_state(), snapshot_lc.cycles)
+later = snapshot_lc.snapshot()
+copied_pages = sum(page is not checkpoint_page for page, checkpoint_page in zip(later.mem.pages, checkpoint.mem.pages))
+check(copied_pages <= 1 and snapshot_lc.snapshot().mem.pages is later.mem.pages)
+snapshot_lc.restore(checkpoint)
+check(machine_state(snapshot_lc) == first_state and snapshot_lc.cycles == 41)
+snapshot_lc.run(300)
+check((machine_state(snapshot_lc), snapshot_lc.architectural_state(), snapshot_lc.cycles) == end_state)
+fork_lc = LC3()
+fork_lc.mem.set_latency(2)
+fork_lc.mem.memory[0x4000] = 0xffff
+fork_lc.restore(checkpoint)
+fork_lc.run(300)
+print(f"Result: {copied_pages} page copied, forked run ends at cycle {fork_lc.cycles}")
+check((machine_state(fork_lc), fork_lc.architectural_state(), fork_lc.cycles) == end_state)
+# Writes through the memoryview are in snapshots and undone by restore too, once marked
+view_lc = LC3()
+before_view_write = view_lc.snapshot()
+view_lc.mem.view[0x4000] = 0x1234
+view_lc.mem.mark_written(0x4000, 1)
+after_view_write = view_lc.snapshot()
+check(sum(page is not before_page for page, before_page
+          in zip(after_view_write.mem.pages, before_view_write.mem.pages)) == 1)
+view_fork_lc = LC3()
+view_fork_lc.restore(after_view_write)
+check(view_fork_lc.mem.memory[0x4000] == 0x1234)
+view_lc.restore(before_view_write)
+check(view_lc.mem.memory[0x4000] == 0)
+print("-" * 50)
+
+print( "Test:   step back through the undo history")
+history_lc = LC3()
+reference_lc = LC3()
+load_test_program(history_lc)
+load_test_program(reference_lc)
+history_lc.record_history(length=50, snapshot_interval=64, snapshots=8)
+reference_states = [machine_state(reference_lc)]
+for _ in range(440):
+    reference_lc.execute()
+    reference_states.append(machine_state(reference_lc))
+history_lc.run(440, stop_on_halt=False)
+match_steps = 0
+for cycles in (1, 7, 30, 100, 3):
+    history_lc.step_back(cycles)
+    if machine_state(history_lc) == reference_states[history_lc.cycles]:
+        match_steps += 1
+print(f"Result: {match_steps} of 5 steps back match, now at cycle {history_lc.cycles}")
+check(match_steps == 5 and history_lc.cycles == 299)
+# Each entry holds only what its cycle loads, and undoing them one at a time matches too
+from LC3 import HISTORY_ALWAYS
+check(all(len(entry[0]) <= len(HISTORY_ALWAYS) + 6 for entry in history_lc.history.journal))
+single_steps = 0
+for _ in range(40):
+    history_lc.step_back()
+    single_steps += machine_state(history_lc) == reference_states[history_lc.cycles]
+check(single_steps == 40 and history_lc.cycles == 259)
+history_lc.run(181, stop_on_halt=False)
+check(history_lc.cycles == 440 and history_lc.cu.regs == expected_regs)
+check(history_lc.step_back_until_changed(register=0))
+check(history_lc.cu.regs[0] == 0x4322 and history_lc.mem.memory == reference_lc.mem.memory)
+history_lc.execute()
+check(history_lc.cu.regs[0] == 0x4323)
+check(history_lc.step_back_until_changed(address=0x3032))
+check(history_lc.mem.memory[0x3032] == 0xabcd and history_lc.cycles < 100)
+history_lc.stop_history()
+check(history_lc.execute == history_lc.execute_cycle)
+print("-" * 50)
+
+print( "Test:   binary trace of every cycle")
+from array import array
+from LC3Trace import (TraceWriter, read_trace, read_trace_array,
+                      TRACE_REG_WRITE, TRACE_MEM_READ, TRACE_MEM_WRITE)
+with tempfile.TemporaryDirectory() as directory:
+    trace_lc = LC3()
+    load_test_program(trace_lc)
+    trace_memory = array("H", trace_lc.mem.memory)
+    trace_file = os.path.join(directory, "program.trace")
+    with TraceWriter(trace_lc, trace_file):
+        trace_lc.run(440, stop_on_halt=False)
+    check(trace_lc.execute == trace_lc.execute_cycle)
+    records = list(read_trace(trace_file))
+    print(f"Result: {len(records)} records, {os.path.getsize(trace_file)} bytes")
+    check(len(records) == 440 and records[-1].cycle == 440 and records[-1].PC == trace_lc.cu.PC)
+    check(records[0].state == 18 and records[0].next_state == records[1].state)
+    trace_regs = [0] * 8
+    reads = 0
+    for record in records:
+        if record.flags & TRACE_REG_WRITE:
+            trace_regs[record.reg] = record.reg_value
+        if record.flags & TRACE_MEM_WRITE:
+            trace_memory[record.mem_address] = record.mem_value
+        if record.flags & TRACE_MEM_READ:
+            reads += 1
+    check(trace_regs == expected_regs and trace_memory == trace_lc.mem.memory)
+    check(reads == trace_lc.mem.accesses - sum(record.flags & TRACE_MEM_WRITE != 0 for record in records))
+
+    compressed_file = os.path.join(directory, "program.trace.gz")
+    trace_lc.reset()
+    load_test_program(trace_lc)
+    with TraceWriter(trace_lc, compressed_file, compression="gzip"):
+        trace_lc.run(440, stop_on_halt=False)
+    compressed_records = list(read_trace(compressed_file))
+    check(compressed_records == records)
+    if numpy is not None:
+        trace_array = read_trace_array(compressed_file)
+        check(len(trace_array) == 440 and trace_array["PC"][-1] == records[-1].PC and
+              int((trace_array["flags"] & TRACE_REG_WRITE != 0).sum()) ==
+              sum(record.flags & TRACE_REG_WRITE != 0 for record in records))
+print("-" * 50)
+
+print( "Test:   performance counters")
+counter_lc = LC3()
+counter_lc.set_engine("microcode")
+load_test_program(counter_lc)
+counter_summary = counter_lc.run(1000)
+counters = counter_lc.counters()
+print(f"Result: {counters.instructions} instructions in {counters.cycles} cycles, "
+      f"{counters.memory_wait_cycles} waiting for memory, ADD CPI {counters.opcode_cpi[0b0001]:.2f}")
+check(counters.cycles == counter_summary.cycles == sum(counters.state_cycles))
+check(counters.instructions == counter_summary.instructions)
+check(counters.memory_wait_cycles == counter_lc.mem.wait_cycles == sum(counters.state_wait_cycles))
+check({state for state in range(64) if counters.state_wait_cycles[state]} == {16, 24, 25, 28, 29})
+check(counters.opcode_cpi[0b0101] == 8.0 and counters.opcode_cpi[0b1000] is None)
+check(sum(counters.opcode_cycles) == counters.cycles and counters.instructions == sum(counters.opcode_instructions))
+check(counters.acv == 0 and counters.interrupts == 0)
+counter_lc.reset()
+counter_lc.mem.memory[0x3000:0x3002] = [0b0010_010_1_1111_1100, 0x0fff]     # ld with ACV, then spin
+counter_lc.mem.memory[0x0100] = 0x3001                                      # handler is the spin
+counter_lc.run_instructions(1)
+counter_lc.cu.INT = True
+counter_lc.run(100)
+counters = counter_lc.counters()
+check(counters.acv == 1 and counters.interrupts == 1 and counters.state_cycles[57] == 1)
+print("-" * 50)
+
+print( "Test:   benchmark workloads give the same results with every engine")
+import json
+from LC3Bench import WORKLOADS, load_workload, run_benchmarks
+match_workloads = 0
+for workload in WORKLOADS:
+    workload_states = []
+    for engine in ["hardwired", "microcode", "fast"]:
+        bench_lc = LC3()
+        bench_lc.set_engine("microcode" if engine == "fast" else engine)
+        load_workload(bench_lc, workload)
+        for _ in range(100):
+            if engine == "fast":
+                bench_lc.execute_instruction()
+            else:
+                bench_lc.run_instructions(1, stop_on_halt=False)
+        workload_states.append((bench_lc.architectural_state(), bench_lc.cycles))
+    if workload_states[0] == workload_states[1] == workload_states[2]:
+        match_workloads += 1
+benchmarks = json.loads(json.dumps(run_benchmarks(["microcode", "fast"], [3], 50)))
+print(f"Result: {match_workloads} of {len(WORKLOADS)} workloads match")
+check(match_workloads == len(WORKLOADS))
+check(len(benchmarks["results"]) == 2 * len(WORKLOADS))
+check(all(result["cycles"] > 0 for result in benchmarks["results"]))
+# Taking, handling and returning from interrupts is most of the storm
+storm_lc = LC3()
+load_workload(storm_lc, next(workload for workload in WORKLOADS if workload.name == "storm"))
+storm_lc.run_instructions(2000, stop_on_halt=False)
+storm_counters = storm_lc.counters()
+check(3 * storm_counters.interrupts > storm_counters.instructions / 2)
+check(storm_lc.cu.regs[2] > 0 and storm_lc.cu.regs[4] > 0 and storm_lc.cu.regs[5] > 0)
+print("-" * 50)
+
+print( "Test:   per phase profiler")
+from LC3Profile import PhaseProfiler, PHASES, STATE_PHASE
+match_engines = 0
+profilers = {}
+for engine in ["hardwired", "microcode", "specialised", "fused"]:
+    profiled_lc = LC3()
+    plain_lc = LC3()
+    profiled_lc.set_engine(engine)
+    plain_lc.set_engine(engine)
+    load_test_program(profiled_lc)
+    load_test_program(plain_lc)
+    profiler = profilers[engine] = PhaseProfiler(profiled_lc)
+    profiled_lc.set_profiler(profiler)
+    profiled_lc.run(440)
+    plain_lc.run(440)
+    profiled_lc.set_profiler(None)
+    if (machine_state(profiled_lc) == machine_state(plain_lc) and
+            profiled_lc.counters() == plain_lc.counters() and
+            profiler.state_cycles == list(plain_lc.counters().state_cycles)):
+        match_engines += 1
+stacks = profilers["microcode"].folded_stacks()
+print(f"Result: {match_engines} of 4 engines match, {len(stacks)} stacks, {stacks[0]}")
+check(match_engines == 4)
+check(profiled_lc.execute == profiled_lc.execute_cycle)
+check(all(line.startswith("execute;state ") and int(line.split()[-1]) > 0 for line in stacks))
+check(set(profilers["microcode"].phase_times()) == set(PHASES))
+# The generated engines' state functions are timed whole
+check(set(profilers["fused"].phase_times()) == {STATE_PHASE})
+print("-" * 50)
+
+print( "Test:   guest program profiler")
+from LC3Profile import GuestProfiler
+guest_lc = LC3()
+load_test_program(guest_lc)
+guest_profiler = GuestProfiler(guest_lc)
+guest_lc.add_hook(guest_profiler)
+guest_summary = guest_lc.run(1000)
+guest_lc.remove_hook(guest_profiler)
+hot = guest_profiler.hot_addresses(2)
+blocks = guest_profiler.basic_blocks()
+subroutines = {subroutine.address: subroutine for subroutine in guest_profiler.subroutines()}
+print(f"Result: hottest 0x{hot[0].address:04x} {hot[0].fetches} fetches {hot[0].cycles} cycles, "
+      f"{len(blocks)} blocks, {len(subroutines)} subroutines")
+check(sum(guest_profiler.cycles) == guest_summary.cycles and sum(guest_profiler.fetches) == guest_summary.instructions)
+check([address for address, _, _ in hot] == [0x3016, 0x3015])             # lbl3 loop
+check((blocks[0].start, blocks[0].end, blocks[0].executions) == (0x3015, 0x3016, 9))
+check(guest_profiler.call_graph() == {(0x3000, 0x301b): 1, (0x3000, 0x301d): 1})
+check(subroutines[0x301b].calls == 1 and subroutines[0x301b].self_cycles == subroutines[0x301b].total_cycles > 0)
+check(subroutines[0x3000].total_cycles == guest_summary.cycles)
+print("-" * 50)
+
+print( "Test:   block translation matches instruction level")
+block_lc = LC3()
+fast_lc = LC3()
+load_test_program(block_lc)
+load_test_program(fast_lc)
+for _ in range(44):
+    fast_lc.execute_instruction()
+block_count = block_lc.run_blocks(44)
+check(block_count == 44 and block_lc.cu.regs == expected_regs)
+check(block_lc.architectural_state() == fast_lc.architectural_state() and
+      latch_state(block_lc) == latch_state(fast_lc))
+check(instruction_counts(block_lc) == instruction_counts(fast_lc))
+random.seed(7)
+match_programs = 0
+for _ in range(300):
+    program = [random.randrange(0x10000) for _ in range(12)]
+    registers = [random.choice([0x3000 + random.randrange(0x20), random.randrange(0x10000)]) for _ in range(8)]
+    kernel = random.random() < 0.3
+    block_lc = LC3()
+    fast_lc = LC3()
+    for machine in (block_lc, fast_lc):
+        machine.mem.memory[0x3000:0x300c] = program
+        machine.cu.regs = list(registers)
+        if kernel:
+            machine.cu.PSR = 0
+    instructions = random.randrange(1, 20)
+    for _ in range(instructions):
+        fast_lc.execute_instruction()
+    block_lc.run_blocks(instructions)
+    if (block_lc.architectural_state() == fast_lc.architectural_state() and
+            latch_state(block_lc) == latch_state(fast_lc) and
+            instruction_counts(block_lc) == instruction_counts(fast_lc)):
+        match_programs += 1
+# A loop that stores over its own add, which must then run as the new instruction
+smc_program = [
+    0b0001_001_001_1_00001,         # loop    add r1, r1, #1
+    0b0111_010_011_000000,          #         str r2, r3, #0
+    0b0001_000_000_1_11111,         #         add r0, r0, #-1
+    0b0000_001_111111100,           #         brp loop
+]
+smc_lc = LC3()
+smc_lc.mem.memory[0x3000:0x3004] = smc_program
+smc_lc.cu.regs = [3, 0, 0b0001_001_001_1_00010, 0x3000, 0, 0, 0, 0]
+smc_lc.run_blocks(12)
+# A loop leaving with an ACV on a later time round, before anything sets NZP again
+acv_loop_program = [
+    0b0111_000_001_000000,          # start   str r0, r1, #0
+    0b0001_001_001_1_11111,         #         add r1, r1, #-1
+    0b0000_001_111111101,           #         brp start
+]
+acv_loop_lcs = (LC3(), LC3())
+for machine in acv_loop_lcs:
+    machine.mem.memory[0x4000:0x4003] = acv_loop_program
+    machine.cu.regs[1] = 0x3004
+    machine.cu.PC = 0x4000
+for _ in range(16):
+    acv_loop_lcs[0].execute_instruction()
+acv_loop_count = acv_loop_lcs[1].execute_block(30)
+print(f"Result: {match_programs} of 300 programs match, self modifying loop r1 = {smc_lc.cu.regs[1]}")
+check(match_programs == 300)
+check(smc_lc.cu.regs[0] == 0 and smc_lc.cu.regs[1] == 5)      # +1 then +2 twice
+check(acv_loop_lcs[1].architectural_state() == acv_loop_lcs[0].architectural_state() and
+      latch_state(acv_loop_lcs[1]) == latch_state(acv_loop_lcs[0]))
+check(acv_loop_count == 16 and acv_loop_lcs[1].cu.ACV and acv_loop_lcs[1].cu.P)
+print("-" * 50)
+
+print( "Test:   next state table")
+from LC3 import (HARDWIRED_NEXT_STATE_TABLE, build_next_state_table, control_signals,
+                 next_state_index, reachable_states, save_next_state_table, load_next_state_table)
+# The sequencer as the condition tests it replaced
+def sequencer(s, ir, r, ben, psr, interrupt, acv):
+    if s.IRD:
+        return ir >> 12
+    return s.J + {0: 0, 1: 2 * r, 2: 4 * ben, 3: (ir >> 11) & 1, 4: 8 * (psr >> 15),
+                  5: 16 * interrupt, 6: 32 * acv}[s.COND]
+words = build_control_store()
+table = build_next_state_table(words)
+random.seed(11)
+match_inputs = 0
+for _ in range(2000):
+    state = random.randrange(64)
+    inputs = (random.randrange(0x10000), random.randrange(2), random.randrange(2),
+              random.choice([0, 0x8000]), random.randrange(2), random.randrange(2))
+    if table[next_state_index(state, *inputs)] == sequencer(control_signals(words[state]), *inputs):
+        match_inputs += 1
+reached = reachable_states(table)
+with tempfile.TemporaryDirectory() as directory:
+    filename = os.path.join(directory, "next_state.bin")
+    save_next_state_table(filename, table)
+    loaded_table = load_next_state_table(filename)
+print(f"Result: {match_inputs} of 2000 inputs match, {len(reached)} states reachable")
+check(match_inputs == 2000)
+check(table == HARDWIRED_NEXT_STATE_TABLE == loaded_table and len(table) == 64 * 1024)
+check(LC3().cu.next_state_table is HARDWIRED_NEXT_STATE_TABLE)
+check(set(range(46)) <= reached and {47, 48, 49, 51, 52, 53, 54, 55, 56, 57, 59, 60, 61} <= reached)
+check(not reached & {46, 50, 58, 62, 63})
+print("-" * 50)
+
+print( "Test:   specialised engine matches hardwired engine every cycle")
+hardwired = LC3()
+specialised = LC3()
+specialised.set_engine("specialised")
+load_test_program(hardwired)
+load_test_program(specialised)
+match_cycles = 0
+for _ in range(440):
+    hardwired.execute()
+    specialised.execute()
+    if (machine_state(hardwired) == machine_state(specialised) and
+            hardwired.mem.memory == specialised.mem.memory):
+        match_cycles += 1
+random.seed(13)
+match_programs = 0
+for program_number in range(100):
+    program = [random.randrange(0x10000) for _ in range(16)]
+    registers = [random.choice([0x3000 + random.randrange(0x20), random.randrange(0x10000)]) for _ in range(8)]
+    hardwired_lc = LC3()
+    specialised_lc = LC3()
+    specialised_lc.set_engine("specialised")
+    for machine in (hardwired_lc, specialised_lc):
+        machine.mem.memory[0x3000:0x3010] = program
+        machine.cu.regs = list(registers)
+        machine.mem.set_latency(1 + program_number % 3)
+        machine.cu.INT = program_number % 4 == 0
+        if program_number % 5 == 0:
+            machine.cu.PSR = 0
+    for _ in range(300):
+        hardwired_lc.execute()
+        specialised_lc.execute()
+        if machine_state(hardwired_lc) != machine_state(specialised_lc):
+            break
+    else:
+        if (hardwired_lc.architectural_state() == specialised_lc.architectural_state() and
+                hardwired_lc.counters() == specialised_lc.counters()):
+            match_programs += 1
+print(f"Result: {match_cycles} of 440 cycles match, {match_programs} of 100 programs match")
+check(match_cycles == 440)
+check(match_programs == 100)
+check(specialised.cu.regs == expected_regs)
+print("-" * 50)
+
+print( "Test:   fused engine keeps exact cycle counts")
+unfused_lc = LC3()
+fused_lc = LC3()
+unfused_lc.set_engine("specialised")
+fused_lc.set_engine("fused")
+load_test_program(unfused_lc)
+load_test_program(fused_lc)
+summaries = []
+for machine in (unfused_lc, fused_lc):
+    machine.breakpoints.add(0x3016)
+    summaries.append(machine.run(1000))
+    machine.breakpoints.clear()
+    summaries.append(machine.run(137))
+    summaries.append(machine.run(1000))
+random.seed(17)
+match_programs = 0
+for program_number in range(100):
+    program = [random.randrange(0x10000) for _ in range(16)]
+    registers = [0x3000 + random.randrange(0x20) for _ in range(8)]
+    unfused_program_lc = LC3()
+    fused_program_lc = LC3()
+    unfused_program_lc.set_engine("specialised")
+    fused_program_lc.set_engine("fused")
+    for machine in (unfused_program_lc, fused_program_lc):
+        machine.mem.memory[0x3000:0x3010] = program
+        machine.cu.regs = list(registers)
+        machine.mem.set_latency(program_number % 6)
+        machine.cu.INT = program_number % 4 == 0
+    if (unfused_program_lc.run(97, stop_on_halt=False) == fused_program_lc.run(97, stop_on_halt=False) and
+            unfused_program_lc.run_instructions(5) == fused_program_lc.run_instructions(5) and
+            machine_state(unfused_program_lc) == machine_state(fused_program_lc) and
+            unfused_program_lc.architectural_state() == fused_program_lc.architectural_state() and
+            unfused_program_lc.counters() == fused_program_lc.counters()):
+        match_programs += 1
+print(f"Result: {summaries[3:]}, {match_programs} of 100 programs match")
+check(summaries[:3] == summaries[3:] and summaries[3].reason == "breakpoint")
+check(machine_state(unfused_lc) == machine_state(fused_lc) and unfused_lc.counters() == fused_lc.counters())
+check(fused_lc.cu.regs == expected_regs)
+check(match_programs == 100)
+# The fetch, 18 to 32, is one fused run
+from LC3 import fused_run
+check(fused_run(fused_lc.control_store, 18) == [18, 33, 28, 30, 32])
+check(fused_lc.fused_runs[fused_lc.mem.clock_latency][18] is not None)
+# Runs for the latency set are built with the engine, not in the first run
+eager_lc = LC3()
+eager_lc.mem.set_latency(1)
+eager_lc.set_engine("fused")
+check(list(eager_lc.fused_runs) == [1])
+print("-" * 50)
+
+print( "Test:   instruction costs from the control store")
+from LC3 import HARDWIRED_COST_TABLE, InstructionCost, build_cost_table, instruction_cycles, instruction_paths
+paths = instruction_paths(build_control_store())
+cost_table = build_cost_table(build_control_store())
+# (INT, opcode, BEN, IR11, PSR15, ACV)
+check(cost_table == HARDWIRED_COST_TABLE)
+check(cost_table[(False, 0b0000, False, False, True, 0)] == InstructionCost(5, 1))     # BR not taken
+check(cost_table[(False, 0b0000, True, False, True, 0)] == InstructionCost(6, 1))      # BR taken
+check(cost_table[(True, 0b0000, True, False, True, 0)] == InstructionCost(8, 3))       # INT from user mode
+check(cost_table[(False, 0b1000, False, False, False, 0)] == InstructionCost(10, 3))   # RTI
+check(cost_table[(False, 0b1000, False, False, True, 0)] == InstructionCost(12, 4))    # RTI in user mode
+check(cost_table[(False, 0b1010, False, False, True, 0)] == InstructionCost(9, 3))     # LDI
+check(cost_table[(False, 0b1010, False, False, True, 2)] == InstructionCost(7, 1))     # LDI pointer ACV
+check(cost_table[(False, 0b0001, False, False, True, 1)] == InstructionCost(3, 0))     # fetch ACV
+check(instruction_cycles(cost_table[(False, 0b0001, False, False, True, 0)], 3) == 8)
+match_runs = 0
+for latency in [0, 1, 3, device_latency(2, 7)]:
+    cycle_lc = LC3()
+    fast_lc = LC3()
+    block_lc = LC3()
+    for machine in (cycle_lc, fast_lc, block_lc):
+        load_test_program(machine)
+        machine.mem.set_latency(latency)
+        machine.cu.INT = True
+    run_instructions_cycle_accurate(cycle_lc, 44)
+    for _ in range(44):
+        fast_lc.execute_instruction()
+    block_lc.run_blocks(44)
+    if (cycle_lc.cycles == fast_lc.cycles == block_lc.cycles and
+            cycle_lc.counters() == fast_lc.counters() == block_lc.counters()):
+        match_runs += 1
+random.seed(19)
+match_programs = 0
+for program_number in range(200):
+    program = [random.randrange(0x10000) for _ in range(12)]
+    registers = [random.choice([0x3000 + random.randrange(0x20), 0xfe00 + random.randrange(4)]) for _ in range(8)]
+    cycle_lc = LC3()
+    fast_lc = LC3()
+    for machine in (cycle_lc, fast_lc):
+        machine.mem.memory[0x3000:0x300c] = program
+        machine.cu.regs = list(registers)
+        machine.mem.set_latency(program_number % 4)
+        if program_number % 3 == 0:
+            machine.cu.PSR = 0
+    for _ in range(12):
+        cycle_lc.cu.INT = fast_lc.cu.INT = random.random() < 0.2
+        run_instructions_cycle_accurate(cycle_lc, 1)
+        fast_lc.execute_instruction()
+    if (cycle_lc.cycles == fast_lc.cycles and cycle_lc.architectural_state() == fast_lc.architectural_state() and
+            cycle_lc.counters() == fast_lc.counters()):
+        match_programs += 1
+print(f"Result: {len(paths)} paths, {match_runs} of 4 latencies match, {match_programs} of 200 programs match")
+check(match_runs == 4)
+check(match_programs == 200)
+print("-" * 50)
+
+print( "Test:   interrupt controller with a timer")
+from LC3 import InterruptController, InterruptDevice, Timer, TIMER_VECTOR
+interrupt_program = [
+    0b0001_011_011_1_00001,     # 0x3000  main  add r3, r3, #1
+    0b0000_111_111111110,       #               br  main
+    0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0,
+    0b0001_100_100_1_00001,     # 0x3010  slow  add r4, r4, #1   - priority 2, long enough to be interrupted
+    0b0101_101_101_1_00000,     #               and r5, r5, #0
+    0b0001_101_101_1_01111,     #               add r5, r5, #15
+    0b0001_101_101_1_11111,     #         wait  add r5, r5, #-1
+    0b0000_001_111111110,       #               brp wait
+    0b1000_000000000000,        #               rti
+    0, 0, 0, 0, 0, 0, 0, 0, 0, 0,
+    0b0001_010_010_1_00001,     # 0x3020  tick  add r2, r2, #1   - the timer, priority 4
+    0b1000_000000000000]        #               rti
+def interrupt_machine(engine):
+    machine = LC3()
+    machine.set_engine(engine)
+    machine.mem.set_latency(2)
+    machine.mem.memory[0x3000:0x3000 + len(interrupt_program)] = interrupt_program
+    machine.mem.memory[0x0100 + TIMER_VECTOR] = 0x3020
+    machine.mem.memory[0x0190] = 0x3010
+    machine.set_interrupts(InterruptController())
+    machine.interrupts.add_device(Timer(60), 0)
+    machine.interrupts.add_device(InterruptDevice(2, 0x90, cycle=100), 0)
+    return machine
+interrupt_states = []
+for engine in ["hardwired", "microcode", "specialised", "fused", "fast", "blocks"]:
+    machine = interrupt_machine("microcode" if engine in ("fast", "blocks") else engine)
+    if engine == "fast":
+        for _ in range(500):
+            machine.execute_instruction()
+    elif engine == "blocks":
+        machine.run_blocks(500)
+    else:
+        summary = machine.run_instructions(500)
+        check(summary.reason == "instructions")
+    interrupt_states.append((machine.cycles, machine.architectural_state(), latch_state(machine),
+                             machine.cu.PSR, machine.interrupts.devices[0].ticks))
+timer_machine = interrupt_machine("fused")
+timer_machine.run_instructions(500)
+ticks = timer_machine.interrupts.devices[0].ticks
+print(f"Result: {timer_machine.cycles} cycles, {ticks} ticks, R2 {timer_machine.cu.regs[2]} R4 {timer_machine.cu.regs[4]}")
+check(all(state == interrupt_states[0] for state in interrupt_states))
+# Every tick is taken, the last one may still be waiting
+check(timer_machine.cu.regs[4] == 1 and timer_machine.cu.regs[2] == ticks - timer_machine.cu.INT)
+check(timer_machine.counters().interrupts == timer_machine.cu.regs[2] + 1)
+# Snapshots and the undo history keep the queue, requests and timer ticks
+def interrupt_state(machine):
+    return (machine.cycles, machine.architectural_state(), latch_state(machine),
+            machine.cu.PSR, machine.interrupts.devices[0].ticks)
+restore_machine = interrupt_machine("hardwired")
+restore_machine.run(200)
+interrupt_checkpoint = restore_machine.snapshot()
+restore_machine.run(300)
+interrupt_end = interrupt_state(restore_machine)
+restore_machine.restore(interrupt_checkpoint)
+restore_machine.run(300)
+check(interrupt_state(restore_machine) == interrupt_end)
+fork_machine = interrupt_machine("hardwired")
+fork_machine.restore(interrupt_checkpoint)
+fork_machine.run(300)
+check(interrupt_state(fork_machine) == interrupt_end)
+history_machine = interrupt_machine("hardwired")
+history_machine.record_history(length=100, snapshot_interval=64)
+history_machine.run(500)
+replays = 0
+for cycles in (200, 30):
+    history_machine.step_back(cycles)
+    history_machine.run(cycles)
+    replays += interrupt_state(history_machine) == interrupt_end
+check(replays == 2)
+# Back to a cycle with both a snapshot and a timer event, through the snapshot or through
+# the journal, is the machine before the event either way
+event_cycle_states = []
+for length in (10, 1000):
+    history_machine = interrupt_machine("hardwired")
+    history_machine.record_history(length=length, snapshot_interval=60)
+    history_machine.run(500)
+    history_machine.step_back(20)
+    event_cycle_states.append((interrupt_state(history_machine), history_machine.interrupts.snapshot()))
+    history_machine.run(20)
+    check(interrupt_state(history_machine) == interrupt_end)
+check(event_cycle_states[0] == event_cycle_states[1])
+restore_error = None
+try:
+    LC3().restore(interrupt_checkpoint)
+except ValueError as error:
+    restore_error = error
+check(restore_error is not None)
+# RTI in user mode is a privilege mode exception, through vector x00
+exception_states = []
+for fast in (False, True):
+    machine = LC3()
+    machine.mem.memory[0x3000] = 0b1000_000000000000
+    machine.mem.memory[0x0100] = 0x0200
+    machine.cu.regs[6] = 0x4000
+    if fast:
+        machine.execute_instruction()
+    else:
+        run_instructions_cycle_accurate(machine, 1)
+    exception_states.append((machine.cycles, machine.architectural_state(), latch_state(machine)))
+check(exception_states[0] == exception_states[1])
+check(machine.cu.PC == 0x0200 and machine.cu.PSR == 0 and machine.cu.regs[6] == 0x2ffe)
+check(machine.cu.SAVED_USP == 0x4000 and list(machine.mem.memory[0x2ffe:0x3000]) == [0x3000, 0x8000])
+# A spin with a timer still to come is not a halt
+spin_lc = LC3()
+spin_lc.mem.memory[0x3000] = 0x0fff
+spin_lc.cu.Z = True
+spin_lc.set_interrupts(InterruptController())
+check(spin_lc.run(100).reason == "halt")
+spin_lc.interrupts.add_device(Timer(1000), spin_lc.cycles)
+check(spin_lc.run(100).reason == "cycles")
+print("-" * 50)
@@ -0,0 +1,151 @@
+# LC3 trace - one fixed size binary record for every cycle, for long runs looked at afterwards
+
+# A trace file is a header then records, all little endian
+#   header  "LC3T", version (uint16), record size (uint16)
+#   record  cycle (uint64), state, next state, flags, register (uint8 each),
+#           bus, PC, IR, MAR, MDR, register value, memory address, memory value (uint16 each)
+#
+# bus, PC, IR, MAR and MDR are as they are at the end of the cycle
+# flags say what else happened in the cycle
+#   TRACE_REG_WRITE - register was loaded with register value
+#   TRACE_MEM_READ  - memory address was read, memory value is the word read
+#   TRACE_MEM_WRITE - memory address was written with memory value
+#
+# Records are packed into a buffer and written out in large blocks, through gzip, bz2
+# or lzma if asked for; the reader finds the compression from the file itself
+
+import bz2
+import gzip
+import lzma
+import struct
+from collections import namedtuple
+
+TRACE_MAGIC = b"LC3T"
+TRACE_VERSION = 1
+
+TRACE_HEADER = struct.Struct("<4sHH")
+TRACE_RECORD = struct.Struct("<QBBBBHHHHHHHH")
+
+TRACE_REG_WRITE = 0x01
+TRACE_MEM_READ  = 0x02
+TRACE_MEM_WRITE = 0x04
+
+TraceRecord = namedtuple("TraceRecord", ["cycle", "state", "next_state", "flags", "reg",
+                                         "bus", "PC", "IR", "MAR", "MDR",
+                                         "reg_value", "mem_address", "mem_value"])
+
+# The same layout as a numpy structured array dtype
+TRACE_DTYPE = [("cycle", "<u8"), ("state", "u1"), ("next_state", "u1"), ("flags", "u1"),
+               ("reg", "u1"), ("bus", "<u2"), ("PC", "<u2"), ("IR", "<u2"), ("MAR", "<u2"),
+               ("MDR", "<u2"), ("reg_value", "<u2"), ("mem_address", "<u2"), ("mem_value", "<u2")]
+
+COMPRESSION = {None: open, "gzip": gzip.open, "bz2": bz2.open, "lzma": lzma.open}
+
+# Bytes each kind of compressed file starts with
+COMPRESSION_MAGIC = [(b"\x1f\x8b", "gzip"), (b"BZh", "bz2"), (b"\xfd7zXZ\x00", "lzma")]
+
+# Records are written out once the buffer has this many bytes
+TRACE_BUFFER_SIZE = 1 << 20
+
+# Traces every cycle of an LC3 from when it is made until close()
+# Can be used in a with statement, which closes it at the end
+
+class TraceWriter():
+    def __init__(self, lc, filename, compression=None):
+        if compression not in COMPRESSION:
+            raise ValueError(f"Unknown compression {compression}")
+        self.lc = lc
+        self.file = COMPRESSION[compression](filename, "wb")
+        self.file.write(TRACE_HEADER.pack(TRACE_MAGIC, TRACE_VERSION, TRACE_RECORD.size))
+        self.buffer = bytearray()
+        self.records = 0
+        lc.add_hook(self)
+
+    def wrap(self, execute):
+        self.execute_inner = execute
+        return self.execute
+
+    def execute(self):
+        lc = self.lc
+        cu = lc.cu
+        state = cu.state
+        mar = cu.MAR
+
+        self.execute_inner()
+
+        s = cu.signals
+        flags = 0
+        reg = reg_value = mem_address = mem_value = 0
+        if s.LD_REG:
+            flags = TRACE_REG_WRITE
+            reg = cu.DR
+            reg_value = cu.bus
+        # R is only set in the cycle an access finishes, always at the MAR it started with
+        if cu.R:
+            flags |= TRACE_MEM_WRITE if s.RW else TRACE_MEM_READ
+            mem_address = mar
+            mem_value = lc.mem.view[mar]
+        self.buffer += TRACE_RECORD.pack(lc.cycles, state, cu.state, flags, reg,
+                                         cu.bus, cu.PC & 0xffff, cu.IR, cu.MAR, cu.MDR,
+                                         reg_value, mem_address, mem_value)
+        self.records += 1
+        if len(self.buffer) >= TRACE_BUFFER_SIZE:
+            self.flush()
+
+    def flush(self):
+        self.file.write(self.buffer)
+        self.buffer.clear()
+
+    def close(self):
+        if self in self.lc.hooks:
+            self.lc.remove_hook(self)
+        self.flush()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exception):
+        self.close()
+
+def open_trace(filename):
+    with open(filename, "rb") as f:
+        start = f.read(6)
+    compression = None
+    for magic, name in COMPRESSION_MAGIC:
+        if start.startswith(magic):
+            compression = name
+    f = COMPRESSION[compression](filename, "rb")
+    header = f.read(TRACE_HEADER.size)
+    if len(header) != TRACE_HEADER.size:
+        f.close()
+        raise ValueError(f"{filename} is not an LC3 trace")
+    magic, version, record_size = TRACE_HEADER.unpack(header)
+    if magic != TRACE_MAGIC or version != TRACE_VERSION or record_size != TRACE_RECORD.size:
+        f.close()
+        raise ValueError(f"{filename} is not an LC3 trace version {TRACE_VERSION}")
+    return f
+
+# Every record in a trace as a TraceRecord, read a block at a time
+
+def read_trace(filename, block_records=1 << 16):
+    with open_trace(filename) as f:
+        while True:
+            block = f.read(TRACE_RECORD.size * block_records)
+            if not block:
+                break
+            if len(block) % TRACE_RECORD.size != 0:
+                raise ValueError(f"{filename} ends part way through a record")
+            for values in TRACE_RECORD.iter_unpack(block):
+                yield TraceRecord(*values)
+
+# The whole trace as a numpy structured array, with a field for each TraceRecord name
+# Needs numpy, which the emulator itself does not
+
+def read_trace_array(filename):
+    import numpy
+    with open_trace(filename) as f:
+        data = f.read()
+    if len(data) % TRACE_RECORD.size != 0:
+        raise ValueError(f"{filename} ends part way through a record")
+    return numpy.frombuffer(data, dtype=numpy.dtype(TRACE_DTYPE))
@@ -0,0 +1,232 @@
+# LC3 lockstep engine - runs many LC3 machines at once, one microstate per step, with numpy
+
+# Every machine (lane) has its own registers, latches, state and 64K words of memory,
+# all held as numpy arrays with one row per lane
+#   regs            (lanes, 8)       uint16
+#   memory          (lanes, 0x10000) uint16
+#   PC, IR, MAR ... (lanes,)
+#
+# Each step works out the control signals of every lane from its own state, through the
+# control store, then runs the same datapath as ControlUnit.execute_logic() and
+# set_new_state() on the whole arrays, so lanes in different states just select
+# different inputs and load different registers
+# After the same number of cycles each lane matches an LC3 run on its own, cycle for cycle
+#
+# Needs numpy, which the emulator itself does not
+
+from array import array
+
+import numpy
+
+from LC3 import (ArchitecturalState, CONTROL_STORE_SIZE, MICROINSTRUCTION_FIELDS,
+                 RegionLatency, bit_field_array, build_control_store, build_next_state_table,
+                 control_signals, sign_extend_array, zero_extend_array)
+
+class LC3Vector():
+    def __init__(self, lanes, control_store=None, latency=3):
+        if control_store is None:
+            control_store = build_control_store()
+        if len(control_store) != CONTROL_STORE_SIZE:
+            raise ValueError(f"Control store needs {CONTROL_STORE_SIZE} words, got {len(control_store)}")
+
+        # One table per control signal, indexed by state
+        # One bit signals, RW as well, are bool so they can mask lanes
+        signals = [control_signals(word) for word in control_store]
+        self.control_table = {}
+        for index, (name, bits, _) in enumerate(MICROINSTRUCTION_FIELDS):
+            values = [s[index] for s in signals]
+            self.control_table[name] = numpy.array(values, dtype=bool if bits == 1 else numpy.uint8)
+        self.next_state_table = numpy.frombuffer(build_next_state_table(control_store), dtype=numpy.uint8)
+
+        self.lanes = lanes
+        self.lane = numpy.arange(lanes)
+        self.set_latency(latency)
+        self.reset()
+
+    def reset(self):
+        lanes = self.lanes
+        self.regs = numpy.zeros((lanes, 8), dtype=numpy.uint16)
+        self.memory = numpy.zeros((lanes, 0x10000), dtype=numpy.uint16)
+
+        self.PC = numpy.full(lanes, 0x3000, dtype=numpy.uint16)
+        self.IR = numpy.zeros(lanes, dtype=numpy.uint16)
+        self.PSR = numpy.full(lanes, 0x8000, dtype=numpy.uint16)
+        self.bus = numpy.zeros(lanes, dtype=numpy.uint16)
+        self.MDR = numpy.zeros(lanes, dtype=numpy.uint16)
+        self.MAR = numpy.zeros(lanes, dtype=numpy.uint16)
+        self.SAVED_SSP = numpy.full(lanes, 0x3000, dtype=numpy.uint16)
+        self.SAVED_USP = numpy.zeros(lanes, dtype=numpy.uint16)
+        self.VECTOR = numpy.zeros(lanes, dtype=numpy.uint16)
+
+        self.R = numpy.zeros(lanes, dtype=bool)
+        self.BEN = numpy.zeros(lanes, dtype=bool)
+        self.ACV = numpy.zeros(lanes, dtype=bool)
+        # Set by hand for each lane, there is no interrupt controller
+        self.INT = numpy.zeros(lanes, dtype=bool)
+        self.INTV = numpy.zeros(lanes, dtype=numpy.uint16)
+        self.INT_PRIORITY = numpy.zeros(lanes, dtype=numpy.uint16)
+        self.N = numpy.zeros(lanes, dtype=bool)
+        self.Z = numpy.zeros(lanes, dtype=bool)
+        self.P = numpy.zeros(lanes, dtype=bool)
+
+        # The gates in process_gating() put out what these were last clock
+        self.ALU_OUT = numpy.zeros(lanes, dtype=numpy.uint16)
+        self.MAR_MUX_OUT = numpy.zeros(lanes, dtype=numpy.uint16)
+
+        self.state = numpy.full(lanes, 18, dtype=numpy.uint8)
+
+        # Memory access in progress, as Memory.clock_count and access_latency
+        self.clock_count = numpy.zeros(lanes, dtype=numpy.int32)
+        self.access_latency = numpy.full(lanes, self.clock_latency, dtype=numpy.int32)
+
+        self.cycles = 0
+
+    # A number of cycles for every access, or a RegionLatency
+    # Other latency models are called per access, so can't be run on every lane at once
+
+    def set_latency(self, latency):
+        if isinstance(latency, int):
+            self.clock_latency = latency
+            self.latency_model = None
+        elif isinstance(latency, RegionLatency):
+            self.clock_latency = latency.default
+            self.latency_model = latency
+        else:
+            raise ValueError("Only a number of cycles or a RegionLatency can be used for every lane")
+
+    # Copy words into memory at origin, for every lane or just the lanes given
+
+    def load(self, origin, words, lanes=None):
+        if lanes is None:
+            lanes = slice(None)
+        self.memory[lanes, origin:origin + len(words)] = words
+
+    def architectural_state(self, lane):
+        return ArchitecturalState(tuple(self.regs[lane].tolist()), int(self.PC[lane]),
+                                  bool(self.N[lane]), bool(self.Z[lane]), bool(self.P[lane]),
+                                  array("H", self.memory[lane].tobytes()))
+
+    def step(self):
+        self.cycles += 1
+        lane = self.lane
+        state = self.state
+
+        # Control signals of each lane from its state
+        t = self.control_table
+        mio_en = t["MIO_EN"][state]
+        rw = t["RW"][state]
+
+        # Acknowledging INT, as set_microcode_signals()
+        self.INT &= state != 49
+
+        # Memory - as Memory.clock_cycle()
+        self.R[:] = False
+        memory_out = numpy.zeros(self.lanes, dtype=numpy.uint16)
+        if mio_en.any():
+            starting = mio_en & (self.clock_count == 0)
+            if self.latency_model is not None:
+                latency = numpy.full(self.lanes, self.clock_latency, dtype=numpy.int32)
+                for first, last, cycles in self.latency_model.regions:
+                    latency[(self.MAR >= first) & (self.MAR <= last)] = cycles
+                self.access_latency = numpy.where(starting, latency, self.access_latency)
+            else:
+                self.access_latency[starting] = self.clock_latency
+            self.clock_count += mio_en
+            ready = mio_en & (self.clock_count >= self.access_latency)
+            self.clock_count[ready] = 0
+            self.R = ready
+            write = ready & rw
+            if write.any():
+                self.memory[lane[write], self.MAR[write]] = self.MDR[write]
+            read = ready & ~rw
+            memory_out[read] = self.memory[lane[read], self.MAR[read]]
+
+        # Gates - as process_gating()
+        gate_alu = t["GATE_ALU"][state]
+        gate_marmux = t["GATE_MARMUX"][state]
+        bus = numpy.where(t["GATE_PC"][state], self.PC, self.bus)
+        bus = numpy.where(t["GATE_MDR"][state], self.MDR, bus)
+        bus = numpy.where(gate_alu, self.ALU_OUT, bus)
+        bus = numpy.where(gate_marmux, self.MAR_MUX_OUT, bus)
+        nzp = (self.N.astype(numpy.uint16) << 2) | (self.Z.astype(numpy.uint16) << 1) | self.P
+        table = t["TABLE_MUX"][state].astype(numpy.uint16) << 8
+        bus = numpy.where(t["GATE_VECTOR"][state], table | self.VECTOR, bus)
+        bus = numpy.where(t["GATE_PC_MINUS_1"][state], self.PC - 1, bus)
+        bus = numpy.where(t["GATE_PSR"][state], self.PSR | nzp, bus)
+
+        # Datapath - as execute_logic()
+        ir = self.IR
+        dr = bit_field_array(ir, 11, 9)
+        sr1 = bit_field_array(ir, 8, 6)
+        six = numpy.full(self.lanes, 6, dtype=numpy.uint16)
+
+        DR = numpy.choose(t["DR_MUX"][state], (dr, six, numpy.full(self.lanes, 7, dtype=numpy.uint16)))
+        SR1 = numpy.choose(t["SR1_MUX"][state], (dr, sr1, six))
+        SR2 = bit_field_array(ir, 2, 0)
+
+        addr2_mux_out = numpy.choose(t["ADDR2_MUX"][state],
+                                     (numpy.zeros(self.lanes, dtype=numpy.uint16),
+                                      sign_extend_array(ir, 6), sign_extend_array(ir, 9),
+                                      sign_extend_array(ir, 11)))
+        sr1_out = self.regs[lane, SR1]
+        sr2_out = self.regs[lane, SR2]
+        sp_mux_out = numpy.choose(t["SP_MUX"][state], (sr1_out + 1, sr1_out - 1, self.SAVED_SSP, self.SAVED_USP))
+        bus = numpy.where(t["GATE_SP"][state], sp_mux_out, bus)
+        addr1_mux_out = numpy.where(t["ADDR1_MUX"][state], sr1_out, self.PC)
+        addr_add_out = addr1_mux_out + addr2_mux_out
+
+        self.MAR_MUX_OUT = numpy.where(t["MAR_MUX"][state], addr_add_out, zero_extend_array(ir, 8))
+        bus = numpy.where(gate_marmux, self.MAR_MUX_OUT, bus)
+
+        pc_mux_out = numpy.choose(t["PC_MUX"][state], (self.PC + 1, bus, addr_add_out))
+
+        sr2_mux_out = numpy.where((ir & 0x20) != 0, sign_extend_array(ir, 5), sr2_out)
+        self.ALU_OUT = numpy.choose(t["ALUK"][state], (sr2_mux_out + sr1_out, sr2_mux_out & sr1_out,
+                                                       ~sr1_out, sr1_out))
+        bus = numpy.where(gate_alu, self.ALU_OUT, bus)
+        self.bus = bus
+
+        ben_out = (dr & nzp) != 0
+        acv_out = ((self.PSR & 0x8000) != 0) & ((bus >= 0xfe00) | (bus < 0x3000))
+
+        # Next state - as set_new_state(), through the next state table
+        index = ((state.astype(numpy.uint16) << 10) | ((ir >> 6) & 0x3c0) | ((ir >> 11) & 1) |
+                 (self.R.astype(numpy.uint16) << 1) | (self.BEN.astype(numpy.uint16) << 2) |
+                 ((self.PSR >> 12) & 8) | (self.INT.astype(numpy.uint16) << 4) |
+                 (self.ACV.astype(numpy.uint16) << 5))
+        self.state = self.next_state_table[index]
+
+        # Loads - as load_registers()
+        ld_mdr = t["LD_MDR"][state]
+        self.MDR = numpy.where(ld_mdr, numpy.where(mio_en, memory_out, bus), self.MDR)
+        self.MAR = numpy.where(t["LD_MAR"][state], bus, self.MAR)
+        self.PC = numpy.where(t["LD_PC"][state], pc_mux_out, self.PC)
+        self.IR = numpy.where(t["LD_IR"][state], bus, self.IR)
+
+        # PSRMux BUS loads NZP and the rest of PSR from a PSR on the bus
+        ld_cc = t["LD_CC"][state]
+        psr_bus = t["PSR_MUX"][state]
+        self.Z = numpy.where(ld_cc, numpy.where(psr_bus, (bus & 2) != 0, bus == 0), self.Z)
+        self.P = numpy.where(ld_cc, numpy.where(psr_bus, (bus & 1) != 0, (bus > 0) & (bus <= 0x7fff)), self.P)
+        self.N = numpy.where(ld_cc, numpy.where(psr_bus, (bus & 4) != 0, bus > 0x7fff), self.N)
+
+        ld_reg = t["LD_REG"][state]
+        if ld_reg.any():
+            self.regs[lane[ld_reg], DR[ld_reg]] = bus[ld_reg]
+
+        self.ACV = numpy.where(t["LD_ACV"][state], acv_out, self.ACV)
+        self.BEN = numpy.where(t["LD_BEN"][state], ben_out, self.BEN)
+
+        vectors = (self.INTV, numpy.full(self.lanes, 0x00, dtype=numpy.uint16),
+                   numpy.full(self.lanes, 0x01, dtype=numpy.uint16), numpy.full(self.lanes, 0x02, dtype=numpy.uint16))
+        self.VECTOR = numpy.where(t["LD_VECTOR"][state], numpy.choose(t["VECTOR_MUX"][state], vectors), self.VECTOR)
+        priv = numpy.where(psr_bus, bus & 0x8000, t["SET_PRIV"][state].astype(numpy.uint16) << 15)
+        self.PSR = numpy.where(t["LD_PRIV"][state], (self.PSR & 0x7fff) | priv, self.PSR)
+        priority = numpy.where(psr_bus, bus & 0x0700, self.INT_PRIORITY << 8)
+        self.PSR = numpy.where(t["LD_PRIORITY"][state], (self.PSR & 0xf8ff) | priority, self.PSR)
+        self.SAVED_SSP = numpy.where(t["LD_SAVED_SSP"][state], sr1_out, self.SAVED_SSP)
+        self.SAVED_USP = numpy.where(t["LD_SAVED_USP"][state], sr1_out, self.SAVED_USP)
+
+    def run(self, cycles):
+        for _ in range(cycles):
+            self.step()